@@ -0,0 +1,452 @@
+#! /usr/bin/env python
+'''
+fake_apiserver.py -- in-memory stand-in for the kubernetes API server.
+
+Understands just enough of the API for the deployer: list (label / field
+selectors), get, create, merge-patch, delete, deletecollection, watch,
+server-side dry-run, /version and discovery.  GET /fake/stats returns the
+request and connection counts.  Every request can be slowed
+down by a fixed latency, and Deployments / Jobs / PVCs / StatefulSets /
+DaemonSets report themselves ready "ready_delay" seconds after they change.
+With --legacy, it serves only the API versions of a cluster from before
+apps/v1.
+'''
+
+import argparse
+import copy
+import json
+import re
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+PATH_RE = re.compile(r'^/apis?/(?:(?P<group>[^/]+)/)?(?P<version>v[^/]+)'
+                     r'(?:/namespaces/(?P<namespace>[^/]+))?'
+                     r'/(?P<plural>[^/]+)(?:/(?P<name>[^/]+))?$')
+
+# Discovery: group version -> [(kind, plural, namespaced)], groups' preferred
+# version first.  LEGACY is a cluster from before apps/v1 (like 1.7): it
+# answers only for the group versions it lists.
+_CORE = [('ConfigMap', 'configmaps', True), ('Endpoints', 'endpoints', True),
+         ('Namespace', 'namespaces', False), ('PersistentVolume', 'persistentvolumes', False),
+         ('PersistentVolumeClaim', 'persistentvolumeclaims', True), ('Pod', 'pods', True),
+         ('Secret', 'secrets', True), ('Service', 'services', True),
+         ('ServiceAccount', 'serviceaccounts', True)]
+_APPS = [('Deployment', 'deployments', True), ('DaemonSet', 'daemonsets', True),
+         ('ReplicaSet', 'replicasets', True), ('StatefulSet', 'statefulsets', True)]
+_RBAC = [('ClusterRole', 'clusterroles', False),
+         ('ClusterRoleBinding', 'clusterrolebindings', False),
+         ('Role', 'roles', True), ('RoleBinding', 'rolebindings', True)]
+DISCOVERY = [
+    ('v1', _CORE),
+    ('apps/v1', _APPS),
+    ('batch/v1', [('Job', 'jobs', True)]),
+    ('batch/v1beta1', [('CronJob', 'cronjobs', True)]),
+    ('extensions/v1beta1', [('Ingress', 'ingresses', True)] + _APPS[:3]),
+    ('rbac.authorization.k8s.io/v1', _RBAC),
+    ('apiextensions.k8s.io/v1beta1', [
+        ('CustomResourceDefinition', 'customresourcedefinitions', False)]),
+]
+LEGACY_DISCOVERY = [
+    ('v1', _CORE),
+    ('apps/v1beta1', [_APPS[0], _APPS[3]]),
+    ('batch/v1', [('Job', 'jobs', True)]),
+    ('batch/v2alpha1', [('CronJob', 'cronjobs', True)]),
+    ('extensions/v1beta1', [('Ingress', 'ingresses', True)] + _APPS[:3]),
+    ('rbac.authorization.k8s.io/v1beta1', _RBAC),
+]
+
+# plurals the server fakes a rollout status for
+WORKLOADS = ('deployments', 'statefulsets', 'daemonsets', 'replicasets',
+             'jobs', 'persistentvolumeclaims')
+
+
+def _groups(state):
+    # the APIGroupList of the served group versions (the first one listed
+    # for a group is its preferred version)
+    groups = []
+    for group_version, _resources in state.discovery:
+        if '/' not in group_version:
+            continue  # the core group (/api/v1)
+        name = group_version.split('/')[0]
+        version = {'groupVersion': group_version, 'version': group_version.split('/')[1]}
+        group = next((g for g in groups if g['name'] == name), None)
+        if group is None:
+            groups.append({'name': name, 'versions': [version], 'preferredVersion': version})
+        else:
+            group['versions'].append(version)
+    return groups
+
+
+class ClusterState(object):
+    '''
+    The fake cluster: objects keyed by (plural, namespace, name), plus an
+    event log for watches
+    '''
+    def __init__(self, latency=0.0, ready_delay=0.0, legacy=False):
+        self.latency = latency
+        self.ready_delay = ready_delay
+        self.legacy = legacy
+        self.discovery = LEGACY_DISCOVERY if legacy else DISCOVERY
+        self.objects = {}
+        self.changed = {}  # key -> time of last spec change
+        self.events = []  # (resourceVersion, plural, namespace, type, object)
+        self.resource_version = 1
+        self.request_count = 0
+        self.connection_count = 0
+        self.cond = threading.Condition()
+
+    def record(self, key, obj, event_type):
+        '''
+        Bump the resourceVersion and notify watchers (call with cond held)
+        '''
+        self.resource_version += 1
+        obj['metadata']['resourceVersion'] = str(self.resource_version)
+        self.events.append((self.resource_version, key[0], key[1], event_type,
+                            copy.deepcopy(obj)))
+        self.cond.notify_all()
+
+    def progress(self):
+        '''
+        Mark workloads ready once ready_delay has passed since they changed
+        '''
+        with self.cond:
+            now = time.time()
+            for key, obj in self.objects.items():
+                if key[0] not in WORKLOADS or now - self.changed.get(key, 0) < self.ready_delay:
+                    continue
+                status = _ready_status(key[0], obj)
+                if obj.get('status') != status:
+                    obj['status'] = status
+                    self.record(key, obj, 'MODIFIED')
+
+
+def _ready_status(plural, obj):
+    spec = obj.get('spec') or {}
+    generation = obj['metadata'].get('generation', 1)
+    if plural == 'persistentvolumeclaims':
+        return {'phase': 'Bound'}
+    if plural == 'jobs':
+        return {'succeeded': spec.get('completions', 1),
+                'conditions': [{'type': 'Complete', 'status': 'True'}]}
+    replicas = spec.get('replicas', 1)
+    if plural == 'daemonsets':
+        return {'observedGeneration': generation, 'desiredNumberScheduled': 1,
+                'currentNumberScheduled': 1, 'updatedNumberScheduled': 1,
+                'numberAvailable': 1, 'numberReady': 1}
+    status = {'observedGeneration': generation, 'replicas': replicas,
+              'updatedReplicas': replicas, 'readyReplicas': replicas,
+              'availableReplicas': replicas, 'currentReplicas': replicas}
+    if plural == 'statefulsets':
+        status['currentRevision'] = status['updateRevision'] = '%s-%s' % (
+            obj['metadata']['name'], generation)
+    return status
+
+
+def _matches(obj, label_selector, field_selector):
+    labels = obj['metadata'].get('labels') or {}
+    for term in filter(None, (label_selector or '').split(',')):
+        key, _, value = term.partition('=')
+        if key not in labels or (value and labels[key] != value):
+            return False
+    for term in filter(None, (field_selector or '').split(',')):
+        key, _, value = term.partition('=')
+        if key == 'metadata.name' and obj['metadata']['name'] != value:
+            return False
+    return True
+
+
+def _merge(target, patch):
+    # JSON merge patch (RFC 7386) -- close enough to strategic merge here
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        elif isinstance(value, list):  # drop strategic merge directives
+            target[key] = copy.deepcopy([e for e in value if not (
+                isinstance(e, dict) and '$patch' in e)])
+        else:
+            target[key] = copy.deepcopy(value)
+    return target
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''
+    HTTP/1.1 (keep-alive) request handler
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # headers and body are separate writes -- don't let Nagle hold the body
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.state.cond:
+            self.server.state.connection_count += 1
+
+    def log_message(self, *_args):  # pylint: disable=arguments-differ
+        pass
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, code, reason, message):
+        self._send(code, {'kind': 'Status', 'status': 'Failure',
+                          'reason': reason, 'message': message, 'code': code})
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+
+    def _route(self):
+        state = self.server.state
+        with state.cond:
+            state.request_count += 1
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        match = PATH_RE.match(url.path)
+        if match and state.legacy and match.group('plural') not in [
+                plural for _kind, plural, _namespaced in dict(state.discovery).get(
+                    '/'.join(filter(None, match.group('group', 'version'))), [])]:
+            match = None  # a group version this (old) cluster doesn't serve
+        if query.get('watch') != 'true' and state.latency:
+            time.sleep(state.latency)
+        return url.path, query, match
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        '''
+        version, discovery, list, get and watch
+        '''
+        state = self.server.state
+        if self.path == '/fake/stats':  # not counted
+            return self._send(200, {'requests': state.request_count,
+                                    'connections': state.connection_count,
+                                    'objects': len(state.objects)})
+        path, query, match = self._route()
+        if path == '/version':
+            return self._send(200, {'major': '1', 'minor': '9', 'gitVersion': 'v1.9.6'})
+        if path == '/apis':
+            return self._send(200, {'kind': 'APIGroupList', 'groups': _groups(state)})
+        group_version = 'v1' if path == '/api/v1' else path[len('/apis/'):]
+        if path.startswith('/api') and group_version in dict(state.discovery):
+            return self._send(200, {'kind': 'APIResourceList', 'resources': [
+                {'kind': kind, 'name': plural, 'namespaced': namespaced}
+                for kind, plural, namespaced in dict(state.discovery)[group_version]]})
+        if not match:
+            return self._error(404, 'NotFound', 'the server could not find the requested resource')
+        plural, namespace, name = match.group('plural', 'namespace', 'name')
+        if query.get('watch') == 'true':
+            return self._watch(plural, namespace, query)
+        with state.cond:
+            if name:
+                obj = state.objects.get((plural, namespace, name))
+                if obj is None:
+                    return self._error(404, 'NotFound', '%s "%s" not found' % (plural, name))
+                return self._send(200, obj)
+            # like the real server, list items carry neither kind nor apiVersion
+            items = [dict((k, v) for k, v in obj.items() if k not in ('kind', 'apiVersion'))
+                     for (p, n, _), obj in sorted(state.objects.items())
+                     if p == plural and (namespace is None or n == namespace) and
+                     _matches(obj, query.get('labelSelector'), query.get('fieldSelector'))]
+            return self._send(200, {
+                'kind': 'List', 'apiVersion': '/'.join(filter(None, match.group(
+                    'group', 'version'))),
+                'items': items, 'metadata': {'resourceVersion': str(state.resource_version)}})
+
+    def _watch(self, plural, namespace, query):
+        state = self.server.state
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        since = int(query.get('resourceVersion') or state.resource_version)
+        deadline = time.time() + float(query.get('timeoutSeconds', 60))
+        with state.cond:
+            while time.time() < deadline:
+                for event in state.events:
+                    if event[0] <= since or event[1] != plural or (
+                            namespace and event[2] != namespace) or not _matches(
+                                event[4], query.get('labelSelector'),
+                                query.get('fieldSelector')):
+                        continue
+                    since = event[0]
+                    line = json.dumps({'type': event[3], 'object': event[4]}) + '\n'
+                    try:
+                        self.wfile.write(line.encode('utf-8'))
+                        self.wfile.flush()
+                    except IOError:
+                        return
+                state.cond.wait(min(1.0, max(0.0, deadline - time.time())))
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        '''
+        create (optionally dry-run)
+        '''
+        _path, query, match = self._route()
+        if not match:
+            return self._error(404, 'NotFound', 'the server could not find the requested resource')
+        state = self.server.state
+        body = self._body()
+        plural, namespace = match.group('plural', 'namespace')
+        key = (plural, namespace, body['metadata']['name'])
+        with state.cond:
+            if key in state.objects:
+                return self._error(409, 'AlreadyExists', '%s "%s" already exists'
+                                   % (plural, key[2]))
+            body['metadata'].update(generation=1, uid='uid-%s' % state.resource_version)
+            if namespace:
+                body['metadata']['namespace'] = namespace
+            if query.get('dryRun'):
+                return self._send(201, body)
+            state.objects[key] = body
+            state.changed[key] = time.time()
+            state.record(key, body, 'ADDED')
+            return self._send(201, body)
+
+    def do_PATCH(self):  # pylint: disable=invalid-name
+        '''
+        merge / strategic-merge patch (optionally dry-run)
+        '''
+        _path, query, match = self._route()
+        if not match:
+            return self._error(404, 'NotFound', 'the server could not find the requested resource')
+        state = self.server.state
+        body = self._body()
+        key = match.group('plural', 'namespace', 'name')
+        with state.cond:
+            current = state.objects.get(key)
+            if current is None:
+                return self._error(404, 'NotFound', '%s "%s" not found' % (key[0], key[2]))
+            updated = _merge(copy.deepcopy(current), body)
+            if updated == current:
+                return self._send(200, current)
+            if updated.get('spec') != current.get('spec'):
+                updated['metadata']['generation'] = current['metadata'].get('generation', 1) + 1
+            if query.get('dryRun'):
+                return self._send(200, updated)
+            state.objects[key] = updated
+            if updated.get('spec') != current.get('spec'):
+                state.changed[key] = time.time()
+            state.record(key, updated, 'MODIFIED')
+            return self._send(200, updated)
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        '''
+        delete / deletecollection
+        '''
+        _path, query, match = self._route()
+        if not match:
+            return self._error(404, 'NotFound', 'the server could not find the requested resource')
+        state = self.server.state
+        self._body()
+        plural, namespace, name = match.group('plural', 'namespace', 'name')
+        with state.cond:
+            if name:
+                obj = state.objects.pop((plural, namespace, name), None)
+                if obj is None:
+                    return self._error(404, 'NotFound', '%s "%s" not found' % (plural, name))
+                state.record((plural, namespace, name), obj, 'DELETED')
+                return self._send(200, {'kind': 'Status', 'status': 'Success'})
+            for key in [k for k, o in state.objects.items()
+                        if k[0] == plural and k[1] == namespace and
+                        _matches(o, query.get('labelSelector'), None)]:
+                state.record(key, state.objects.pop(key), 'DELETED')
+            return self._send(200, {'kind': 'Status', 'status': 'Success'})
+
+
+class FakeApiServer(ThreadingMixIn, HTTPServer):
+    '''
+    Threaded fake API server.  Use start() / stop(), or run standalone.
+    '''
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, ready_delay=0.0, legacy=False):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.state = ClusterState(latency, ready_delay, legacy)
+        self._stopped = threading.Event()
+
+    @property
+    def url(self):
+        '''
+        Base URL of the server
+        '''
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def write_kubeconfig(self, path):
+        '''
+        Write a kubeconfig pointing at this server
+        '''
+        with open(path, 'w') as k_file:
+            json.dump({
+                'apiVersion': 'v1', 'kind': 'Config', 'current-context': 'fake',
+                'clusters': [{'name': 'fake', 'cluster': {'server': self.url}}],
+                'users': [{'name': 'fake', 'user': {'token': 'fake'}}],
+                'contexts': [{'name': 'fake', 'context': {'cluster': 'fake',
+                                                           'user': 'fake'}}],
+            }, k_file)
+        return path
+
+    def _progress_loop(self):
+        while not self._stopped.wait(0.05):
+            self.state.progress()
+
+    def start(self):
+        '''
+        Serve (and advance rollouts) on background threads
+        '''
+        for target in (self.serve_forever, self._progress_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop serving
+        '''
+        self._stopped.set()
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    '''
+    Run a fake API server in the foreground
+    '''
+    parser = argparse.ArgumentParser(description='Fake kubernetes API server')
+    parser.add_argument('-p', '--port', type=int, default=8001,
+                        help='Port to listen on (0 picks a free one)')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='Seconds added to every (non-watch) request')
+    parser.add_argument('-r', '--ready-delay', type=float, default=0.0,
+                        help='Seconds before workloads report ready')
+    parser.add_argument('-k', '--kubeconfig',
+                        help='Write a kubeconfig for this server here')
+    parser.add_argument('--legacy', action='store_true',
+                        help='Only serve the API versions of a cluster from before apps/v1')
+    args = parser.parse_args()
+    server = FakeApiServer(args.port, args.latency, args.ready_delay, args.legacy)
+    if args.kubeconfig:
+        server.write_kubeconfig(args.kubeconfig)
+    print('Serving on %s' % server.url)
+    sys.stdout.flush()
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+'''
+fake_kubectl.py -- stand-in for the `kubectl` binary, backed by the fake API
+server named in $KUBECONFIG.
+
+Every invocation is a real process (so process spawn cost is part of what is
+measured), and is logged as one line to $FAKE_KUBECTL_LOG, if set.  Supports
+the subset of kubectl the deployer uses: version (--client, -o json), get (-o json / name,
+--watch, -l, --ignore-not-found), apply -f, and delete.
+'''
+
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kube_api import KubeApiClient  # pylint: disable=wrong-import-position
+from utils import ApiTransport  # pylint: disable=wrong-import-position
+
+CLIENT_VERSION = 'v1.9.6'
+
+
+class Unsupported(object):
+    '''
+    Fallback transport -- fails the way kubectl fails on a bad command
+    '''
+    def run(self, namespace, command_args, input_data=None):
+        '''
+        Always fails
+        '''
+        del namespace, input_data
+        raise subprocess.CalledProcessError(
+            1, command_args, 'error: fake kubectl does not support: %s'
+            % ' '.join(command_args))
+
+
+def _option(args, *names):
+    # pop "-o x", "-o=x" and "--output=x" style options out of args
+    for index, arg in enumerate(args):
+        for name in names:
+            if arg == name and index + 1 < len(args):
+                value = args[index + 1]
+                del args[index:index + 2]
+                return value
+            if arg.startswith(name + '='):
+                del args[index]
+                return arg.split('=', 1)[1]
+    return None
+
+
+def _flag(args, name):
+    if name in args:
+        args.remove(name)
+        return True
+    return False
+
+
+def _get(transport, namespace, args):
+    output = _option(args, '-o', '--output')
+    selector = _option(args, '-l', '--selector')
+    ignore_not_found = _flag(args, '--ignore-not-found')
+    watch = _flag(args, '--watch') or _flag(args, '-w')
+    types = args[0].split(',')
+    name = args[1] if len(args) > 1 else None
+    if watch:
+        first = transport.list_objects(namespace, types[0], name=name)
+        for obj in first['items']:
+            print(json.dumps(obj, indent=4))
+        sys.stdout.flush()
+        for event in transport.watch(namespace, types[0], first['metadata'].get(
+                'resourceVersion'), name=name, timeout=3600):
+            print(json.dumps(event['object'], indent=4))
+            sys.stdout.flush()
+        return
+    if output == 'name':
+        print(transport.run(namespace, ['get', args[0], '-o', 'name']))
+        return
+    if name:
+        items = transport.list_objects(namespace, types[0], name=name)['items']
+        if items:
+            print(json.dumps(items[0], indent=4))
+        elif not ignore_not_found:
+            kind = transport.client.resource_info(types[0])[2]
+            raise subprocess.CalledProcessError(
+                1, args, 'Error from server (NotFound): %s "%s" not found' % (kind, name))
+        return
+    items = []
+    for resource_type in types:
+        items.extend(transport.list_objects(namespace, resource_type,
+                                            label_selector=selector)['items'])
+    print(json.dumps({'apiVersion': 'v1', 'kind': 'List', 'items': items,
+                      'metadata': {}}, indent=4))
+
+
+def main():
+    '''
+    Run one kubectl command against the fake API server
+    '''
+    if os.environ.get('FAKE_KUBECTL_LOG'):
+        with open(os.environ['FAKE_KUBECTL_LOG'], 'a') as log:
+            log.write(' '.join(sys.argv[1:]) + '\n')
+    args = sys.argv[1:]
+    namespace = _option(args, '--namespace', '-n') or 'default'
+    kubeconfig = os.environ.get('KUBECONFIG', os.path.expanduser('~/.kube/config'))
+    client = KubeApiClient.from_kubeconfig(kubeconfig.split(os.pathsep)[0])
+    transport = ApiTransport(client, fallback=Unsupported())
+    try:
+        if args[0] == 'version':
+            versions = {'clientVersion': {'gitVersion': CLIENT_VERSION}}
+            if not _flag(args, '--client'):
+                versions['serverVersion'] = client.request('GET', '/version')
+            if _option(args, '-o', '--output') == 'json':
+                print(json.dumps(versions))
+            else:
+                print('\n'.join('%s Version: %s' % (side, versions[side.lower() + 'Version'][
+                    'gitVersion']) for side in ('Client', 'Server')
+                                 if side.lower() + 'Version' in versions))
+        elif args[0] == 'get':
+            _get(transport, namespace, args[1:])
+        else:
+            input_data = sys.stdin.read() if args[-2:] == ['-f', '-'] else None
+            print(transport.run(namespace, args, input_data))
+    except subprocess.CalledProcessError as cpe:
+        sys.stderr.write('%s\n' % cpe.output)
+        sys.exit(1)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
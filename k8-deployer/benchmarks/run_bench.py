@@ -0,0 +1,328 @@
+#! /usr/bin/env python
+'''
+run_bench.py -- offline benchmark of gen_k8, deploy, prune_namespace and
+wipedata against a fake API server (and a fake kubectl on $PATH).
+
+For every tree size, and every transport, each stage reports wall time,
+kubectl subprocesses spawned, API requests served and peak resident memory
+(of this process -- the fake API server runs in its own process).  Results
+are written as JSON; pass a previous results file with --compare to flag
+regressions.
+'''
+
+import argparse
+import contextlib
+import datetime
+import functools
+import io
+import json
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+# pylint: disable=wrong-import-position
+import cluster_cache
+import deploy
+import gen_k8
+import prune_namespace
+import utils
+import wipedata
+from kube_api import KubeApiClient
+import synth
+
+NAMESPACE = 'bench'
+STAGES = ['gen', 'gen-incremental', 'deploy', 'redeploy', 'prune', 'wipedata']
+
+
+def main():
+    '''
+    Run the benchmarks
+    '''
+    parser = argparse.ArgumentParser(
+        description='Offline benchmark of gen / deploy / prune / wipedata')
+    parser.add_argument('-s', '--sizes', default='10,100,1000',
+                        help='Comma separated tree sizes (manifests). '
+                        'Default is 10,100,1000')
+    parser.add_argument('-t', '--transports', default='kubectl,api',
+                        help='Comma separated transports. Default is kubectl,api')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='Comma separated stages. Default is all: %s'
+                        % ','.join(STAGES))
+    parser.add_argument('-l', '--latency', type=float, default=0.005,
+                        help='Seconds added to every API request. Default is 0.005')
+    parser.add_argument('-r', '--ready-delay', type=float, default=0.2,
+                        help='Seconds before workloads report ready. Default is 0.2')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Concurrency passed to deploy / wipedata. Default is 4')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='gen_jinja worker processes. Default is 1')
+    parser.add_argument('-o', '--output', default='bench_results.json',
+                        help='Results file. Default is bench_results.json')
+    parser.add_argument('--compare',
+                        help='Previous results file to compare wall times against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown (fraction) reported as a regression. '
+                        'Default is 0.2')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show the output of each stage')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='k8-bench-')
+    try:
+        results = run(work_dir, [int(x) for x in args.sizes.split(',')],
+                      args.transports.split(','), args.stages.split(','), args)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'date': datetime.datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'commit': _git_commit(),
+            'options': {k: v for k, v in vars(args).items()
+                        if k not in ('output', 'compare', 'verbose')},
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as r_file:
+        json.dump(report, r_file, indent=1, sort_keys=True)
+    print_table(results)
+    print('Results written to: %s' % args.output)
+    if args.compare and compare(args.compare, results, args.threshold):
+        sys.exit(1)
+    if any('error' in result for result in results):
+        sys.exit(1)
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def _install_fake_kubectl(work_dir):
+    # put a `kubectl` on $PATH that runs fake_kubectl.py
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    kubectl = os.path.join(bin_dir, 'kubectl')
+    with open(kubectl, 'w') as k_file:
+        k_file.write('#!/bin/sh\nexec "%s" "%s" "$@"\n'
+                     % (sys.executable, os.path.join(BENCH_DIR, 'fake_kubectl.py')))
+    os.chmod(kubectl, os.stat(kubectl).st_mode | stat.S_IEXEC)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_KUBECTL_LOG'] = os.path.join(work_dir, 'kubectl.log')
+
+
+def _kubectl_calls():
+    try:
+        with open(os.environ['FAKE_KUBECTL_LOG'], 'r') as log:
+            return sum(1 for _ in log)
+    except IOError:
+        return 0
+
+
+class FakeCluster(object):
+    '''
+    fake_apiserver.py, run as a separate process
+    '''
+    def __init__(self, work_dir, latency, ready_delay):
+        self.kubeconfig = os.path.join(work_dir, 'kubeconfig')
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, 'fake_apiserver.py'),
+             '--port', '0', '--latency', str(latency),
+             '--ready-delay', str(ready_delay), '--kubeconfig', self.kubeconfig],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        self.process.stdout.readline()  # "Serving on ..."
+        self.client = KubeApiClient.from_kubeconfig(self.kubeconfig)
+
+    def request_count(self):
+        '''
+        API requests served so far
+        '''
+        return self.client.request('GET', '/fake/stats')['requests']
+
+    def leak_objects(self, namespace, count):
+        '''
+        Create labelled objects no template defines (for prune to find)
+        '''
+        for index in range(count):
+            self.client.apply(namespace, {
+                'apiVersion': 'v1', 'kind': 'ConfigMap',
+                'metadata': {'name': 'leaked-%05d' % index,
+                             'labels': dict([utils.OWNER_LABEL])}})
+        cluster_cache.invalidate(namespace, 'ConfigMap')
+
+    def stop(self):
+        '''
+        Shut the server down
+        '''
+        cluster_cache.close_all()  # stop watching it first
+        self.client.close()
+        self.process.terminate()
+        self.process.wait()
+
+
+def _reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets VmHWM (the peak RSS)
+    try:
+        with open('/proc/self/clear_refs', 'w') as c_file:
+            c_file.write('5')
+    except IOError:
+        pass
+
+
+def _peak_rss_kb():
+    try:
+        with open('/proc/self/status', 'r') as s_file:
+            for line in s_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    import resource  # pylint: disable=import-outside-toplevel
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # since start
+
+
+def measure(name, fun, cluster=None, verbose=False):
+    '''
+    Runs fun(), returns a result record for it
+    '''
+    calls = _kubectl_calls()
+    requests = cluster.request_count() if cluster else 0
+    _reset_peak_rss()
+    output = io.StringIO()
+    start = time.time()
+    error = None
+    try:
+        with contextlib.redirect_stdout(sys.stdout if verbose else output):
+            fun()
+    except Exception as err:  # pylint: disable=broad-except
+        error = '%s: %s' % (type(err).__name__, err)
+        if not verbose:
+            sys.stdout.write(output.getvalue()[-4000:])
+    wall = time.time() - start
+    result = {
+        'stage': name,
+        'wall_s': round(wall, 4),
+        'subprocesses': _kubectl_calls() - calls,
+        'api_requests': (cluster.request_count() - requests) if cluster else 0,
+        'peak_rss_kb': _peak_rss_kb(),
+    }
+    if error:
+        result['error'] = error
+    print('  %-16s %8.3fs%s' % (name, wall, '  ** %s' % error if error else ''))
+    return result
+
+
+def run(work_dir, sizes, transports, stages, args):
+    '''
+    Runs every stage for every size / transport, returns the result records
+    '''
+    _install_fake_kubectl(work_dir)
+    results = []
+    for size in sizes:
+        print('Size: %s manifests' % size)
+        size_dir = os.path.join(work_dir, str(size))
+        tree_dir = synth.generate(size_dir, size)
+        out_dir = os.path.join(size_dir, 'k8-generated')
+        os.makedirs(out_dir)
+        context = synth.context(tree_dir, NAMESPACE)
+        # always render -- the cluster stages deploy the output
+        records = [measure('gen', functools.partial(
+            gen_k8.gen_jinja, context, tree_dir, out_dir, processes=args.processes),
+                           verbose=args.verbose)]
+        if 'gen-incremental' in stages:
+            records.append(measure('gen-incremental', functools.partial(
+                gen_k8.gen_jinja, context, tree_dir, out_dir, incremental=True,
+                processes=args.processes), verbose=args.verbose))
+        results.extend(dict(record, size=size, transport=None)
+                       for record in records if record['stage'] in stages)
+
+        for transport in transports:
+            print(' Transport: %s' % transport)
+            cluster = FakeCluster(size_dir, args.latency, args.ready_delay)
+            os.environ['KUBECONFIG'] = cluster.kubeconfig
+            utils.set_transport(transport)
+            try:
+                results.extend(dict(record, size=size, transport=transport)
+                               for record in run_cluster_stages(
+                                   cluster, out_dir, size, stages, args))
+            finally:
+                cluster.stop()
+    return results
+
+
+def run_cluster_stages(cluster, out_dir, size, stages, args):
+    '''
+    The stages that talk to the (fake) cluster
+    '''
+    records = []
+
+    def _measure(name, fun):
+        if name in stages:
+            records.append(measure(name, fun, cluster, args.verbose))
+
+    _measure('deploy', lambda: deploy.deploy(
+        cluster.kubeconfig, NAMESPACE, out_dir, False, jobs=args.jobs))
+    _measure('redeploy', lambda: deploy.deploy(
+        cluster.kubeconfig, NAMESPACE, out_dir, False, jobs=args.jobs,
+        incremental=True))
+    cluster.leak_objects(NAMESPACE, max(1, size // 10))
+    _measure('prune', lambda: prune_namespace.prune_namespace(NAMESPACE, out_dir))
+    _measure('wipedata', lambda: wipedata._wipe_all_pvs(  # pylint: disable=protected-access
+        NAMESPACE, jobs=args.jobs))
+    return records
+
+
+def print_table(results):
+    '''
+    Print the results as a table
+    '''
+    print('%6s %-9s %-16s %10s %8s %8s %10s' % (
+        'size', 'transport', 'stage', 'wall(s)', 'procs', 'api', 'rss(kb)'))
+    for result in results:
+        print('%6s %-9s %-16s %10.3f %8s %8s %10s%s' % (
+            result['size'], result['transport'] or '-', result['stage'],
+            result['wall_s'], result['subprocesses'], result['api_requests'],
+            result['peak_rss_kb'],
+            '  FAILED' if 'error' in result else ''))
+
+
+def compare(previous_file, results, threshold):
+    '''
+    Compare wall times against a previous results file.  Returns True if
+    any stage regressed by more than threshold.
+    '''
+    with open(previous_file, 'r') as p_file:
+        previous = {(r['size'], r['transport'], r['stage']): r
+                    for r in json.load(p_file)['results']}
+    regressed = False
+    print('Compared to: %s' % previous_file)
+    for result in results:
+        old = previous.get((result['size'], result['transport'], result['stage']))
+        if not old or not old['wall_s']:
+            continue
+        change = (result['wall_s'] - old['wall_s']) / old['wall_s']
+        slow = change > threshold
+        regressed = regressed or slow
+        print('%s%6s %-9s %-16s %10.3f -> %10.3f (%+.0f%%)%s' % (
+            '\033[31m' if slow else '', result['size'], result['transport'] or '-',
+            result['stage'], old['wall_s'], result['wall_s'], change * 100,
+            '  REGRESSION\033[39m' if slow else ''))
+    return regressed
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#! /usr/bin/env python
+'''
+synth.py -- generates a synthetic jinja template tree shaped like a real
+deployment: namespace.yaml, secrets/, storage/, configmaps/, services/,
+deployments/ (with a .depend.start) and jobs/ (only .depend.start entries
+are applied).  Templates use context values, loops and from_file, so
+rendering them does representative work.
+'''
+
+import argparse
+import os
+import shutil
+
+# Share of the manifests (after namespace.yaml) in each directory
+LAYOUT = [
+    ('secrets', 0.10),
+    ('storage', 0.05),
+    ('configmaps', 0.30),
+    ('services', 0.15),
+    ('deployments', 0.30),
+    ('jobs', 0.10),
+]
+
+NAMESPACE = '''apiVersion: v1
+kind: Namespace
+metadata:
+  name: {{ K8_NAMESPACE }}
+'''
+
+SECRET = '''apiVersion: v1
+kind: Secret
+metadata:
+  name: @NAME@
+type: Opaque
+data:
+  tls.crt: {{ from_file_base64(SYNTH_FILES + '/cert.pem') }}
+  token: {{ base64_encode(sha256(K8_NAMESPACE + '@NAME@')) }}
+'''
+
+PVC = '''apiVersion: v1
+kind: PersistentVolumeClaim
+metadata:
+  name: @NAME@
+spec:
+  accessModes: [ReadWriteOnce]
+  resources:
+    requests:
+      storage: {{ SYNTH_STORAGE_SIZE }}
+'''
+
+CONFIGMAP = '''apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: @NAME@
+data:
+  ca.pem: "{{ from_file(SYNTH_FILES + '/cert.pem') }}"
+{% for key, value in SYNTH_SETTINGS.items() %}
+  {{ key }}: "{{ value }}-@NAME@"
+{% endfor %}
+'''
+
+SERVICE = '''apiVersion: v1
+kind: Service
+metadata:
+  name: @NAME@
+spec:
+  selector:
+    app: @NAME@
+  ports:
+  - port: 443
+    targetPort: 8443
+'''
+
+DEPLOYMENT = '''apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: @NAME@
+spec:
+  replicas: {{ SYNTH_REPLICAS }}
+  selector:
+    matchLabels:
+      app: @NAME@
+  template:
+    metadata:
+      labels:
+        app: @NAME@
+    spec:
+      containers:
+      - name: main
+        image: "{{ SYNTH_REGISTRY }}/@NAME@:{{ SYNTH_VERSION }}"
+        env:
+        - name: UI_URL
+          value: "{{ UI_URL }}"
+{% for key in SYNTH_SETTINGS %}
+        - name: {{ key | upper }}
+          value: "{{ SYNTH_SETTINGS[key] }}"
+{% endfor %}
+'''
+
+JOB = '''apiVersion: batch/v1
+kind: Job
+metadata:
+  name: @NAME@
+spec:
+  template:
+    spec:
+      restartPolicy: Never
+      containers:
+      - name: main
+        image: "{{ SYNTH_REGISTRY }}/@NAME@:{{ SYNTH_VERSION }}"
+        command: ["true"]
+'''
+
+TEMPLATES = {'secrets': SECRET, 'storage': PVC, 'configmaps': CONFIGMAP,
+             'services': SERVICE, 'deployments': DEPLOYMENT, 'jobs': JOB}
+
+
+def counts(size):
+    '''
+    Returns [(directory, number of manifests)] for a tree of "size" manifests
+    '''
+    remaining = max(0, size - 1)  # namespace.yaml
+    result = []
+    for directory, share in LAYOUT:
+        count = min(remaining, max(1, int(round((size - 1) * share))))
+        result.append((directory, count))
+        remaining -= count
+    if remaining:  # rounding leftovers
+        result[LAYOUT.index(('configmaps', 0.30))] = (
+            'configmaps', dict(result)['configmaps'] + remaining)
+    return result
+
+
+def context(tree_dir, namespace='bench'):
+    '''
+    The jinja context the generated templates expect
+    '''
+    return {
+        'K8_NAMESPACE': namespace,
+        'UI_URL': 'https://%s.example.com' % namespace,
+        'SYNTH_FILES': os.path.join(os.path.abspath(tree_dir), '..', 'files'),
+        'SYNTH_STORAGE_SIZE': '1Gi',
+        'SYNTH_REPLICAS': 1,
+        'SYNTH_REGISTRY': 'registry.example.com',
+        'SYNTH_VERSION': '1.0.0',
+        'SYNTH_SETTINGS': {'setting_%02d' % i: 'value-%s' % i for i in range(10)},
+    }
+
+
+def generate(base_dir, size):
+    '''
+    Writes a tree of "size" templates to base_dir/templates (plus the files
+    they read to base_dir/files).  Returns the templates directory.
+    '''
+    tree_dir = os.path.join(base_dir, 'templates')
+    files_dir = os.path.join(base_dir, 'files')
+    for path in (tree_dir, files_dir):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+    with open(os.path.join(files_dir, 'cert.pem'), 'w') as c_file:
+        c_file.write('-----BEGIN CERTIFICATE-----\n%s\n-----END CERTIFICATE-----\n'
+                     % '\n'.join(['MIIB' + 'x' * 60] * 20))
+    with open(os.path.join(tree_dir, 'namespace.yaml'), 'w') as n_file:
+        n_file.write(NAMESPACE)
+
+    for directory, count in counts(size):
+        if not count:
+            continue
+        os.makedirs(os.path.join(tree_dir, directory))
+        names = ['%s-%05d' % (directory[:-1], i) for i in range(count)]
+        for name in names:
+            with open(os.path.join(tree_dir, directory, name + '.yml'), 'w') as t_file:
+                t_file.write(TEMPLATES[directory].replace('@NAME@', name))
+        if directory == 'deployments':
+            # a short chain, then a parallel group; the rest are unordered
+            entries = ['%s.yml' % n for n in names[:2]]
+            if len(names) > 2:
+                entries.append('[%s]' % ', '.join('%s.yml' % n for n in names[2:6]))
+        elif directory == 'jobs':
+            entries = ['[%s]' % ', '.join('%s.yml' % n for n in names)]
+        else:
+            continue
+        with open(os.path.join(tree_dir, directory, '.depend.start'), 'w') as d_file:
+            d_file.write(''.join('- %s\n' % e for e in entries))
+    return tree_dir
+
+
+def main():
+    '''
+    Generate a synthetic template tree
+    '''
+    parser = argparse.ArgumentParser(description='Generate a synthetic template tree')
+    parser.add_argument('-o', '--output-dir', required=True)
+    parser.add_argument('-s', '--size', type=int, default=100,
+                        help='Number of manifests (default 100)')
+    args = parser.parse_args()
+    print('Generated %s' % generate(args.output_dir, args.size))
+    print(counts(args.size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+'''
+Informer style cache of the objects in a namespace.
+
+Each kind is listed once, the first time it is asked for, then kept current
+by a background watch.  Reads (by kind, or kind and name) come from memory.
+Objects we have just written are marked stale with invalidate(), and are
+fetched again (by name) the next time they are read.  Waiting for a
+condition blocks until the watch reports a change.
+'''
+
+import atexit
+import sys
+import threading
+import time
+
+from utils import OWNER_LABEL, get_transport, list_objects, watch_objects
+
+# Longest single watch before it is re-established (kubectl can't resume a
+# watch, so for that transport each kind is re-listed this often)
+WATCH_SESSION = 60
+
+# Longest a waited on object is left to the watch while missing, before its
+# kind is listed again (in case the watch missed it)
+MISSING_RECHECK = 10
+
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+def for_namespace(namespace):
+    '''
+    Returns the (shared) cache of a namespace, for the active transport
+    '''
+    transport = get_transport()
+    with _CACHES_LOCK:
+        cache = _CACHES.get(namespace)
+        if cache is None or cache.transport is not transport:
+            if cache is not None:
+                cache.close()  # the transport (ie: cluster) changed
+            cache = _CACHES[namespace] = ClusterCache(namespace, transport)
+        return cache
+
+
+@atexit.register
+def close_all():
+    '''
+    Close every cache (ie: before the cluster they watch goes away)
+    '''
+    with _CACHES_LOCK:
+        caches = list(_CACHES.values())
+        _CACHES.clear()
+    for cache in caches:
+        cache.close()
+
+
+def invalidate(namespace, kind, names=None):
+    '''
+    Mark objects (or a whole kind) we've just changed as stale
+    '''
+    with _CACHES_LOCK:
+        cache = _CACHES.get(namespace)
+    if cache is not None:
+        cache.invalidate(kind, names)
+
+
+def is_owned(obj):
+    '''
+    True if the object carries our ownership label
+    '''
+    labels = obj['metadata'].get('labels') or {}
+    return labels.get(OWNER_LABEL[0]) == OWNER_LABEL[1]
+
+
+def _resource_version(obj):
+    try:
+        return int(obj['metadata'].get('resourceVersion'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_older(obj, cached):
+    # an (in flight) watch event older than what a fetch already returned
+    if cached is None:
+        return False
+    new, old = _resource_version(obj), _resource_version(cached)
+    return new is not None and old is not None and new < old
+
+
+class ClusterCache(object):
+    '''
+    The objects of one namespace: {kind: {name: object}}
+    '''
+    def __init__(self, namespace, transport=None):
+        self.namespace = namespace
+        self.transport = transport or get_transport()
+        self._objects = {}
+        self._versions = {}  # kind -> resourceVersion to resume watching from
+        self._changes = {}  # kind -> count of changes seen
+        self._stale = {}  # kind -> names to fetch again
+        self._expired = set()  # kinds to list again
+        self._missing_since = {}  # kind -> since when a waited on name is missing
+        self._watchers = {}
+        self._changed = threading.Condition()
+        self._closed = False
+
+    def close(self):
+        '''
+        Stop watching (this cache's watches only: other caches share the
+        transport)
+        '''
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+        self.transport.stop_watches(self)
+
+    def invalidate(self, kind, names=None):
+        '''
+        Mark the named objects (or, without names, the whole kind) stale
+        '''
+        with self._changed:
+            if kind not in self._objects:
+                return
+            if names is None:
+                self._expired.add(kind)
+            else:
+                self._stale[kind].update(names)
+
+    def objects(self, kind):
+        '''
+        Returns {name: object} of every object of a kind
+        '''
+        self._refresh(kind)
+        with self._changed:
+            return dict(self._objects[kind])
+
+    def get(self, kind, name):
+        '''
+        Returns an object (or None if it doesn't exist)
+        '''
+        self._refresh(kind, [name])
+        with self._changed:
+            return self._objects[kind].get(name)
+
+    def snapshot(self, kind, names=None):
+        '''
+        Returns ({name: object} of the named objects -- or every object of
+        the kind -- that exist, and a change count to pass to wait_change()).
+        Stale objects the cache hasn't seen yet are left to the watch: to a
+        waiter, missing and not ready are the same.  Named objects still
+        missing after MISSING_RECHECK seconds are looked for by listing the
+        kind again.
+        '''
+        self._refresh(kind, names, fetch_missing=False)
+        with self._changed:
+            missing = names is not None and not set(names) <= set(self._objects[kind])
+            since = (self._missing_since.setdefault(kind, time.time()) if missing
+                     else self._missing_since.pop(kind, None))
+        if missing and time.time() - since >= MISSING_RECHECK:
+            self._list(kind)
+            with self._changed:
+                self._missing_since[kind] = time.time()
+        with self._changed:
+            state = {n: o for n, o in self._objects[kind].items()
+                     if names is None or n in names}
+            return state, self._changes[kind]
+
+    def wait_change(self, kind, seen, timeout):
+        '''
+        Blocks until a kind changed since snapshot() returned "seen" (or
+        "timeout" seconds passed).  Returns True if it changed.
+        '''
+        return self.wait_any_change({kind: seen}, timeout)
+
+    def wait_any_change(self, seen, timeout):
+        '''
+        Like wait_change, for several kinds at once: seen is {kind: change
+        count from snapshot()}.  Returns True if any of them changed.
+        '''
+        deadline = time.time() + timeout
+
+        def _changed():
+            return any(self._changes[kind] != count for kind, count in seen.items())
+        with self._changed:
+            while not _changed() and not self._closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+            return _changed()
+
+    def _refresh(self, kind, names=None, fetch_missing=True):
+        # list (or fetch by name) whatever isn't known to be current
+        with self._changed:
+            relist = kind not in self._objects or kind in self._expired or (
+                names is None and self._stale[kind])
+            fetch = [] if relist else sorted(
+                n for n in self._stale[kind] & set(names or [])
+                if fetch_missing or n in self._objects[kind])
+        if relist:
+            self._list(kind)
+        for name in fetch:
+            self._fetch(kind, name)
+
+    def _list(self, kind):
+        listing = list_objects(self.namespace, kind)
+        with self._changed:
+            self._objects[kind] = {o['metadata']['name']: o
+                                   for o in listing.get('items', [])}
+            self._versions[kind] = listing.get('metadata', {}).get('resourceVersion')
+            self._stale[kind] = set()
+            self._expired.discard(kind)
+            self._changes[kind] = self._changes.get(kind, 0) + 1
+            self._changed.notify_all()
+            if kind not in self._watchers:
+                watcher = threading.Thread(target=self._watch, args=(kind,),
+                                           name='watch %s' % kind)
+                watcher.daemon = True
+                self._watchers[kind] = watcher
+                watcher.start()
+
+    def _fetch(self, kind, name):
+        items = list_objects(self.namespace, kind, name=name)['items']
+        with self._changed:
+            if items:
+                self._objects[kind][name] = items[0]
+            else:
+                self._objects[kind].pop(name, None)
+            self._stale[kind].discard(name)
+            self._changes[kind] += 1
+            self._changed.notify_all()
+
+    def _watch(self, kind):
+        # keeps self._objects[kind] current, for as long as the cache is open
+        while not self._closed:
+            resume = self._versions.get(kind)
+            try:
+                for event in watch_objects(self.namespace, kind, resume,
+                                           timeout=WATCH_SESSION, owner=self):
+                    if self._closed:
+                        return
+                    if event['type'] == 'ERROR':  # ie: resourceVersion expired
+                        resume = None
+                        break
+                    self._update(kind, event)
+            except Exception as err:  # pylint: disable=broad-except
+                if self._closed:
+                    return
+                sys.stderr.write('Warning: watch of %s in %s failed: %s\n'
+                                 % (kind, self.namespace, err))
+                resume = None
+                time.sleep(1)
+            if self._closed:
+                return
+            if resume is None or self.transport.name == 'kubectl':
+                try:
+                    self._list(kind)  # missed events (or deletions) -- list again
+                except Exception as err:  # pylint: disable=broad-except
+                    sys.stderr.write('Warning: listing %s in %s failed: %s\n'
+                                     % (kind, self.namespace, err))
+
+    def _update(self, kind, event):
+        obj = event['object']
+        metadata = obj.get('metadata') or {}
+        with self._changed:
+            if metadata.get('resourceVersion'):
+                self._versions[kind] = metadata['resourceVersion']
+            if event['type'] == 'BOOKMARK':
+                return
+            store = self._objects[kind]
+            if event['type'] == 'DELETED':
+                store.pop(metadata.get('name'), None)
+            elif metadata.get('name') not in store:
+                # new to us, so it can't predate a write of ours
+                store[metadata['name']] = obj
+                self._stale[kind].discard(metadata['name'])
+            elif not _is_older(obj, store[metadata['name']]):
+                store[metadata['name']] = obj
+            self._changes[kind] += 1
+            self._changed.notify_all()
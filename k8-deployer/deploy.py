@@ -12,34 +12,84 @@ deploy.py -- CLI to apply kubernetes templates to a remote k8 cluster
 '''
 
 import argparse
-import glob
+import concurrent.futures
+import copy
+import functools
 import os
 import re
+import shlex
 import subprocess
-import sys
-import time
 import yaml
 
-from utils import all_resource_names, run_kubecmd, run_minikubecmd, run_localcmd
-from prune_namespace import prune_namespace
+from utils import (HASH_ANNOTATION, OWNER_SELECTOR, ApiTransport, get_transport,
+                   run_kubecmd, run_minikubecmd, run_localcmd, set_transport,
+                   stamp_content_hash, stamp_ownership)
+import cluster_cache
+import kubectl_runtime
+from scheduler import Scheduler
+from readiness import (ROLLOUTS, job_done, wait_for, wait_pvcs_bound,
+                       wait_rollout)
+from prune_namespace import extraneous, prune_namespace
+from manifest_index import (ManifestIndex, TemplateFiles, read_depend_start,
+                            scan_file)
+import tracing
+
+STORAGE_ONLINE = 'storage-online'
+
+# Longest wait for running Jobs to finish before a deploy is aborted
+RUNNING_JOBS_TIMEOUT = 70
+
+# Server-side dry-run requests in flight at once (--diff)
+DIFF_CONCURRENCY = 16
+
+# Fields the server manages -- ignored when comparing planned and live objects
+SERVER_METADATA = ['creationTimestamp', 'generation', 'managedFields',
+                   'resourceVersion', 'selfLink', 'uid']
+IGNORED_ANNOTATIONS = [HASH_ANNOTATION,
+                       'kubectl.kubernetes.io/last-applied-configuration']
+
+# Deploy phases, in order: (file_or_dir, phases it must wait for,
+#                           ignore_not_exist, only_depend)
+PHASES = [
+    ('namespace.yaml', [], False, False),
+    ('secrets/', ['namespace.yaml'], True, False),
+    ('storage/', ['namespace.yaml'], True, False),
+    ('configmaps/', ['namespace.yaml'], True, False),
+    ('services/', ['namespace.yaml'], True, False),
+    ('deployments/', ['secrets/', STORAGE_ONLINE, 'configmaps/', 'services/'],
+     True, False),
+    ('statefulsets/', ['deployments/'], True, False),
+    ('daemonsets/', ['statefulsets/'], True, False),
+    ('jobs/', ['daemonsets/'], True, True),
+    ('cronjobs/', ['jobs/'], True, True),
+    # Now run everything at the base template_dir
+    ('.', ['cronjobs/'], False, False),
+]
 
 
-def main():
+def add_cluster_arguments(parser):
     '''
-    Deploy a kubernetes application from pre-generated kubernetes templates
+    Adds the kubeconfig and namespace arguments (shared with deployerd.py)
     '''
-    parser = argparse.ArgumentParser(
-        description='Deploys a K8 application')
     parser.add_argument(
         '-k', '--kubeconfig', required=True,
         help='Kubernetes config file.  If running locally: "~/.kube/config"')
     parser.add_argument(
         '-n', '--namespace', required=True,
         help='Kubernetes namespace')
+
+
+def main():
+    '''
+    Deploy a kubernetes application from pre-generated kubernetes templates
+    '''
+    parser = argparse.ArgumentParser(
+        description='Deploys a K8 application')
+    add_cluster_arguments(parser)
     parser.add_argument(
         '-t', '--template-dir', default='./k8-generated/',
-        help='Directory containing the kubernetes files.'
-             '  Default is "./k8-generated/"')
+        help='Directory (or bundle, see gen_k8.py --bundle) containing the'
+             ' kubernetes files.  Default is "./k8-generated/"')
     parser.add_argument(
         '-m', '--minikube', action='store_true',
         help='Set if deploying to minikube.')
@@ -49,43 +99,98 @@ def main():
     parser.add_argument(
         '-v', '--version-checks', action='store_true',
         help='Set to enable version checks.')
+    parser.add_argument(
+        '--prune-owned-only', action='store_true',
+        help='Only prune objects carrying the k8-deployer ownership label.')
+    parser.add_argument(
+        '--owned-jobs-only', action='store_true',
+        help='Only delete (and wait on) Jobs carrying the k8-deployer ownership'
+             ' label before applying.')
+    parser.add_argument(
+        '-i', '--incremental', action='store_true',
+        help='Skip applying (and waiting on) objects whose content hash'
+             ' matches the live object.')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of independent apply/wait steps to run concurrently.'
+             '  Default is 1')
+    parser.add_argument(
+        '--transport', choices=['kubectl', 'api'], default=None,
+        help='How to talk to the cluster: spawn "kubectl" per call, or keep'
+             ' pooled "api" connections open (falls back to kubectl).'
+             '  Default is $K8_DEPLOYER_TRANSPORT or "kubectl"')
+    parser.add_argument(
+        '--diff', action='store_true',
+        help='Change nothing: server-side dry-run every object and print what'
+             ' would be created, changed and pruned.  Uses the "api" transport.')
+    parser.add_argument(
+        '--trace', metavar='FILE',
+        help='Record timings of every phase, call and wait; write them as a'
+             ' Chrome trace (chrome://tracing) to FILE and print a summary.')
 
     args = parser.parse_args()
-    if args.minikube:
-        local_extras(args.template_dir, True)
-    elif args.dockeredge:
-        local_extras(args.template_dir, False)
-    # Run the deploy
-    deploy(args.kubeconfig, args.namespace,
-           args.template_dir, args.version_checks)
-
-
-def local_extras(template_dir, minikube=False):
-    '''
-    Special handling for Local environments
-    '''
-    # Need to precreate the hostpath directories if running local
-    for template in glob.glob(os.path.join(template_dir, 'storage', '*')):
-        with open(template, "r") as tfile:
-            docs = yaml.load_all(tfile, Loader=yaml.SafeLoader)
-            for doc in docs:
-                if doc['kind'] == 'PersistentVolume':
-                    if 'hostPath' not in doc['spec']:
-                        raise AssertionError("local_extras: template (%s) "
-                                             "not using hostpath." % template)
-                    if minikube:
-                        cmd = 'sudo mkdir -p %s' % doc['spec']['hostPath']['path']
-                        run_minikubecmd(cmd)
-                    elif not os.path.exists(doc['spec']['hostPath']['path']):
-                        cmd = ['sudo', 'mkdir', '-p',
-                               doc['spec']['hostPath']['path']]
-                        run_localcmd(cmd)
-                        cmd = ['sudo', 'chmod', '777',
-                               doc['spec']['hostPath']['path']]
-                        run_localcmd(cmd)
-
-
-def validate(kubeconfig, namespace, template_dir, version_checks):
+    tracing.enable(bool(args.trace))
+    try:
+        with tracing.span('manifest index'):
+            index = ManifestIndex.load(args.template_dir)
+        if args.diff:
+            result = diff_deploy(args.kubeconfig, args.namespace, args.template_dir,
+                                 args.version_checks, transport=args.transport or 'api',
+                                 prune_owned_only=args.prune_owned_only, index=index)
+            print_diff(result)
+            if result['errors']:
+                raise AssertionError("%s object(s) failed the server-side dry-run"
+                                     % len(result['errors']))
+            return
+        with tracing.span('local_extras'):
+            if args.minikube:
+                local_extras(args.template_dir, True, index)
+            elif args.dockeredge:
+                local_extras(args.template_dir, False, index)
+        # Run the deploy
+        deploy(args.kubeconfig, args.namespace,
+               args.template_dir, args.version_checks, transport=args.transport,
+               jobs=args.jobs, prune_owned_only=args.prune_owned_only,
+               incremental=args.incremental, index=index,
+               owned_jobs_only=args.owned_jobs_only)
+    finally:
+        tracing.finish(args.trace)
+
+
+def hostpath_dirs(template_dir, index=None):
+    '''
+    Returns the hostPath directories of the storage PersistentVolumes, in
+    template order (each once)
+    '''
+    index = index or ManifestIndex.load(template_dir)
+    paths = []
+    for entry in index.documents('PersistentVolume', 'storage'):
+        doc = index.load_document(entry)
+        if 'hostPath' not in doc['spec']:
+            raise AssertionError("local_extras: template (%s) "
+                                 "not using hostpath." % entry['file'])
+        if doc['spec']['hostPath']['path'] not in paths:
+            paths.append(doc['spec']['hostPath']['path'])
+    return paths
+
+
+def local_extras(template_dir, minikube=False, index=None):
+    '''
+    Special handling for Local environments: pre-creates every hostPath
+    directory in one call (one `minikube ssh` session, or one local sudo)
+    '''
+    paths = hostpath_dirs(template_dir, index)
+    if minikube:
+        if paths:
+            run_minikubecmd('sudo mkdir -p %s' % ' '.join(shlex.quote(p) for p in paths))
+        return
+    paths = [p for p in paths if not os.path.exists(p)]
+    if paths:
+        run_localcmd(['sudo', 'sh', '-c', 'mkdir -p "$@" && chmod 777 "$@"', 'sh'] +
+                     paths)
+
+
+def validate(kubeconfig, namespace, template_dir, version_checks, index=None):
     '''
     Verify args
     '''
@@ -93,17 +198,17 @@ def validate(kubeconfig, namespace, template_dir, version_checks):
         raise AssertionError(
             "kubeconfig file does not exist: %s" % kubeconfig)
 
-    with open(os.path.join(template_dir, 'namespace.yaml'), "r") as n_file:
-        doc = yaml.load(n_file, Loader=yaml.SafeLoader)
-        name_in_file = doc['metadata']['name']
-        if doc['metadata']['name'] != namespace:
-            raise AssertionError(
-                "Namespaces do not match!!  From file: %s" % name_in_file)
-
-    # verify kubectl client/server versions
-    versions = [x.split(':')[1].strip() for x in (subprocess.check_output(
-        ['kubectl', 'version', '--short=true'],
-        universal_newlines=True).strip().split('\n'))]
+    index = index or ManifestIndex.load(template_dir)
+    docs = index.documents(path='namespace.yaml')
+    if not docs:
+        raise AssertionError("No namespace.yaml in: %s" % template_dir)
+    name_in_file = docs[0]['name']
+    if name_in_file != namespace:
+        raise AssertionError(
+            "Namespaces do not match!!  From file: %s" % name_in_file)
+
+    # verify kubectl client/server versions (probed once, then cached)
+    versions = kubectl_runtime.versions(kubeconfig)
     if versions[0] != versions[1]:
         message = (
             "kubectl version mismatch -- Install matching client.\n"
@@ -115,240 +220,421 @@ def validate(kubeconfig, namespace, template_dir, version_checks):
             print("\033[33mWarning: %s\033[39m" % message)
 
 
-def parse_details(describe, regex_list):
+def wait_online(namespace, k8_template, index=None):
     '''
-    Parses `kubectl describe` output, and returns list of regex matches
+    For supported types, will attempt to wait for the applied resources
+    to be online
     '''
-    compiled_list = [re.compile(x) for x in regex_list]
-    result_list = len(compiled_list) * [None]  # preallocate
-    for line in describe.splitlines():
-        for index, element in enumerate(compiled_list):
-            match = element.match(line)
-            if match:
-                result_list[index] = match.group(1)
-    return result_list
+    docs = index.objects_in(k8_template) if index else None
+    objects = []
+    for doc in scan_file(k8_template) if docs is None else docs:
+        if doc['kind'] in ROLLOUTS:
+            objects.append((doc['kind'], doc['name']))
+        else:
+            print("Don't know how to wait_online for type: %s" % doc['kind'])
+    # all at once: Deployments etc 10 minutes, Jobs 5 hours
+    wait_rollout(namespace, objects)
 
 
-def wait(fun, namespace, name, num_tries):
-    '''
-    Closure to wait until fun returns True
-    '''
-    result = None
-    count = 0
-    for count in range(num_tries):
-        result = fun(namespace, name, count)
-        if not result:
-            if count == 0:
-                print("\033[33mWaiting on %s(%s,%s)..." %
-                      (fun, namespace, name))
-            time.sleep(5)  # 5 sec sleep
-            sys.stdout.write('.')
-            sys.stdout.flush()
-        else:
-            break
-    if count != 0:
-        print('\033[39m')  # Write the newline / clear colors
-    if not result:
-        raise AssertionError("Condition not met %s(%s,%s)" %
-                             (fun, namespace, name))
+# `kubectl apply` result lines: "deployment.apps/foo configured" (or the
+# older 'deployment "foo" configured')
+APPLY_RESULT = re.compile(
+    r'^([\w.-]+?)(?:\.[\w.-]+)?(?:/| ")([^ "]+)"? (created|configured|unchanged)')
 
 
-def is_deployment_online(namespace, deployment, _count):
+def _applied_objects(output):
     '''
-    Return True/False reflecting whether a deployment is running
+    Returns {(lower-case kind, name): action} parsed from `kubectl apply` output
     '''
-    # output is different depending on v1.5 or v1.7 clients:
-    #   v1.5: Replicas:		1 updated | 1 total | 1 available | 0 unavailable
-    #   v1.7: Replicas:		1 desired | 1 updated | 1 total | 1 available | 0 unavailable
-    result = parse_details(run_kubecmd(namespace,
-                                       ['describe', 'deployment', deployment]),
-                           [r'^Replicas:.*(\d) total',
-                            r'^Replicas:.*(\d) available'])
-    # True if total == available (and is a valid non-zero number)
-    return result[0] and int(result[0]) > 0 and result[0] == result[1]
+    result = {}
+    for line in (output or '').splitlines():
+        match = APPLY_RESULT.match(line.strip())
+        if match:
+            result[(match.group(1).lower(), match.group(2))] = match.group(3)
+    return result
 
 
-def is_job_done(namespace, job, count):
+def live_content_hashes(namespace, kinds):
     '''
-    Return True/False reflecting whether a Job has completed.  If Job fails,
-    an AssertionError is raised.
+    Returns {(kind, namespace, name): content hash} for every labelled object
+    of the given kinds currently in the cluster
     '''
-    # Pods Statuses:	1 Running / 0 Succeeded / 0 Failed
-    result = parse_details(run_kubecmd(namespace,
-                                       ['describe', 'job', job]),
-                           [r'^Pods Statuses:.*(\d) Running',
-                            r'^Pods Statuses:.*(\d) Succeeded',
-                            r'^Pods Statuses:.*(\d) Failed'])
-
-    if not result[0]:
-        return True  # not able to find valid data -- keep polling
-
-    num_running = int(result[0])
-    num_succeed = int(result[1])
-    num_failure = int(result[2])
-    if num_running != 0:
-        return False  # still running
-    if num_running == 0 and num_succeed == 0 and num_failure == 0:
-        if count > 120:  # 120 tries w/ 5sec sleep == 10min
-            raise AssertionError("Job refuses to start after 10min.")
-        return False  # hasn't even started yet
-    if num_succeed == 0 and num_failure != 0:  # something failed
-        raise AssertionError("Job %s failed.  Running: %s, Succeeded: %s, Failed: %s" %
-                             (job, num_running, num_succeed, num_failure))
-    return True  # job is done successfully
-
-
-def wait_online(namespace, k8_template):
+    result = {}
+    cache = cluster_cache.for_namespace(namespace)
+    for kind in sorted(kinds):
+        for item in cache.objects(kind).values():
+            metadata = item['metadata']
+            digest = (metadata.get('annotations') or {}).get(HASH_ANNOTATION)
+            if digest and cluster_cache.is_owned(item):
+                result[(kind, metadata.get('namespace', namespace),
+                        metadata['name'])] = digest
+    return result
+
+
+def _unchanged(namespace, entries, live_hashes):
+    # True if every (indexed) document of a file matches the live object
+    return entries is not None and all(live_hashes.get(
+        (e['kind'], e['namespace'] or namespace, e['name'])) == e['hash']
+                                       for e in entries)
+
+
+def apply_templates(namespace, paths, live_hashes=None, index=None):
     '''
-    For supported types, will attempt to wait for the applied resources
-    to be online
+    Applies every document of the given files / directories as one
+    multi-document stream (a single kubectl call), stamping each object with
+    the ownership label and a content hash.  When live_hashes is given,
+    objects whose hash matches the live object are skipped (files whose
+    indexed documents all match aren't even read).  On failure, reports
+    which objects (and files) didn't apply.  Files are read through the
+    index when given (ie: from a bundle).
+    Returns {(lower-case kind, name): action}.
+    '''
+    files = index or TemplateFiles()
+    docs = []
+    skipped = {}
+    sources = {}  # (lower-case kind, name) -> file it came from
+    written = {}  # (namespace, kind) -> names
+    for path in paths:
+        for k8_template in (files.templates_in(path) if files.isdir(path) else [path]):
+            entries = index.objects_in(k8_template) if index else None
+            if live_hashes is not None and _unchanged(namespace, entries, live_hashes):
+                skipped.update(((e['kind'].lower(), e['name']), 'skipped') for e in entries)
+                continue
+            for doc in yaml.safe_load_all(files.read(k8_template)):
+                if not doc:
+                    continue
+                digest = stamp_content_hash(stamp_ownership(doc))
+                key = (doc['kind'].lower(), doc['metadata']['name'])
+                if live_hashes is not None and live_hashes.get(
+                        (doc['kind'], doc['metadata'].get('namespace', namespace),
+                         doc['metadata']['name'])) == digest:
+                    skipped[key] = 'skipped'
+                    continue
+                docs.append(doc)
+                sources[key] = k8_template
+                written.setdefault((doc['metadata'].get('namespace', namespace),
+                                    doc['kind']), []).append(doc['metadata']['name'])
+    if skipped:
+        print('Unchanged, not applied: %s' % ', '.join(
+            '%s/%s' % key for key in sorted(skipped)))
+    if not docs:
+        return skipped
+    try:
+        output = run_kubecmd(namespace, ['apply', '-f', '-'],
+                             input_data=yaml.safe_dump_all(docs))
+    except subprocess.CalledProcessError as cpe:
+        _invalidate(written)
+        applied = _applied_objects(cpe.output)
+        failed = ['%s/%s (%s)' % (kind, name, source) for (kind, name), source
+                  in sorted(sources.items()) if (kind, name) not in applied]
+        raise AssertionError("kubectl apply failed for:\n  %s"
+                             % '\n  '.join(failed or ['(unknown)'])) from cpe
+    _invalidate(written)
+    print(output)
+    skipped.update(_applied_objects(output))
+    return skipped
+
+
+def _invalidate(written):
+    # what we've just applied is re-read (not taken from the watch) next time
+    for (obj_namespace, kind), names in written.items():
+        cluster_cache.invalidate(obj_namespace, kind, names)
+
+
+def apply_and_wait(namespace, k8_template, live_hashes=None, index=None):
+    '''
+    Applies a file, then waits for its resources to be online (unless none
+    of them needed applying)
     '''
-    with open(k8_template, 'r') as k_file:
-        parsed_template = yaml.safe_load_all(k_file)
-        for doc in parsed_template:
-            kind = doc['kind']
-            if kind == 'Deployment':
-                # 120 retries w/ 5-sec sleeps == 10 minutes
-                wait(is_deployment_online, namespace,
-                     doc['metadata']['name'], 120)
-            elif kind == 'Job':
-                # 3600 retries w/ 5-sec sleeps == 5 hours
-                wait(is_job_done, namespace, doc['metadata']['name'], 3600)
-            else:
-                print("Don't know how to wait_online for type: %s" % kind)
+    results = apply_templates(namespace, [k8_template], live_hashes, index)
+    if not results or any(x != 'skipped' for x in results.values()):
+        wait_online(namespace, k8_template, index)
 
 
-def run_kubeapply(namespace, base_dir, file_or_dir,
-                  ignore_not_exist=False, only_depend=False):
+def add_kubeapply(scheduler, namespace, base_dir, file_or_dir, deps=(),
+                  ignore_not_exist=False, only_depend=False, live_hashes=None,
+                  index=None):
     '''
-    Applies kube-config from a directory
+    Adds the steps applying kube-config from a directory to the scheduler.
+    Each '.depend.start' entry becomes its own node (applied then waited on,
+    after the entries it depends on); the remaining files of the directory
+    are applied by one more node, once every entry is done.  Returns the
+    name of a barrier node that completes once the whole directory is done.
     '''
-    if ignore_not_exist and (
-            not os.path.exists(os.path.join(base_dir, file_or_dir))):
+    files = index or TemplateFiles()
+    path = os.path.normpath(os.path.join(base_dir, file_or_dir))
+    done_nodes = []
+    if ignore_not_exist and not files.exists(path):
         # ignore if file_or_dir not exists (and flag allows us)
-        return
-
-    # Load the optional '.depend.start' file and apply each reference in turn
-    depend_start_path = os.path.join(base_dir, file_or_dir, '.depend.start')
-    if os.path.exists(depend_start_path):
-        with open(depend_start_path, "r") as d_file:
-            files = yaml.load(d_file, Loader=yaml.SafeLoader)
-            for f_name in files:
-                k8_template = os.path.join(base_dir, file_or_dir, f_name)
-                print(run_kubecmd(namespace,
-                                  ['apply', '-f',
-                                   k8_template]))
-                wait_online(namespace, k8_template)
+        return scheduler.add(file_or_dir, None, deps)
+
+    # Load the optional '.depend.start' file, one node per reference
+    depend_start_path = os.path.join(path, '.depend.start')
+    if files.exists(depend_start_path):
+        listed = []
+        entries = index.depend_start(depend_start_path) if index else None
+        if entries is None:
+            entries = read_depend_start(depend_start_path)
+        for f_name, f_deps in entries:
+            k8_template = os.path.normpath(os.path.join(path, f_name))
+            done_nodes.append(scheduler.add(
+                os.path.join(file_or_dir, f_name),
+                functools.partial(apply_and_wait, namespace, k8_template,
+                                  live_hashes, index),
+                list(deps) + [os.path.join(file_or_dir, d) for d in f_deps]))
+            listed.append(k8_template)
+        rest = [] if only_depend else [
+            f for f in files.templates_in(path) if f not in listed]
     else:
-        # no .depend.start file, force only_depend to fals to process directory
-        only_depend = False
+        # no .depend.start file, only_depend doesn't apply -- process directory
+        rest = [path]
 
-    # Now Load the entire directory
-    if not only_depend:
-        print(run_kubecmd(namespace,
-                          ['apply', '-f', os.path.join(base_dir, file_or_dir)]))
+    # Now the rest of the directory, after the '.depend.start' entries
+    if rest:
+        done_nodes.append(scheduler.add(
+            os.path.join(file_or_dir, '*'),
+            functools.partial(apply_templates, namespace, rest, live_hashes, index),
+            list(deps) + done_nodes))
+    return scheduler.add(file_or_dir, None, done_nodes or deps)
 
 
 def wait_storage_online(namespace):
     '''
-    Polls PVCs status and waits until all are bound
-    '''
-    not_bound = None
-    count = 0
-    for count in range(120):  # 120 retries w/ 5-sec sleeps == 10 minutes
-        pvcs = run_kubecmd(namespace, ['get', 'pvc']).splitlines()[1:]
-        not_bound = [s for s in pvcs if "Bound" not in s]
-        if not_bound:
-            if count == 0:
-                print('\033[33mWaiting for all PersistentVolumeClaims '
-                      '(PVCs) to be bound...')
-            time.sleep(5)  # 5 sec sleep
-            sys.stdout.write('.')
-            sys.stdout.flush()
-        else:
-            break
-    if count != 0:
-        print('\033[39m')  # Write the newline / clear colors
-    if not_bound:
-        raise AssertionError("PVCs not 'Bound':\n%s" % (not_bound))
+    Waits (up to 10 minutes) until all PVCs are bound
+    '''
+    wait_pvcs_bound(namespace)
+
 
+def _job_finished(obj):
+    # completed or failed (a failed Job is as safe to delete)
+    try:
+        return job_done(obj)
+    except AssertionError:
+        return True
 
-def delete_all_jobs(namespace, retry_count=0):
+
+def delete_all_jobs(namespace, owned_only=False, timeout=RUNNING_JOBS_TIMEOUT):
     '''
-    deletes all jobs (Aborts if any are running)
+    Deletes every Job -- or, with owned_only, every Job carrying our ownership
+    label -- in one call.  Running Jobs are waited on (up to "timeout"
+    seconds); if any are still running, the deployment is aborted.
     '''
-    all_jobs = all_resource_names(namespace, 'Job')
-    for job in all_jobs:
-        done = False
+    cache = cluster_cache.for_namespace(namespace)
+    jobs = {name: obj for name, obj in cache.objects('Job').items()
+            if not owned_only or cluster_cache.is_owned(obj)}
+    running = sorted(name for name, obj in jobs.items() if not _job_finished(obj))
+    if running:
+        print('Warning: Running jobs detected: %s, waiting up to %s seconds...'
+              % (', '.join(running), timeout))
         try:
-            done = is_job_done(namespace, job, 0)
-        except AssertionError:
-            done = True
-        except subprocess.CalledProcessError as cpe:
-            if "not found" in cpe.output:
-                done = True
-            else:
-                raise  # the original error
-
-        if not done:
-            if retry_count > 6:
-                raise AssertionError(
-                    'Running job: %s detected.  Aborting deployment.' % job)
-            print('Warning: Running jobs detected: %s, retrying in 10 seconds...' % job)
-            time.sleep(10)  # sleep 5-seconds
-            delete_all_jobs(namespace, retry_count+1)  # recurse
-
-    # if we made it this far, there are no running jobs (safe to delete)
-    if all_jobs:
-        # delete all jobs
-        print('Deleting all jobs: ' + run_kubecmd(namespace,
-                                                  ['delete', 'jobs', '--all']))
-
-
-def deploy(kubeconfig, namespace, template_dir, version_checks):
-    '''
-    Runs the k8 deployment process
+            wait_for(namespace, 'Job', _job_finished, timeout, names=running,
+                     description='running Jobs')
+        except AssertionError as err:
+            # (a Job deleted meanwhile isn't running either)
+            still_running = sorted(name for name, obj in cache.objects('Job').items()
+                                   if name in running and not _job_finished(obj))
+            if still_running:
+                raise AssertionError('Running job(s): %s detected.  Aborting deployment.'
+                                     % ', '.join(still_running)) from err
+        jobs = {name: obj for name, obj in cache.objects('Job').items()
+                if not owned_only or cluster_cache.is_owned(obj)}
+
+    # no running jobs (safe to delete)
+    if jobs:
+        print('Deleting all jobs: ' + run_kubecmd(
+            namespace, ['delete', 'jobs'] + (['-l', OWNER_SELECTOR] if owned_only
+                                             else ['--all'])))
+        cache.invalidate('Job')
+
+
+def deploy(kubeconfig, namespace, template_dir, version_checks,
+           transport=None, jobs=1, prune_owned_only=False, incremental=False,
+           index=None, owned_jobs_only=False):
+    '''
+    Runs the k8 deployment process.  index is the template_dir's
+    ManifestIndex (loaded here if not given).
     '''
     # set the environment
     os.environ['KUBECONFIG'] = kubeconfig
+    if transport:
+        set_transport(transport)
+
+    if index is None:
+        with tracing.span('manifest index'):
+            index = ManifestIndex.load(template_dir)
 
     # run validations
-    validate(kubeconfig, namespace, template_dir, version_checks)
+    with tracing.span('validate'):
+        validate(kubeconfig, namespace, template_dir, version_checks, index)
 
     # delete all jobs (will abort if any are running)
-    delete_all_jobs(namespace)
-
-    # run through the deployment
-    run_kubeapply(namespace, template_dir, 'namespace.yaml')
-
-    # optional directories (in order)
-    run_kubeapply(namespace, template_dir, 'secrets/',
-                  ignore_not_exist=True)
-    run_kubeapply(namespace, template_dir, 'storage/',
-                  ignore_not_exist=True)
-
-    # wait for storage to come online
-    wait_storage_online(namespace)
-
-    run_kubeapply(namespace, template_dir, 'configmaps/',
-                  ignore_not_exist=True)
-    run_kubeapply(namespace, template_dir, 'services/',
-                  ignore_not_exist=True)
-    run_kubeapply(namespace, template_dir, 'deployments/',
-                  ignore_not_exist=True)
-    run_kubeapply(namespace, template_dir, 'statefulsets/',
-                  ignore_not_exist=True)
-    run_kubeapply(namespace, template_dir, 'daemonsets/',
-                  ignore_not_exist=True)
-    run_kubeapply(namespace, template_dir, 'jobs/',
-                  ignore_not_exist=True, only_depend=True)
-    run_kubeapply(namespace, template_dir, 'cronjobs/',
-                  ignore_not_exist=True, only_depend=True)
-    # Now run everything at the base template_dir
-    run_kubeapply(namespace, template_dir, '.')
+    with tracing.span('delete_all_jobs'):
+        delete_all_jobs(namespace, owned_jobs_only)
+
+    # incremental: snapshot what's live so unchanged objects can be skipped
+    live_hashes = None
+    if incremental:
+        with tracing.span('live_content_hashes'):
+            live_hashes = live_content_hashes(namespace, index.resources().keys())
+
+    # run through the deployment -- each phase only waits on the phases it
+    # really needs, independent phases / files are applied concurrently
+    scheduler = Scheduler(jobs)
+    for file_or_dir, deps, ignore_not_exist, only_depend in PHASES:
+        add_kubeapply(scheduler, namespace, template_dir, file_or_dir, deps,
+                      ignore_not_exist=ignore_not_exist,
+                      only_depend=only_depend, live_hashes=live_hashes,
+                      index=index)
+        if file_or_dir == 'storage/':
+            # wait for storage to come online
+            scheduler.add(STORAGE_ONLINE,
+                          functools.partial(wait_storage_online, namespace),
+                          ['storage/'])
+    with tracing.span('apply phases', jobs=jobs):
+        scheduler.run()
 
     # Find leaked objects and delete them
-    prune_namespace(namespace, template_dir)
+    with tracing.span('prune_namespace'):
+        prune_namespace(namespace, template_dir, owned_only=prune_owned_only,
+                        index=index)
+
+
+def planned_files(template_dir, index=None):
+    '''
+    Returns the files deploy() applies, in phase order
+    '''
+    files = index or TemplateFiles()
+    result = []
+    for file_or_dir, _deps, _ignore_not_exist, only_depend in PHASES:
+        path = os.path.normpath(os.path.join(template_dir, file_or_dir))
+        if not files.isdir(path):
+            result.extend([path] if files.exists(path) else [])
+            continue
+        depend_start_path = os.path.join(path, '.depend.start')
+        if not files.exists(depend_start_path):
+            result.extend(files.templates_in(path))
+            continue
+        entries = index.depend_start(depend_start_path) if index else None
+        if entries is None:
+            entries = read_depend_start(depend_start_path)
+        listed = [os.path.normpath(os.path.join(path, f)) for f, _ in entries]
+        result.extend(listed)
+        if not only_depend:
+            result.extend(f for f in files.templates_in(path) if f not in listed)
+    return sorted(set(result), key=result.index)
+
+
+def _comparable(obj):
+    # an object minus its status, type (a template's apiVersion may be an
+    # older one than the listing's) and the fields the server manages
+    obj = copy.deepcopy(obj)
+    for key in ('status', 'apiVersion', 'kind'):
+        obj.pop(key, None)
+    metadata = obj.get('metadata') or {}
+    for key in SERVER_METADATA:
+        metadata.pop(key, None)
+    annotations = metadata.get('annotations') or {}
+    for key in IGNORED_ANNOTATIONS:
+        annotations.pop(key, None)
+    if not annotations:
+        metadata.pop('annotations', None)
+    return obj
+
+
+def _changed_paths(old, new, prefix=''):
+    # dotted paths of the fields that differ (lists compare as a whole)
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return [] if old == new else [prefix or '.']
+    paths = []
+    for key in sorted(set(old) | set(new)):
+        if old.get(key) != new.get(key):
+            paths.extend(_changed_paths(old.get(key), new.get(key),
+                                        '%s.%s' % (prefix, key) if prefix else key))
+    return paths
+
+
+def _dry_run(client, namespace, doc, live):
+    # returns (action, changed paths) for one object
+    if live is not None and doc['kind'] == 'Job':
+        # deploy deletes (and so re-creates) every Job: compare content hashes
+        live_hash = (live['metadata'].get('annotations') or {}).get(HASH_ANNOTATION)
+        if live_hash == doc['metadata']['annotations'][HASH_ANNOTATION]:
+            return 'unchanged', []
+        return 'changed', ['(re-created)']
+    action, planned = client.dry_run_apply(namespace, doc, exists=live is not None)
+    if action == 'created':
+        return action, []
+    paths = _changed_paths(_comparable(live), _comparable(planned))
+    return ('changed' if paths else 'unchanged'), paths
+
+
+def diff_deploy(kubeconfig, namespace, template_dir, version_checks,
+                transport='api', prune_owned_only=False, index=None):
+    '''
+    Server-side dry-runs every object deploy() would apply (DIFF_CONCURRENCY
+    requests at a time) and compares the results with the live objects.
+    Nothing is changed.  Returns {"created": [obj], "changed": [(obj,
+    [changed fields])], "unchanged": [obj], "pruned": [obj], "errors":
+    [(obj, error)]} -- obj being "kind/name".
+    '''
+    os.environ['KUBECONFIG'] = kubeconfig
+    if not isinstance(set_transport(transport), ApiTransport):
+        raise AssertionError("--diff needs the api transport (a usable kubeconfig)")
+    client = get_transport().client
+    index = index or ManifestIndex.load(template_dir)
+    validate(kubeconfig, namespace, template_dir, version_checks, index)
+
+    docs = []
+    for k8_template in planned_files(template_dir, index):
+        for doc in yaml.safe_load_all(index.read(k8_template)):
+            if doc:
+                stamp_content_hash(stamp_ownership(doc))
+                docs.append(doc)
+    # one list per kind (via the cache), then the dry-runs in parallel
+    live = {}
+    for doc in docs:
+        key = (doc['metadata'].get('namespace', namespace), doc['kind'])
+        if key not in live:
+            live[key] = cluster_cache.for_namespace(key[0]).objects(key[1])
+    result = {'created': [], 'changed': [], 'unchanged': [], 'pruned': [],
+              'errors': []}
+    with tracing.span('dry-run', objects=len(docs)), \
+            concurrent.futures.ThreadPoolExecutor(DIFF_CONCURRENCY) as pool:
+        futures = [(doc, pool.submit(
+            _dry_run, client, namespace, doc,
+            live[(doc['metadata'].get('namespace', namespace), doc['kind'])].get(
+                doc['metadata']['name']))) for doc in docs]
+        for doc, future in futures:
+            obj = '%s/%s' % (doc['kind'].lower(), doc['metadata']['name'])
+            try:
+                action, paths = future.result()
+            except subprocess.CalledProcessError as err:
+                result['errors'].append((obj, str(err.output or err).strip()))
+                continue
+            result[action].append((obj, paths) if action == 'changed' else obj)
+    for kind, names in sorted(extraneous(namespace, template_dir, prune_owned_only,
+                                         index).items()):
+        result['pruned'].extend('%s/%s' % (kind.lower(), n) for n in sorted(names))
+    return result
+
+
+def print_diff(result, max_fields=5):
+    '''
+    Prints a diff_deploy() result, one line per created / changed / pruned
+    object, and the totals
+    '''
+    for obj in result['created']:
+        print('\033[32m+ %s\033[39m' % obj)
+    for obj, paths in result['changed']:
+        print('\033[33m~ %s: %s%s\033[39m' % (obj, ', '.join(paths[:max_fields]),
+                                              ' ...' if len(paths) > max_fields else ''))
+    for obj in result['pruned']:
+        print('\033[31m- %s\033[39m' % obj)
+    for obj, error in result['errors']:
+        print('\033[31m! %s: %s\033[39m' % (obj, error))
+    print('Diff: %s to create, %s to change, %s unchanged, %s to prune, %s errors' % (
+        len(result['created']), len(result['changed']), len(result['unchanged']),
+        len(result['pruned']), len(result['errors'])))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,323 @@
+#! /usr/bin/env python
+'''
+deployerd.py -- long running deployer: keeps the Jinja templates compiled
+and the cluster connection open, watches the template and context files,
+and on a change re-renders only the affected templates and applies only
+the objects that changed.
+
+A small HTTP endpoint reports status and triggers runs:
+    GET  /status   -- current state and the last run's result
+    POST /sync     -- check for changes now
+    POST /deploy   -- render, then run a full (incremental) deploy
+'''
+
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from deploy import (PHASES, add_cluster_arguments, apply_templates, deploy,
+                    planned_files)
+from manifest_index import read_depend_start
+from gen_k8 import _get_jinja_env, add_render_arguments, gen_jinja, init_context
+from prune_namespace import prune_namespace
+from readiness import ROLLOUTS, wait_rollout
+import cluster_cache
+from utils import run_kubecmd, set_transport
+
+# Seconds before a failed run is retried
+RETRY_DELAY = 30
+
+
+def main():
+    '''
+    Run the deployer daemon
+    '''
+    parser = argparse.ArgumentParser(
+        description='Watches K8 templates, re-rendering and applying changes')
+    add_cluster_arguments(parser)
+    add_render_arguments(parser, watched=True)
+    parser.add_argument(
+        '-l', '--listen', default='127.0.0.1:8099',
+        help='host:port of the status / trigger endpoint.  Default is 127.0.0.1:8099')
+    parser.add_argument(
+        '--interval', type=float, default=2,
+        help='Seconds between checks for changed files.  Default is 2')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Concurrency of full deploys.  Default is 1')
+    parser.add_argument(
+        '--transport', choices=['kubectl', 'api'], default='api',
+        help='How to talk to the cluster.  Default is "api"')
+    parser.add_argument(
+        '--prune-owned-only', action='store_true',
+        help='Only prune objects carrying the k8-deployer ownership label.')
+    parser.add_argument(
+        '--no-initial-deploy', action='store_true',
+        help="Don't run a full deploy at start up.")
+    args = parser.parse_args()
+    for _dir in [args.input_dir, args.output_dir]:
+        if not os.path.isdir(_dir):
+            raise AssertionError("Directory does not exist %s" % _dir)
+
+    deployer = Deployer(args)
+    host, port = args.listen.rsplit(':', 1)
+    server = StatusServer((host, int(port)), StatusHandler)
+    server.deployer = deployer
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print('\033[32mListening on http://%s:%s/status\033[39m' % (host, port))
+    deployer.run_forever(initial_deploy=not args.no_initial_deploy)
+
+
+def _snapshot(paths):
+    '''
+    {file: (mtime, size)} for every file under the given files / directories
+    '''
+    result = {}
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            result[path] = (stat.st_mtime_ns, stat.st_size)
+        for subdir, _dirs, files in os.walk(path):
+            for _file in files:
+                full = os.path.join(subdir, _file)
+                try:
+                    stat = os.stat(full)
+                except OSError:
+                    continue  # deleted while walking
+                result[full] = (stat.st_mtime_ns, stat.st_size)
+    return result
+
+
+def _phase_of(rel_path):
+    '''
+    Returns (index of the deploy phase a generated file belongs to, its
+    PHASES entry), or None for a file in a directory no phase applies
+    '''
+    directory = os.path.dirname(rel_path)
+    for index, phase in enumerate(PHASES):
+        if rel_path == phase[0] or directory + '/' == phase[0]:
+            return index, phase
+    if directory:
+        return None
+    return len(PHASES) - 1, PHASES[-1]  # the base directory
+
+
+class Deployer(object):
+    '''
+    The daemon's state: Jinja env, context, last render, and run status
+    '''
+    def __init__(self, args):
+        self.args = args
+        self.input_dir = os.path.abspath(args.input_dir)
+        self.output_dir = os.path.abspath(args.output_dir)
+        self.kubeconfig = os.path.abspath(os.path.expanduser(args.kubeconfig))
+        self.env = _get_jinja_env(self.input_dir, cache_size=-1)
+        self.context = None
+        self.manifest = None
+        self.inputs = {}
+        self.context_inputs = {}
+        self.failed = None  # what a failed run left to retry
+        self.retry_at = None
+        self.status = {'state': 'starting', 'namespace': args.namespace,
+                       'runs': 0, 'last_run': None, 'pending': None, 'retry_at': None}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        os.environ['KUBECONFIG'] = self.kubeconfig
+        set_transport(args.transport)
+
+    def trigger(self, full=False):
+        '''
+        Ask for a check (or a full deploy) as soon as possible
+        '''
+        with self._lock:
+            if full or not self.status['pending']:
+                self.status['pending'] = 'deploy' if full else 'sync'
+        self._wake.set()
+
+    def get_status(self):
+        '''
+        Snapshot of the status (for the HTTP endpoint)
+        '''
+        with self._lock:
+            return json.loads(json.dumps(self.status))
+
+    def _set(self, **values):
+        with self._lock:
+            self.status.update(values)
+
+    def run_forever(self, initial_deploy=True):
+        '''
+        The main loop: runs are serialized on this thread
+        '''
+        if initial_deploy:
+            self.trigger(full=True)
+        else:
+            self.trigger()
+        while True:
+            self._wake.wait(self.args.interval)
+            self._wake.clear()
+            with self._lock:
+                pending, self.status['pending'] = self.status['pending'], None
+            inputs = _snapshot([self.input_dir])
+            context_inputs = _snapshot(self.args.context_files or [])
+            changed = inputs != self.inputs or context_inputs != self.context_inputs
+            retry = self.failed is not None and time.time() >= self.retry_at
+            if not pending and not changed and not retry:
+                continue
+            self.run(pending or ('change' if changed else 'retry'),
+                     context_inputs != self.context_inputs)
+            self.inputs, self.context_inputs = inputs, context_inputs
+
+    def run(self, trigger, reload_context=True):
+        '''
+        Re-render changed templates, then apply what changed (or, for a
+        "deploy" trigger, run a full deploy).  After a failed run, what
+        changed is measured from the output the last good run applied, so
+        the failed files are applied again.
+        '''
+        started = time.time()
+        result = {'trigger': trigger, 'started': started, 'ok': False}
+        retry, self.failed = self.failed, None
+        if retry:
+            trigger = 'deploy' if retry['trigger'] == 'deploy' else trigger
+            before, old_manifest = retry['output'], retry['manifest']
+        else:
+            before, old_manifest = _snapshot([self.output_dir]), self.manifest or {}
+        self._set(state='rendering')
+        try:
+            if reload_context or retry or self.context is None:
+                self.context = init_context(self.args)
+            self.manifest = gen_jinja(self.context, self.input_dir, self.output_dir,
+                                      incremental=True, env=self.env)
+            after = _snapshot([self.output_dir])
+            changed = sorted(os.path.relpath(path, self.output_dir)
+                             for path, stamp in after.items()
+                             if before.get(path) != stamp and
+                             os.path.relpath(path, self.output_dir) in self.manifest)
+            removed = sorted(set(old_manifest) - set(self.manifest))
+            result.update(rendered=changed, removed=removed)
+            self._set(state='deploying')
+            if trigger == 'deploy':
+                deploy(self.kubeconfig, self.args.namespace, self.output_dir, False,
+                       jobs=self.args.jobs, prune_owned_only=self.args.prune_owned_only,
+                       incremental=True)
+            elif changed or removed:
+                result['applied'] = self.apply_changed(changed)
+                if removed:
+                    prune_namespace(self.args.namespace, self.output_dir,
+                                    owned_only=self.args.prune_owned_only)
+            result['ok'] = True
+        except Exception as err:  # pylint: disable=broad-except
+            traceback.print_exc()
+            result['error'] = '%s: %s' % (type(err).__name__, err)
+            self.failed = {'trigger': trigger, 'output': before, 'manifest': old_manifest}
+            self.retry_at = time.time() + RETRY_DELAY
+        result['duration'] = round(time.time() - started, 2)
+        with self._lock:
+            self.status['runs'] += 1
+            self.status.update(state='idle', last_run=result,
+                               retry_at=self.retry_at if self.failed else None)
+        print('\033[%sm%s run (%s file(s) changed) finished in %ss%s\033[39m' % (
+            '32' if result['ok'] else '31', trigger, len(result.get('rendered') or []),
+            result['duration'], '' if result['ok'] else ': %s (retrying in %ss)' % (
+                result['error'], RETRY_DELAY)))
+
+    def apply_changed(self, changed):
+        '''
+        Applies the changed generated files, phase by phase (in deploy
+        order), waiting on the changed objects that roll out (Deployments,
+        StatefulSets, Jobs, ...) -- all of a phase at once.  Returns the
+        {kind/name: action} applied.
+        '''
+        paths = set(changed)
+        replanned = [os.path.dirname(p) for p in changed
+                     if os.path.basename(p) == '.depend.start']
+        if replanned:  # a changed .depend.start: apply its whole directory again
+            paths.update(p for p in (os.path.relpath(f, self.output_dir)
+                                     for f in planned_files(self.output_dir))
+                         if os.path.dirname(p) in replanned)
+        by_phase = {}
+        for rel_path in sorted(paths):
+            if not rel_path.endswith(('.yml', '.yaml', '.json')):
+                continue  # ie: .depend.start
+            found = _phase_of(rel_path)
+            if found is None:
+                continue  # deploy() doesn't apply it either
+            index, phase = found
+            if phase[3]:  # only_depend: only files listed in .depend.start
+                depend_start = os.path.join(self.output_dir, phase[0], '.depend.start')
+                listed = [os.path.join(phase[0], f) for f, _ in (
+                    read_depend_start(depend_start) if os.path.exists(depend_start) else [])]
+                if rel_path not in listed:
+                    continue
+            by_phase.setdefault(index, []).append(rel_path)
+        jobs = set(obj['name'] for paths in by_phase.values() for rel_path in paths
+                   for obj in self.manifest[rel_path]['objects'] if obj['kind'] == 'Job')
+        jobs &= set(cluster_cache.for_namespace(self.args.namespace).objects('Job'))
+        if jobs:  # Job specs are immutable: re-create the changed ones
+            print('Deleting changed jobs: ' + run_kubecmd(
+                self.args.namespace, ['delete', 'jobs'] + sorted(jobs)))
+            cluster_cache.invalidate(self.args.namespace, 'Job', jobs)
+        applied = {}
+        for index in sorted(by_phase):
+            paths = [os.path.join(self.output_dir, p) for p in by_phase[index]]
+            results = apply_templates(self.args.namespace, paths)
+            applied.update(('%s/%s' % key, action) for key, action in results.items())
+            wait_rollout(self.args.namespace, [
+                (obj['kind'], obj['name']) for rel_path in by_phase[index]
+                for obj in self.manifest[rel_path]['objects']
+                if obj['kind'] in ROLLOUTS and results.get(
+                    (obj['kind'].lower(), obj['name'])) not in (None, 'unchanged')])
+        return applied
+
+
+class StatusServer(ThreadingMixIn, HTTPServer):
+    '''
+    Status / trigger endpoint
+    '''
+    daemon_threads = True
+    deployer = None
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    '''
+    GET /status, POST /sync, POST /deploy
+    '''
+    def log_message(self, *_args):  # pylint: disable=arguments-differ
+        pass
+
+    def _send(self, code, body):
+        data = json.dumps(body, indent=1, sort_keys=True).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        '''
+        Report status
+        '''
+        if self.path.rstrip('/') in ('', '/status'):
+            return self._send(200, self.server.deployer.get_status())
+        return self._send(404, {'error': 'unknown path: %s' % self.path})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        '''
+        Trigger a run
+        '''
+        if self.path.rstrip('/') not in ('/sync', '/deploy'):
+            return self._send(404, {'error': 'unknown path: %s' % self.path})
+        self.server.deployer.trigger(full=self.path.rstrip('/') == '/deploy')
+        return self._send(202, self.server.deployer.get_status())
+
+
+if __name__ == "__main__":
+    main()
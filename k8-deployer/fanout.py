@@ -0,0 +1,206 @@
+#! /usr/bin/env python
+'''
+fanout.py -- CLI to generate and deploy to many (kubeconfig, namespace)
+targets at once.
+
+Each target runs gen_k8.py (optional) and deploy.py in its own processes,
+with its own log file, at most --parallel targets at a time.  The exit
+status is non-zero if any target failed.
+'''
+
+import argparse
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import time
+import yaml
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    '''
+    CLI fan-out deploy
+    '''
+    parser = argparse.ArgumentParser(
+        description='Deploys to several kubeconfig / namespace targets concurrently')
+    parser.add_argument(
+        '-f', '--targets-file', required=True,
+        help='YAML/JSON file listing the targets (see README)')
+    parser.add_argument(
+        '-p', '--parallel', type=int, default=4,
+        help='Number of targets deployed at the same time.  Default is 4')
+    parser.add_argument(
+        '-w', '--work-dir', default='./fanout-output/',
+        help=('Per-target logs and generated files go here.'
+              '  Default is "./fanout-output/"'))
+    parser.add_argument(
+        '-r', '--results',
+        help='Also write per-target results to this JSON file')
+    parser.add_argument(
+        '-o', '--only', action='append', default=None,
+        help='Only deploy the named target(s): -o tenant-a -o tenant-b')
+    args = parser.parse_args()
+
+    targets = load_targets(args.targets_file)
+    if args.only:
+        unknown = set(args.only) - set(t['name'] for t in targets)
+        if unknown:
+            raise AssertionError("Unknown target(s): %s" % sorted(unknown))
+        targets = [t for t in targets if t['name'] in args.only]
+    results = fanout(targets, args.work_dir, args.parallel)
+    if args.results:
+        with open(args.results, 'w') as r_file:
+            json.dump(results, r_file, indent=1, sort_keys=True)
+    if any(r['status'] != 'ok' for r in results):
+        sys.exit(1)
+
+
+def load_targets(targets_file):
+    '''
+    Reads the targets file:
+
+        defaults:                  # optional, merged into every target
+          input_dir: ./k8-templates/
+          storage_type: nfs
+          context_files: [config/secrets.json]
+          deploy_args: [--transport, api, -j, '4']
+        targets:
+        - namespace: tenant-a
+          kubeconfig: ~/.kube/cluster-1
+          context: {UI_HOST: a.example.com}
+        - name: tenant-b-eu        # default: the namespace
+          namespace: tenant-b
+          kubeconfig: ~/.kube/cluster-2
+          template_dir: ./pre-generated/tenant-b/   # no gen_k8 step
+
+    Returns the list of targets (dicts), defaults applied.
+    '''
+    with open(targets_file, 'r') as t_file:
+        config = yaml.load(t_file, Loader=yaml.SafeLoader) or {}
+    if isinstance(config, list):
+        config = {'targets': config}
+    defaults = config.get('defaults') or {}
+    targets = []
+    for entry in config.get('targets') or []:
+        target = dict(defaults)
+        target.update(entry)
+        target['context'] = dict(defaults.get('context') or {},
+                                 **(entry.get('context') or {}))
+        for key in ['kubeconfig', 'namespace']:
+            if not target.get(key):
+                raise AssertionError("Target missing '%s': %s" % (key, entry))
+        if not target.get('input_dir') and not target.get('template_dir'):
+            raise AssertionError("Target needs an 'input_dir' (to generate) or a"
+                                 " 'template_dir' (pre-generated): %s" % entry)
+        target['kubeconfig'] = os.path.expanduser(target['kubeconfig'])
+        target.setdefault('name', target['namespace'])
+        targets.append(target)
+    names = [t['name'] for t in targets]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        raise AssertionError("Duplicate target names: %s -- set 'name' to tell"
+                             " them apart" % duplicates)
+    return targets
+
+
+def target_commands(target, target_dir):
+    '''
+    Returns the [gen_k8.py, deploy.py] (or just [deploy.py]) command lines
+    for a target
+    '''
+    commands = []
+    template_dir = target.get('template_dir')
+    if target.get('input_dir'):
+        template_dir = os.path.join(target_dir, 'k8-generated')
+        if not os.path.isdir(template_dir):
+            os.makedirs(template_dir)
+        # context overrides go last, so they win over the shared files
+        context_file = os.path.join(target_dir, 'context.json')
+        with open(context_file, 'w') as c_file:
+            json.dump(target['context'], c_file, indent=1, sort_keys=True)
+        command = [sys.executable, os.path.join(BASEDIR, 'gen_k8.py'),
+                   '-n', target['namespace'],
+                   '-s', target.get('storage_type', 'nfs'),
+                   '-i', target['input_dir'], '-o', template_dir]
+        if target.get('fqdn'):
+            command += ['-f', target['fqdn']]
+        command += [str(x) for x in target.get('gen_args') or []]
+        command += ['-cf'] + list(target.get('context_files') or []) + [context_file]
+        commands.append(command)
+    commands.append([sys.executable, os.path.join(BASEDIR, 'deploy.py'),
+                     '-k', target['kubeconfig'], '-n', target['namespace'],
+                     '-t', template_dir] +
+                    [str(x) for x in target.get('deploy_args') or []])
+    return commands
+
+
+def run_target(target, work_dir):
+    '''
+    Generate and deploy one target, all output going to its log file.
+    Returns its result record.
+    '''
+    target_dir = os.path.join(work_dir, target['name'])
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    log_path = os.path.join(work_dir, '%s.log' % target['name'])
+    started = time.time()
+    result = {'name': target['name'], 'namespace': target['namespace'],
+              'kubeconfig': target['kubeconfig'], 'log': log_path,
+              'status': 'ok', 'step': None}
+    with open(log_path, 'w') as log:
+        for command in target_commands(target, target_dir):
+            result['step'] = os.path.basename(command[1])
+            log.write('$ %s\n' % ' '.join(command))
+            log.flush()
+            returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT,
+                                         stdin=subprocess.DEVNULL)
+            if returncode:
+                result['status'] = 'failed'
+                result['returncode'] = returncode
+                log.write('\n%s exited with %s\n' % (result['step'], returncode))
+                break
+    result['duration'] = round(time.time() - started, 1)
+    return result
+
+
+def fanout(targets, work_dir, parallel=4):
+    '''
+    Runs every target, "parallel" at a time.  Prints each result as it
+    finishes and a summary at the end.  Returns the results (in target order).
+    '''
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    print('Deploying %s target(s), %s at a time.  Logs in: %s'
+          % (len(targets), max(1, parallel), os.path.abspath(work_dir)))
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max(1, parallel)) as pool:
+        futures = {pool.submit(run_target, target, work_dir): target
+                   for target in targets}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]['name']
+            try:
+                results[name] = future.result()
+            except Exception as err:  # pylint: disable=broad-except
+                # couldn't even start (ie: unwritable work dir)
+                results[name] = {'name': name, 'status': 'failed',
+                                 'step': 'setup', 'error': str(err)}
+            result = results[name]
+            if result['status'] == 'ok':
+                print('\033[32m%s: deployed in %ss\033[39m'
+                      % (name, result['duration']))
+            else:
+                print('\033[31m%s: FAILED in %s (see %s)\033[39m'
+                      % (name, result['step'], result.get('log', result.get('error'))))
+
+    ordered = [results[t['name']] for t in targets]
+    failed = [r['name'] for r in ordered if r['status'] != 'ok']
+    print('Summary: %s ok, %s failed%s' % (len(ordered) - len(failed), len(failed),
+                                          ': %s' % ', '.join(failed) if failed else ''))
+    return ordered
+
+
+if __name__ == "__main__":
+    main()
@@ -13,34 +13,56 @@ Generate K8 files from Jinja templates
 
 import argparse
 import base64
+import collections
+import copy
 import glob
 import hashlib
+import json
+import multiprocessing
 import os
 import shutil
 import string
 import random
+import threading
+import traceback
 import yaml
 
 # External dependencies
 import jinja2
+import jinja2.meta
 
+from manifest_index import write_bundle
+import tracing
 
-def main():
+# libyaml's C loader when pyyaml was built with it (much faster)
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Context keys computed (when missing) from the others, see init_context
+DERIVED_KEYS = ['UI_HOST', 'UI_URL', 'GATEWAY_HOST', 'MUTUAL_AUTH_GATEWAY_HOST',
+                'API_GATEWAY_URL']
+
+# Per-output record of the inputs each file was rendered from (see gen_jinja)
+MANIFEST_FILE = '.gen-manifest'
+
+# template source hash -> (context keys it reads, templates it references)
+_SOURCE_INFO = {}
+
+# template -> _template_inputs() result, for the current gen_targets run
+_TEMPLATE_INPUTS = {}
+
+# Files read through from_file / from_file_base64 by the current render
+_READ_PATHS = set()
+
+
+def add_render_arguments(parser, watched=False):
     '''
-    CLI generate K8 files from Jinja templates
+    Adds the storage type, FQDN, directory and context arguments (shared
+    with deployerd.py, which watches the input and context files)
     '''
-    parser = argparse.ArgumentParser(
-        description='Generate Kubernetes files from Jinja templates')
-    # Required
-    parser.add_argument(
-        '-n', '--namespace', required=True,
-        help='Kubernetes namespace')
     parser.add_argument(
         '-s', '--storage-type', required=True,
         choices=['hostpath', 'nfs', 'bluemix', 'glusterfs-storage'],
         help='Kubernetes storage type.  Use "hostpath" for Minikube.')
-
-    # Options
     parser.add_argument(
         '-f', '--fqdn',
         help=('Application FQDN override.'
@@ -50,8 +72,8 @@ def main():
         help='K8 template input directory.  Default is "./k8-templates/"')
     parser.add_argument(
         '-o', '--output_dir', default='k8-generated/',
-        help=('Generated file output directory.  Default is "./k8-generated/".'
-              '  Contents WILL BE WIPED.'))
+        help=('Generated file output directory.  Default is "./k8-generated/".' +
+              ('' if watched else '  Contents WILL BE WIPED (unless --incremental).')))
     parser.add_argument(
         '-d', '--dev_settings', action='store_true',
         help='Development settings (open NodePorts, etc)')
@@ -66,8 +88,59 @@ def main():
     parser.add_argument(
         '-cf', '--context_files', default=None,
         nargs='+',  # one or more
-        help='Jinja context from JSON/YML files.')
+        help='Jinja context from JSON/YML files%s.' % (' (watched too)' if watched else ''))
+
+
+def main():
+    '''
+    CLI generate K8 files from Jinja templates
+    '''
+    parser = argparse.ArgumentParser(
+        description='Generate Kubernetes files from Jinja templates')
+    # Required
+    parser.add_argument(
+        '-n', '--namespace',
+        help='Kubernetes namespace (required unless --matrix)')
+    add_render_arguments(parser)
+
+    # Options
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help=('Only re-render outputs whose inputs (templates, files, context'
+              ' values) changed, and delete orphaned outputs.'))
+    parser.add_argument(
+        '-p', '--processes', type=int, default=1,
+        help=('Number of processes rendering templates in parallel'
+              ' (0: one per CPU).  Default is 1'))
+    parser.add_argument(
+        '--schema-check', action='store_true',
+        help='Check every object has an apiVersion, kind and metadata.name.')
+    parser.add_argument(
+        '--matrix', metavar='FILE',
+        help=('YAML/JSON list of per-namespace context overlays (each with a'
+              ' K8_NAMESPACE).  Templates are compiled and context files read'
+              ' once; each namespace is rendered into OUTPUT_DIR/<K8_NAMESPACE>/.'))
+    parser.add_argument(
+        '--context-sources', action='store_true',
+        help=('Print which layer (env, a context file, -c, args, matrix or'
+              ' derived) supplied each context key, and exit.'))
+    parser.add_argument(
+        '--bundle', metavar='FILE',
+        help=('Also pack the generated files into one bundle FILE (deploy.py'
+              ' -t FILE reads it without a directory walk).'))
+    parser.add_argument(
+        '--helper-cache-mb', type=int, default=64,
+        help=('Memory cap for cached from_file / from_file_base64 / sha256'
+              ' results (0 disables the cache).  Default is 64'))
+    parser.add_argument(
+        '--trace', metavar='FILE',
+        help=('Record per-template render times; write them as a Chrome trace'
+              ' (chrome://tracing) to FILE and print a summary.'))
     args = parser.parse_args()
+    if not args.namespace and not args.matrix:
+        parser.error('the following arguments are required: -n/--namespace')
+    if args.bundle and args.matrix:
+        parser.error('--bundle is not supported with --matrix')
     input_dir = os.path.abspath(args.input_dir)
     output_dir = os.path.abspath(args.output_dir)
 
@@ -84,62 +157,166 @@ def main():
         raise AssertionError("FQDN: %s is not fully qualified." % args.fqdn)
 
     # Initialize Context & Generate K8s from Jinja
-    context = init_context(args)
-    gen_jinja(context, input_dir, output_dir)
-
-
-def _apply_env_overrides(context):
+    tracing.enable(bool(args.trace))
+    HELPER_CACHE.max_bytes = args.helper_cache_mb * 1024 * 1024
+    try:
+        if args.matrix:
+            with tracing.span('init_context', 'gen'):
+                base_sources = {}
+                base = load_base_context(args, base_sources)
+                targets = []
+                for overlay in load_matrix(args.matrix):
+                    sources = dict(base_sources)
+                    target_dir = os.path.join(output_dir, overlay['K8_NAMESPACE'])
+                    if not os.path.isdir(target_dir):
+                        os.makedirs(target_dir)
+                    targets.append((init_context(args, overlay, base, sources),
+                                    target_dir))
+                    if args.context_sources:
+                        print('\033[32m%s:\033[39m' % overlay['K8_NAMESPACE'])
+                        print_sources(sources)
+            if args.context_sources:
+                return
+            with tracing.span('gen_targets', 'gen', targets=len(targets)):
+                gen_targets(targets, input_dir, incremental=args.incremental,
+                            processes=args.processes, schema_check=args.schema_check)
+        else:
+            with tracing.span('init_context', 'gen'):
+                sources = {}
+                context = init_context(args, sources=sources)
+            if args.context_sources:
+                print_sources(sources)
+                return
+            with tracing.span('gen_jinja', 'gen'):
+                gen_jinja(context, input_dir, output_dir, incremental=args.incremental,
+                          processes=args.processes, schema_check=args.schema_check)
+            if args.bundle:
+                with tracing.span('write_bundle', 'gen'):
+                    digest = write_bundle(output_dir, args.bundle)
+                print('Bundle written: %s (sha256 %s)' % (args.bundle, digest))
+        print(HELPER_CACHE.report())
+    finally:
+        tracing.finish(args.trace)
+
+
+def _env_overrides():
     '''
-    Apply JINJA context overrides from ENV variables
+    The JINJA context overrides from ENV variables, as one context layer
     ENV:  JINJA__<key> = value
           JINJA__<key>__<subkey> = value
     '''
+    layer = {}
     for env_key, env_value in os.environ.items():
         if not env_key.startswith('JINJA__'):
             continue
-        curr_context = context
+        curr_context = layer
         tokens = env_key[7:].split('__')
-        for counter, key in enumerate(tokens):
-            if counter+1 == len(tokens):
-                curr_context[key] = env_value
-                break
-            else:
-                if key not in curr_context:
-                    curr_context[key] = {}
-                curr_context = curr_context[key] # move curr_context pointer
+        for key in tokens[:-1]:
+            curr_context = curr_context.setdefault(key, {})  # move the pointer
+        curr_context[tokens[-1]] = env_value
+    return layer
+
+
+def deep_merge(context, layer, sources=None, name=None, _prefix=''):
+    '''
+    Merges a context layer into context (in place): dicts are merged key by
+    key, any other value replaces what was there.  With sources, records
+    {dotted key: layer name} for every value the layer set.
+    '''
+    for key, value in layer.items():
+        path = '%s%s' % (_prefix, key)
+        if isinstance(value, dict) and isinstance(context.get(key), dict):
+            deep_merge(context[key], value, sources, name, path + '.')
+            continue
+        if sources is not None:
+            if isinstance(context.get(key), dict):
+                for replaced in [k for k in sources if k.startswith(path + '.')]:
+                    del sources[replaced]
+            sources[path] = name
+        context[key] = copy.deepcopy(value)
+
+
+def print_sources(sources):
+    '''
+    Prints which layer supplied each context key (not the values)
+    '''
+    width = max([len(key) for key in sources] or [0])
+    for key in sorted(sources):
+        print('%s  <- %s' % (key.ljust(width), sources[key]))
 
 
-def init_context(args):
+def load_matrix(matrix_file):
+    '''
+    Reads a matrix file: a list of per-namespace context overlays, ie:
+        - {K8_NAMESPACE: tenant-a, UI_HOST: a.example.com}
+        - {K8_NAMESPACE: tenant-b, LDAP_SERVER: ldap-b.example.com}
     '''
-    Initialize the JINJA context from input args
+    with open(matrix_file, 'r') as m_file:
+        overlays = yaml.load(m_file, Loader=YamlLoader) or []
+    namespaces = []
+    for overlay in overlays:
+        if not isinstance(overlay, dict) or not overlay.get('K8_NAMESPACE'):
+            raise AssertionError("Matrix entry without a K8_NAMESPACE: %s" % (overlay,))
+        if overlay['K8_NAMESPACE'] in namespaces:
+            raise AssertionError("Duplicate K8_NAMESPACE in matrix: %s"
+                                 % overlay['K8_NAMESPACE'])
+        namespaces.append(overlay['K8_NAMESPACE'])
+    return overlays
+
+
+def load_base_context(args, sources=None, env_layer=None):
+    '''
+    The part of the JINJA context shared by every namespace.  Layers, lowest
+    precedence first: ENV overrides (so the context files can use them),
+    each of args.context_files, then args.context.  With sources, records
+    the layer that supplied each key (see deep_merge).
     '''
     context = {}
-    # apply JINJA overrides
-    _apply_env_overrides(context)
-
-    # load context from args.context_files
-    if args.context_files:
-        for context_filename in args.context_files:
-            # treat context files as jinja templates too
-            env = _get_jinja_env(os.path.dirname(os.path.abspath(context_filename)))
-            tmplt = env.get_template(os.path.basename(context_filename))
-            context.update(yaml.load(tmplt.render(context), Loader=yaml.SafeLoader))  # JSON/YML supported
+    deep_merge(context, _env_overrides() if env_layer is None else env_layer,
+               sources, 'env')
+
+    # load context from args.context_files -- each rendered as a jinja
+    # template too, with the context so far
+    for context_filename in args.context_files or []:
+        deep_merge(context, CONTEXT_FILES.load(context_filename, context),
+                   sources, context_filename)
     # now overlay context from args.context (if any)
     if args.context:
-        context.update(args.context)
+        deep_merge(context, dict(args.context), sources, '-c')
+    return context
+
+
+def init_context(args, overlay=None, base=None, sources=None):
+    '''
+    Initialize the JINJA context from input args.  Layers, lowest precedence
+    first: load_base_context(), the settings from args, ENV overrides, the
+    per-target overlay, then the derived hosts / URLs (only where missing).
+    For matrix mode, "base" is a load_base_context() result shared by all
+    targets (sources should then start as a copy of its sources).
+    '''
+    env_layer = _env_overrides()
+    context = copy.deepcopy(base) if base is not None else \
+        load_base_context(args, sources, env_layer)
+    overlay = overlay or {}
     # add the well-known context now
-    context['K8_NAMESPACE'] = args.namespace  # set the namespace
-    context['K8_STORAGE_TYPE'] = args.storage_type  # set the storage type
-    context['ENABLE_DEV_SETTINGS'] = args.dev_settings  # set dev settings
-    context['ENABLE_QA_SETTINGS'] = args.qa_settings  # set qa settings
+    deep_merge(context, {
+        'K8_NAMESPACE': args.namespace,  # set the namespace
+        'K8_STORAGE_TYPE': args.storage_type,  # set the storage type
+        'ENABLE_DEV_SETTINGS': args.dev_settings,  # set dev settings
+        'ENABLE_QA_SETTINGS': args.qa_settings,  # set qa settings
+    }, sources, 'args')
 
     # apply JINJA overrides
-    _apply_env_overrides(context)
+    deep_merge(context, env_layer, sources, 'env')
+    # ...then the per-target overlay
+    deep_merge(context, overlay, sources, 'matrix')
+    derived = [key for key in DERIVED_KEYS if key not in context]
 
     # Set the UI_HOST if not already in the context
     if 'UI_HOST' not in context:
         # use fqdn if specified, otherwise use namespace
-        hst = args.fqdn if args.fqdn else args.namespace + ".gravitant.net"
+        hst = args.fqdn if args.fqdn and 'K8_NAMESPACE' not in overlay \
+            else overlay.get('K8_NAMESPACE', args.namespace) + ".gravitant.net"
         context['UI_HOST'] = hst
     # Set the UI_URL if not already in the context
     if 'UI_URL' not in context:
@@ -157,16 +334,106 @@ def init_context(args):
     if 'API_GATEWAY_URL' not in context:
         context['API_GATEWAY_URL'] = ("https://%s:443"
                                       "" % context['GATEWAY_HOST'])
+    if sources is not None:
+        sources.update((key, 'derived') for key in derived)
     return context
 
 
+class HelperCache(object):
+    '''
+    LRU memo for the template helpers, shared by every template (and matrix
+    target) rendered by this process.  File results are keyed by path,
+    size, mtime and inode, so an edited file is re-read.  Values are evicted
+    (least recently used first) once they add up to more than max_bytes.
+    '''
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self.stats = collections.Counter()  # (helper, 'hits' / 'misses') -> count
+        self._entries = collections.OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, helper, key, compute):
+        '''
+        Returns the cached value for key, or compute() (and caches it)
+        '''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats[helper, 'hits'] += 1
+                return self._entries[key][0]
+            self.stats[helper, 'misses'] += 1
+        value = compute()
+        size = len(value or '') + len(str(key))
+        with self._lock:
+            if size <= self.max_bytes and key not in self._entries:
+                self._entries[key] = (value, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    self.size -= self._entries.popitem(last=False)[1][1]
+                    self.evictions += 1
+        return value
+
+    def file(self, helper, path, compute):
+        '''
+        get() for a value computed from the contents of path
+        '''
+        stat = os.stat(path)
+        return self.get(helper, (helper, path, stat.st_size, stat.st_mtime_ns,
+                                 stat.st_ino), compute)
+
+    def take_stats(self):
+        '''
+        Returns (and resets) the hit / miss counts -- ie: to ship a worker
+        process's counts back to its parent
+        '''
+        with self._lock:
+            stats = dict(self.stats)
+            self.stats.clear()
+        return stats
+
+    def add_stats(self, stats):
+        '''
+        Add counts from take_stats()
+        '''
+        with self._lock:
+            self.stats.update(stats)
+
+    def report(self):
+        '''
+        One line summary of hits / misses per helper
+        '''
+        helpers = sorted(set(helper for helper, _ in self.stats))
+        return 'Helper cache: %s; %sKB cached, %s evicted' % (
+            ', '.join('%s %s hits/%s misses' % (
+                helper, self.stats[helper, 'hits'], self.stats[helper, 'misses'])
+                      for helper in helpers) or 'unused',
+            self.size // 1024, self.evictions)
+
+
+HELPER_CACHE = HelperCache()
+
+# from_file escaping, done in a single pass
+_ESCAPES = str.maketrans({'\n': '\\n', '"': '\\"', '\t': '\\t'})
+
+
+def _read_escaped(path):
+    with open(path, "r") as sfile:
+        return sfile.read().translate(_ESCAPES)
+
+
+def _read_base64(path):
+    with open(path, "rb") as sfile:
+        return base64.b64encode(sfile.read()).decode('ascii')
+
+
 def from_file(path):
     '''
     Returns contents of path as a big string.  Newlines are converted to \\n
     '''
-    with open(path, "r") as sfile:
-        return sfile.read().replace('\n', '\\n').replace('"', '\\"')\
-                           .replace('\t', '\\t')
+    _READ_PATHS.add(path)
+    return HELPER_CACHE.file('from_file', path, lambda: _read_escaped(path))
 
 
 def from_file_base64(path):
@@ -174,8 +441,8 @@ def from_file_base64(path):
     Returns contents of path as a big BASE64 encoded-string.
     Good for binary files in Kubernetes Secrets
     '''
-    with open(path, "rb") as sfile:
-        return base64.b64encode(sfile.read()).decode('ascii')
+    _READ_PATHS.add(path)
+    return HELPER_CACHE.file('from_file_base64', path, lambda: _read_base64(path))
 
 
 def base64_decode(b64_encoded_str):
@@ -204,7 +471,8 @@ def sha256(str_to_hash):
     '''
     Generate SHA256 hash of input ASCII str
     '''
-    return hashlib.sha256(str_to_hash.encode('ascii')).hexdigest()
+    return HELPER_CACHE.get('sha256', ('sha256', str_to_hash), lambda: hashlib.sha256(
+        str_to_hash.encode('ascii')).hexdigest())
 
 
 def delete_dir_contents(path):
@@ -219,7 +487,7 @@ def delete_dir_contents(path):
             shutil.rmtree(_file)
 
 
-def _get_jinja_env(input_dir):
+def _get_jinja_env(input_dir, cache_size=400):
     '''
     Sets up the Jinja environment with all the common stuff (filters, etc)
     '''
@@ -227,7 +495,7 @@ def _get_jinja_env(input_dir):
     env = jinja2.Environment(
         loader=jinja2.FileSystemLoader(input_dir),
         undefined=jinja2.StrictUndefined,
-        trim_blocks=True, lstrip_blocks=True)
+        trim_blocks=True, lstrip_blocks=True, cache_size=cache_size)
 
     # register helpers as functions
     env.globals['from_file'] = from_file
@@ -247,37 +515,347 @@ def _get_jinja_env(input_dir):
     return env
 
 
-def gen_jinja(context, input_dir, output_dir):
+def _hash(data):
+    return hashlib.sha256(data if isinstance(data, bytes)
+                          else data.encode('utf-8')).hexdigest()
+
+
+def _read_hash(path):
+    with open(path, 'rb') as sfile:
+        return _hash(sfile.read())
+
+
+def _file_hash(path):
+    try:
+        return HELPER_CACHE.file('file_hash', path, lambda: _read_hash(path))
+    except (IOError, OSError):
+        return None  # missing file -- changes if it appears
+
+
+def _context_hash(context, key):
+    if key not in context:
+        return None
+    return _hash(json.dumps(context[key], sort_keys=True, default=str))
+
+
+def _template_inputs(env, template):
+    '''
+    Returns ({template name: source hash}, set of context keys read) for a
+    template and everything it includes / imports / extends.  Template names
+    computed at render time can't be tracked -- a None name is returned.
+    '''
+    sources = {}
+    keys = set()
+    pending = [template]
+    while pending:
+        name = pending.pop()
+        if name in sources:
+            continue
+        if name is None:
+            sources[None] = None
+            continue
+        source = env.loader.get_source(env, name)[0]
+        digest = sources[name] = _hash(source)
+        if digest not in _SOURCE_INFO:  # shared includes are parsed once
+            ast = env.parse(source)
+            _SOURCE_INFO[digest] = (jinja2.meta.find_undeclared_variables(ast),
+                                    list(jinja2.meta.find_referenced_templates(ast)))
+        keys |= _SOURCE_INFO[digest][0]
+        pending.extend(_SOURCE_INFO[digest][1])
+    return sources, keys - set(env.globals)
+
+
+def _is_fresh(env, entry, context, out_path):
+    # True if out_path exists and was rendered from the same inputs
+    if not entry or 'objects' not in entry or not os.path.exists(out_path):
+        return False
+    return _same_inputs(env, entry, context)
+
+
+def _same_inputs(env, entry, context):
+    # True if the templates, files and context values entry was rendered
+    # from are unchanged
+    if not entry or entry['dynamic']:
+        return False
+    for name, digest in entry['templates'].items():
+        try:
+            if _hash(env.loader.get_source(env, name)[0]) != digest:
+                return False
+        except jinja2.TemplateNotFound:
+            return False
+    return (all(_file_hash(p) == d for p, d in entry['files'].items()) and
+            all(_context_hash(context, k) == d for k, d in entry['context'].items()))
+
+
+def _load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILE), 'r') as m_file:
+            return json.load(m_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_if_changed(path, content):
+    # leave the file (and its mtime) alone if the content is identical
+    if os.path.exists(path):
+        with open(path, 'r') as out_file:
+            if out_file.read() == content:
+                return
+    with open(path, "w") as out_file:
+        out_file.write(content)
+
+
+def _delete_orphans(output_dir, outputs):
+    # remove generated files (and then-empty sub-dirs) we no longer produce
+    for subdir, _dirs, files in os.walk(output_dir, topdown=False):
+        for _file in files:
+            rel = os.path.relpath(os.path.join(subdir, _file), output_dir)
+            if subdir == output_dir and _file.startswith('.'):
+                continue  # our manifest, .gitignore, etc
+            if rel not in outputs:
+                os.remove(os.path.join(subdir, _file))
+        if subdir != output_dir and not os.listdir(subdir):
+            os.rmdir(subdir)
+
+
+def check_schema(doc, template):
+    '''
+    Minimal structural check of a rendered kubernetes object
+    (apiVersion / kind / metadata.name), so errors surface before any
+    cluster call
+    '''
+    if not isinstance(doc, dict):
+        raise AssertionError("%s: document is not a mapping" % template)
+    for key in ('apiVersion', 'kind'):
+        if not isinstance(doc.get(key), str) or not doc[key]:
+            raise AssertionError("%s: missing %s" % (template, key))
+    metadata = doc.get('metadata')
+    if not isinstance(metadata, dict) or not isinstance(metadata.get('name'), str) \
+            or not metadata['name']:
+        raise AssertionError("%s: %s is missing metadata.name" % (template, doc['kind']))
+
+
+def render_each(input_dir, template, contexts):
+    '''
+    Renders a single template from input_dir once per context (compiling it
+    only once), returning the list of rendered strings
+    '''
+    tmplt = _get_jinja_env(input_dir).get_template(template)
+    return [tmplt.render(context) for context in contexts]
+
+
+def _render_template(env, template, context, output_dir, old_entry=None,
+                     schema_check=False):
+    '''
+    Renders (and validates) one template into output_dir, returning its
+    manifest entry -- including the kind/name/namespace of every object
+    in it.  When old_entry shows the inputs are unchanged, nothing is
+    rendered and old_entry is returned.
+    '''
+    tmp_out_full = os.path.join(output_dir, template)
+    tmp_out_split = os.path.split(tmp_out_full)
+    if _is_fresh(env, old_entry, context, tmp_out_full):
+        return old_entry
+    _READ_PATHS.clear()
+    rendered = env.get_template(template).render(context)
+    # verify the JINJA rendered YML/JSON is valid by parsing it (in memory,
+    # before anything is written)
+    objects = []
+    if any(tmp_out_full.endswith(x) for x in ['.yml', '.yaml', '.json']):
+        for doc in yaml.load_all(rendered, Loader=YamlLoader):
+            if doc is None:
+                continue  # empty document
+            if schema_check:
+                check_schema(doc, template)
+            if not isinstance(doc, dict):
+                continue  # parseable, but not a kubernetes object
+            metadata = doc.get('metadata') or {}
+            objects.append({'kind': doc.get('kind'),
+                            'name': metadata.get('name'),
+                            'namespace': metadata.get('namespace')})
+    # create sub-dirs as needed
+    if not os.path.exists(tmp_out_split[0]):
+        os.makedirs(tmp_out_split[0], exist_ok=True)  # make sub-dir
+    # write the jinja rendered output
+    _write_if_changed(tmp_out_full, rendered)
+    if template not in _TEMPLATE_INPUTS:
+        _TEMPLATE_INPUTS[template] = _template_inputs(env, template)
+    sources, keys = _TEMPLATE_INPUTS[template]
+    return {
+        'dynamic': None in sources,
+        'templates': {k: v for k, v in sources.items() if k is not None},
+        'files': {p: _file_hash(p) for p in sorted(_READ_PATHS)},
+        'context': {k: _context_hash(context, k) for k in sorted(keys)},
+        'objects': objects,
+    }
+
+
+class ContextFiles(object):
+    '''
+    Parsed context files.  A context file is a Jinja template too: it is
+    rendered and parsed again only when its source, a file it reads or a
+    context value it uses changed.
+    '''
+    def __init__(self):
+        self._envs = {}  # directory -> Jinja env
+        self._entries = {}  # path -> inputs and parsed value
+        self.stats = collections.Counter()
+
+    def load(self, path, context):
+        '''
+        Returns the parsed (JSON/YML) context file, rendered with context.
+        The value is shared: don't modify it.
+        '''
+        directory, name = os.path.split(os.path.abspath(path))
+        if directory not in self._envs:
+            self._envs[directory] = _get_jinja_env(directory)
+        env = self._envs[directory]
+        entry = self._entries.get(path)
+        if _same_inputs(env, entry, context):
+            self.stats['hits'] += 1
+            return entry['value']
+        self.stats['misses'] += 1
+        _READ_PATHS.clear()
+        value = yaml.load(env.get_template(name).render(context), Loader=YamlLoader)
+        sources, keys = _template_inputs(env, name)
+        self._entries[path] = {
+            'dynamic': None in sources,
+            'templates': {k: v for k, v in sources.items() if k is not None},
+            'files': {p: _file_hash(p) for p in sorted(_READ_PATHS)},
+            'context': {k: _context_hash(context, k) for k in sorted(keys)},
+            'value': value or {},
+        }
+        return value or {}
+
+
+CONTEXT_FILES = ContextFiles()
+
+# Per worker process state for parallel rendering (see _init_worker)
+_WORKER = {}
+
+
+def _init_worker(input_dir, targets, old_manifests, schema_check, trace=False,
+                 cache_bytes=HELPER_CACHE.max_bytes):
+    _WORKER.update(env=_get_jinja_env(input_dir), targets=targets,
+                   old_manifests=old_manifests, schema_check=schema_check)
+    HELPER_CACHE.max_bytes = cache_bytes
+    _TEMPLATE_INPUTS.clear()
+    tracing.enable(trace)
+
+
+def _traced_render(env, template, context, output_dir, old_entry, schema_check):
+    # _render_template, inside a per-template span
+    with tracing.span(template, 'template') as current:
+        entry = _render_template(env, template, context, output_dir, old_entry,
+                                 schema_check)
+        current.set(fresh=entry is old_entry)
+        return entry
+
+
+def _worker_render(work):
+    # runs in a pool worker: returns (target index, template, entry, error,
+    # trace spans, helper cache stats)
+    index, template = work
+    context, output_dir = _WORKER['targets'][index]
+    try:
+        entry, error = _traced_render(
+            _WORKER['env'], template, context, output_dir,
+            _WORKER['old_manifests'][index].get(template),
+            _WORKER['schema_check']), None
+    except Exception:  # pylint: disable=broad-except
+        entry, error = None, traceback.format_exc()
+    return (index, template, entry, error, tracing.drain(),
+            HELPER_CACHE.take_stats())
+
+
+def gen_jinja(context, input_dir, output_dir, incremental=False, processes=1,
+              schema_check=False, env=None):
     '''
     Given the input_dir representing a directory or jinja tempates, render
     all templates into output_dir using the supplied context.
+
+    A manifest of the inputs each output was rendered from (template sources,
+    included templates, files read via from_file*, context values used) is
+    kept in output_dir.  With incremental, only outputs whose inputs changed
+    are rewritten, and orphaned outputs are deleted -- instead of wiping
+    output_dir first.
+
+    With processes > 1 (0 means one per CPU), templates are rendered by a
+    pool of worker processes.  With schema_check, every object must have an
+    apiVersion, kind and metadata.name.  A long running caller can pass the
+    same Jinja env (from _get_jinja_env) each time, so that only templates
+    whose source changed are recompiled.
+
+    Returns the manifest: {output: {..., 'objects': [{kind, name, namespace}]}}
     '''
-    # clear contents of generate directory
-    delete_dir_contents(output_dir)
+    return gen_targets([(context, output_dir)], input_dir, incremental,
+                       processes, schema_check, env)[0]
 
-    # Jinja2 environment
-    env = _get_jinja_env(input_dir)
 
-    # Iterate all templates in the environment
-    for template in env.list_templates(extensions=['yml', 'yaml', 'json', 'start']):
-        tmp_out_full = os.path.join(output_dir, template)
-        tmp_out_split = os.path.split(tmp_out_full)
-        # create sub-dirs as needed
-        if not os.path.exists(tmp_out_split[0]):
-            os.makedirs(tmp_out_split[0])  # make sub-dir
-        # write the jinja rendered output
+def gen_targets(targets, input_dir, incremental=False, processes=1,
+                schema_check=False, env=None):
+    '''
+    Like gen_jinja, for a list of (context, output_dir) targets: every
+    template is compiled once and rendered for each target in turn.
+    Returns the list of manifests (in target order).
+    '''
+    _TEMPLATE_INPUTS.clear()
+    old_manifests = [_load_manifest(output_dir) if incremental else {}
+                     for _context, output_dir in targets]
+    if not incremental:
+        # clear contents of generate directories
+        for _context, output_dir in targets:
+            delete_dir_contents(output_dir)
+
+    # Jinja2 environment (no cache limit -- every template is used per target)
+    env = env or _get_jinja_env(input_dir, cache_size=-1)
+    manifests = [{} for _ in targets]
+    templates = env.list_templates(extensions=['yml', 'yaml', 'json', 'start'])
+    work = [(index, template) for template in templates
+            for index in range(len(targets))]
+    processes = processes or multiprocessing.cpu_count()
+
+    def _failed(index, template):
+        print("** Error with template: %s%s" % (
+            template, ' (%s)' % targets[index][1] if len(targets) > 1 else ''))
+
+    if processes > 1 and len(work) > 1:
+        pool = multiprocessing.Pool(
+            processes, initializer=_init_worker,
+            initargs=(input_dir, targets, old_manifests, schema_check,
+                      tracing.is_enabled(), HELPER_CACHE.max_bytes))
         try:
-            with open(tmp_out_full, "w") as out_file:
-                out_file.write(env.get_template(template).render(context))
-            # verify the JINJA rendered YML/JSON is valid by parsing it
-            if any(tmp_out_full.endswith(x) for x in ['.yml', '.yaml', '.json']):
-                with open(tmp_out_full, 'r') as out_file:
-                    for _ in yaml.load_all(out_file, Loader=yaml.SafeLoader):
-                        # making it this far proves the document is parseable
-                        pass
-        except:
-            print("** Error with template: %s" % template)
-            raise
+            chunksize = max(1, len(work) // (processes * 4))
+            for index, template, entry, error, spans, stats in pool.imap_unordered(
+                    _worker_render, work, chunksize):
+                tracing.merge(spans)
+                HELPER_CACHE.add_stats(stats)
+                if error:
+                    _failed(index, template)
+                    raise AssertionError("Template %s failed to render:\n%s"
+                                         % (template, error))
+                manifests[index][template] = entry
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        # Iterate all templates in the environment
+        for index, template in work:
+            context, output_dir = targets[index]
+            try:
+                manifests[index][template] = _traced_render(
+                    env, template, context, output_dir,
+                    old_manifests[index].get(template), schema_check)
+            except:
+                _failed(index, template)
+                raise
+
+    for (_context, output_dir), manifest in zip(targets, manifests):
+        if incremental:
+            _delete_orphans(output_dir, set(manifest))
+        with open(os.path.join(output_dir, MANIFEST_FILE), 'w') as m_file:
+            json.dump(manifest, m_file, indent=1, sort_keys=True)
+    return manifests
 
 
 if __name__ == "__main__":
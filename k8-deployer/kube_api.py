@@ -0,0 +1,560 @@
+'''
+Minimal in-process Kubernetes API client.
+
+Keeps HTTPS keep-alive connections to the API server open for the lifetime of
+the process, so that hundreds of small calls made during a deploy don't each
+pay for a `kubectl` spawn, a kubeconfig parse, a TLS handshake and API
+discovery.  Only the python standard library (+ pyyaml) is used.
+'''
+
+import atexit
+import base64
+import http.client
+import json
+import os
+import queue
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+import yaml
+
+import tracing
+
+# kind -> (api path prefix, plural, namespaced)
+# Fallback for servers whose discovery can't be read: the group / version a
+# cluster actually serves (ie: Deployments before apps/v1) comes from
+# discovery, read once per client
+RESOURCES = {
+    'ConfigMap': ('/api/v1', 'configmaps', True),
+    'Endpoints': ('/api/v1', 'endpoints', True),
+    'Namespace': ('/api/v1', 'namespaces', False),
+    'PersistentVolume': ('/api/v1', 'persistentvolumes', False),
+    'PersistentVolumeClaim': ('/api/v1', 'persistentvolumeclaims', True),
+    'Pod': ('/api/v1', 'pods', True),
+    'Secret': ('/api/v1', 'secrets', True),
+    'Service': ('/api/v1', 'services', True),
+    'ServiceAccount': ('/api/v1', 'serviceaccounts', True),
+    'CronJob': ('/apis/batch/v1beta1', 'cronjobs', True),
+    'DaemonSet': ('/apis/apps/v1', 'daemonsets', True),
+    'Deployment': ('/apis/apps/v1', 'deployments', True),
+    'Ingress': ('/apis/extensions/v1beta1', 'ingresses', True),
+    'Job': ('/apis/batch/v1', 'jobs', True),
+    'ReplicaSet': ('/apis/apps/v1', 'replicasets', True),
+    'StatefulSet': ('/apis/apps/v1', 'statefulsets', True),
+    'ClusterRole': ('/apis/rbac.authorization.k8s.io/v1', 'clusterroles', False),
+    'ClusterRoleBinding': ('/apis/rbac.authorization.k8s.io/v1',
+                           'clusterrolebindings', False),
+    'Role': ('/apis/rbac.authorization.k8s.io/v1', 'roles', True),
+    'RoleBinding': ('/apis/rbac.authorization.k8s.io/v1', 'rolebindings', True),
+    'CustomResourceDefinition': ('/apis/apiextensions.k8s.io/v1beta1',
+                                 'customresourcedefinitions', False),
+}
+
+# kubectl short names / plurals -> kind
+ALIASES = {
+    'cm': 'ConfigMap', 'ep': 'Endpoints', 'ns': 'Namespace',
+    'pv': 'PersistentVolume', 'pvc': 'PersistentVolumeClaim', 'po': 'Pod',
+    'svc': 'Service', 'sa': 'ServiceAccount', 'cj': 'CronJob',
+    'ds': 'DaemonSet', 'deploy': 'Deployment', 'ing': 'Ingress',
+    'rs': 'ReplicaSet', 'sts': 'StatefulSet', 'crd': 'CustomResourceDefinition',
+}
+
+# kubectl's record of the configuration it last applied: apply removes the
+# fields that were in it but are no longer in the new configuration
+LAST_APPLIED = 'kubectl.kubernetes.io/last-applied-configuration'
+
+# Lists that strategic merge patches merge element by element (not replace),
+# and the field(s) identifying an element
+MERGE_KEYS = {
+    'containers': ('name',), 'initContainers': ('name',), 'env': ('name',),
+    'volumes': ('name',), 'volumeMounts': ('mountPath',),
+    'volumeDevices': ('devicePath',), 'imagePullSecrets': ('name',),
+    'hostAliases': ('ip',), 'ports': ('containerPort', 'port'),
+}
+
+_STATUS_REASONS = {
+    400: 'BadRequest', 401: 'Unauthorized', 403: 'Forbidden', 404: 'NotFound',
+    409: 'AlreadyExists', 410: 'Gone', 422: 'Invalid', 500: 'InternalError',
+}
+
+
+class ApiError(subprocess.CalledProcessError):
+    '''
+    Raised on a failed API call.  Subclasses CalledProcessError (with
+    kubectl-like output) so callers handle both transports the same way.
+    '''
+    def __init__(self, status, method, path, message):
+        reason = _STATUS_REASONS.get(status, 'Unknown')
+        super(ApiError, self).__init__(
+            status, '%s %s' % (method, path),
+            output='Error from server (%s): %s' % (reason, message))
+        self.status = status
+        self.reason = reason
+
+    def __str__(self):
+        return '%s returned HTTP %s: %s' % (self.cmd, self.returncode, self.output)
+
+
+def resolve_kind(resource_type):
+    '''
+    Maps a kubectl style resource type (Job, jobs, pvc, ...) to a Kind
+    '''
+    if resource_type in RESOURCES:
+        return resource_type
+    lowered = resource_type.lower()
+    if lowered in ALIASES:
+        return ALIASES[lowered]
+    for kind, (_prefix, plural, _namespaced) in RESOURCES.items():
+        if lowered in (kind.lower(), plural):
+            return kind
+    return resource_type
+
+
+def with_last_applied(doc):
+    '''
+    Returns a copy of doc annotated with its own configuration (as
+    `kubectl apply` records it)
+    '''
+    metadata = dict(doc.get('metadata') or {})
+    annotations = dict(metadata.get('annotations') or {})
+    annotations.pop(LAST_APPLIED, None)
+    metadata['annotations'] = annotations
+    doc = dict(doc, metadata=metadata)
+    annotations[LAST_APPLIED] = json.dumps(doc, sort_keys=True, separators=(',', ':'),
+                                           default=str)
+    return doc
+
+
+def last_applied(obj):
+    '''
+    Returns the configuration last applied to a live object ({} if unknown)
+    '''
+    annotations = (obj.get('metadata') or {}).get('annotations') or {}
+    try:
+        return json.loads(annotations.get(LAST_APPLIED) or '{}')
+    except ValueError:
+        return {}
+
+
+def _merge_key(field, elements):
+    # the field identifying the elements of a merged list (None: replace it)
+    for key in MERGE_KEYS.get(field, ()):
+        if all(isinstance(e, dict) and key in e for e in elements):
+            return key
+    return None
+
+
+def apply_patch(original, modified, strategic=True, field=None):
+    '''
+    Returns the patch `kubectl apply` would send: modified, plus the removal
+    of every field of original (the configuration last applied) modified no
+    longer has.  Fields set by others (not in original) are left alone.
+    '''
+    if isinstance(original, dict) and isinstance(modified, dict):
+        patch = dict((key, apply_patch(original.get(key), value, strategic, key))
+                     for key, value in modified.items())
+        patch.update((key, None) for key in original if key not in modified)
+        return patch
+    if strategic and isinstance(original, list) and isinstance(modified, list):
+        key = _merge_key(field, original + modified)
+        if key:
+            old = dict((e[key], e) for e in original)
+            kept = set(e[key] for e in modified)
+            return [apply_patch(old.get(e[key]), e, strategic) for e in modified] + \
+                [{key: value, '$patch': 'delete'} for value in old if value not in kept]
+    return modified
+
+
+def _group(prefix):
+    # "/apis/apps/v1" -> "apps" ("" for the core group)
+    parts = prefix.strip('/').split('/')
+    return parts[1] if parts[0] == 'apis' else ''
+
+
+def _write_temp(data):
+    # ssl wants files for client cert/keys; clean them up at exit
+    handle, path = tempfile.mkstemp(prefix='k8-deployer-')
+    with os.fdopen(handle, 'wb') as t_file:
+        t_file.write(data)
+    atexit.register(lambda: os.path.exists(path) and os.remove(path))
+    return path
+
+
+def load_kubeconfig(path, context_name=None):
+    '''
+    Parse a kubeconfig file, returning a dict with: server, ssl_context and
+    headers.  Raises ValueError for auth methods we don't support natively
+    (exec / auth-provider plugins) -- callers should fall back to kubectl.
+    '''
+    with open(path, 'r') as k_file:
+        config = yaml.load(k_file, Loader=yaml.SafeLoader)
+    base_dir = os.path.dirname(os.path.abspath(path))
+
+    def _named(section, name):
+        for entry in config.get(section) or []:
+            if entry['name'] == name:
+                return entry[section[:-1]]
+        raise ValueError('kubeconfig: %s "%s" not found' % (section[:-1], name))
+
+    def _file(value):
+        return value if os.path.isabs(value) else os.path.join(base_dir, value)
+
+    context = _named('contexts', context_name or config['current-context'])
+    cluster = _named('clusters', context['cluster'])
+    user = _named('users', context['user']) if context.get('user') else {}
+
+    if 'exec' in user or 'auth-provider' in user:
+        raise ValueError('kubeconfig: exec/auth-provider users need kubectl')
+
+    headers = {}
+    ssl_context = None
+    server = cluster['server'].rstrip('/')
+    if server.startswith('https'):
+        ssl_context = ssl.create_default_context()
+        if cluster.get('insecure-skip-tls-verify'):
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        elif 'certificate-authority-data' in cluster:
+            ssl_context.load_verify_locations(cadata=base64.b64decode(
+                cluster['certificate-authority-data']).decode('ascii'))
+        elif 'certificate-authority' in cluster:
+            ssl_context.load_verify_locations(
+                cafile=_file(cluster['certificate-authority']))
+        cert = key = None
+        if 'client-certificate-data' in user:
+            cert = _write_temp(base64.b64decode(user['client-certificate-data']))
+        elif 'client-certificate' in user:
+            cert = _file(user['client-certificate'])
+        if 'client-key-data' in user:
+            key = _write_temp(base64.b64decode(user['client-key-data']))
+        elif 'client-key' in user:
+            key = _file(user['client-key'])
+        if cert:
+            ssl_context.load_cert_chain(cert, key)
+
+    if 'token' in user:
+        headers['Authorization'] = 'Bearer %s' % user['token']
+    elif 'tokenFile' in user:
+        with open(_file(user['tokenFile']), 'r') as t_file:
+            headers['Authorization'] = 'Bearer %s' % t_file.read().strip()
+    elif 'username' in user:
+        creds = '%s:%s' % (user['username'], user.get('password', ''))
+        headers['Authorization'] = 'Basic %s' % base64.b64encode(
+            creds.encode('utf-8')).decode('ascii')
+
+    return {'server': server, 'ssl_context': ssl_context, 'headers': headers}
+
+
+class KubeApiClient(object):
+    '''
+    Thread-safe API client holding a pool of keep-alive connections
+    '''
+    def __init__(self, server, ssl_context=None, headers=None, pool_size=8,
+                 timeout=60):
+        parsed = urllib.parse.urlparse(server)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        self.base_path = parsed.path.rstrip('/')
+        self.ssl_context = ssl_context
+        self.headers = dict(headers or {})
+        self.timeout = timeout
+        self.request_count = 0
+        self._count_lock = threading.Lock()
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._discovered = None  # kind -> [(prefix, plural, namespaced)]
+        self._discovery_lock = threading.Lock()
+
+    @classmethod
+    def from_kubeconfig(cls, path, context_name=None, **kwargs):
+        '''
+        Build a client from a kubeconfig file
+        '''
+        config = load_kubeconfig(path, context_name)
+        return cls(config['server'], config['ssl_context'], config['headers'],
+                   **kwargs)
+
+    def _new_connection(self, timeout=None):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(
+                self.host, self.port, context=self.ssl_context,
+                timeout=timeout or self.timeout)
+        return http.client.HTTPConnection(self.host, self.port,
+                                          timeout=timeout or self.timeout)
+
+    def _checkout(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._new_connection()
+
+    def _checkin(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        '''
+        Close all pooled connections
+        '''
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _count(self):
+        with self._count_lock:
+            self.request_count += 1
+
+    def request(self, method, path, body=None, query=None,
+                content_type='application/json'):
+        '''
+        Issue a request on a pooled connection, returning the decoded JSON
+        response.  Raises ApiError on HTTP errors.
+        '''
+        with tracing.span('%s %s' % (method, path), 'http'):
+            return self._request(method, path, body, query, content_type)
+
+    def _request(self, method, path, body, query, content_type):
+        url = self.base_path + path
+        if query:
+            url += '?' + urllib.parse.urlencode(query)
+        headers = dict(self.headers)
+        headers['Accept'] = 'application/json'
+        payload = None
+        if body is not None:
+            payload = json.dumps(body, default=str).encode('utf-8')
+            headers['Content-Type'] = content_type
+
+        for attempt in range(2):
+            conn = self._checkout()
+            try:
+                self._count()
+                conn.request(method, url, body=payload, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                    BrokenPipeError, ConnectionResetError):
+                # stale keep-alive connection -- retry once on a fresh one
+                conn.close()
+                if attempt:
+                    raise
+                tracing.record('reconnect', 'retry', time.time(), 0, {'path': path})
+                continue
+            except Exception:
+                conn.close()
+                raise
+            if response.getheader('Connection', '').lower() == 'close':
+                conn.close()
+            else:
+                self._checkin(conn)
+            break
+
+        result = json.loads(data.decode('utf-8')) if data else {}
+        if response.status >= 400:
+            message = result.get('message') if isinstance(result, dict) else None
+            raise ApiError(response.status, method, path,
+                           message or data.decode('utf-8', 'replace'))
+        return result
+
+    def stream(self, path, query=None, timeout=None):
+        '''
+        Generator yielding decoded JSON lines from a streaming (watch)
+        request.  Uses a dedicated connection that is not returned to the pool.
+        '''
+        url = self.base_path + path
+        if query:
+            url += '?' + urllib.parse.urlencode(query)
+        headers = dict(self.headers)
+        headers['Accept'] = 'application/json'
+        conn = self._new_connection(timeout)
+        try:
+            self._count()
+            conn.request('GET', url, headers=headers)
+            response = conn.getresponse()
+            if response.status >= 400:
+                data = response.read().decode('utf-8', 'replace')
+                raise ApiError(response.status, 'GET', path, data)
+            while True:
+                line = response.readline()
+                if not line:
+                    return
+                line = line.strip()
+                if line:
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            conn.close()
+
+    # ------------------------------------------------------------------
+    # Resource helpers
+    # ------------------------------------------------------------------
+    def _discover(self, refresh=False):
+        # {kind: [(prefix, plural, namespaced)]} of every resource the server
+        # serves -- each group's preferred version first
+        with self._discovery_lock:
+            if self._discovered is not None and not refresh:
+                return self._discovered
+            discovered = {}
+            try:
+                group_paths = ['/api/v1']
+                for group in self.request('GET', '/apis').get('groups', []):
+                    preferred = group['preferredVersion']['groupVersion']
+                    group_paths.extend('/apis/%s' % version for version in [preferred] + [
+                        v['groupVersion'] for v in group.get('versions', [])
+                        if v['groupVersion'] != preferred])
+                for prefix in group_paths:
+                    for resource in self.request('GET', prefix).get('resources', []):
+                        if '/' not in resource['name']:  # not a subresource
+                            discovered.setdefault(resource['kind'], []).append(
+                                (prefix, resource['name'], resource['namespaced']))
+            except ApiError as err:
+                print('\033[33mWarning: API discovery failed (%s), using the'
+                      ' built-in API versions\033[39m' % err)
+            self._discovered = discovered
+            return discovered
+
+    def resource_info(self, resource_type, api_version=None):
+        '''
+        Returns (kind, api path prefix, plural, namespaced) for a resource
+        type, at the version the server prefers (a kind served by several
+        groups keeps to its RESOURCES group where the server has it)
+        '''
+        kind = resolve_kind(resource_type)
+        served = self._discover().get(kind)
+        if not served and kind not in RESOURCES:
+            served = self._discover(refresh=True).get(kind)  # ie: a new CRD
+        if served:
+            group = _group(RESOURCES[kind][0]) if kind in RESOURCES else None
+            prefix, plural, namespaced = next(
+                (info for info in served if _group(info[0]) == group), served[0])
+        elif kind in RESOURCES:
+            prefix, plural, namespaced = RESOURCES[kind]
+        else:
+            raise ApiError(404, 'GET', '/apis',
+                           'the server doesn\'t have a resource type "%s"' % kind)
+        if api_version:  # honour the document's own apiVersion
+            prefix = ('/api/%s' % api_version if '/' not in api_version
+                      else '/apis/%s' % api_version)
+        return kind, prefix, plural, namespaced
+
+    def resource_path(self, namespace, resource_type, name=None,
+                      api_version=None):
+        '''
+        Returns the URL path for a resource (collection if name is None)
+        '''
+        _kind, prefix, plural, namespaced = self.resource_info(resource_type,
+                                                              api_version)
+        path = prefix
+        if namespaced:
+            path += '/namespaces/%s' % urllib.parse.quote(namespace)
+        path += '/%s' % plural
+        if name:
+            path += '/%s' % urllib.parse.quote(name)
+        return path
+
+    def list(self, namespace, resource_type, label_selector=None,
+             field_selector=None):
+        '''
+        Returns the list response (items, metadata.resourceVersion) for a type
+        '''
+        kind = resolve_kind(resource_type)
+        query = {}
+        if label_selector:
+            query['labelSelector'] = label_selector
+        if field_selector:
+            query['fieldSelector'] = field_selector
+        result = self.request('GET', self.resource_path(namespace, kind),
+                              query=query)
+        for item in result.get('items', []):
+            # list items omit their kind and apiVersion
+            item.setdefault('kind', kind)
+            item.setdefault('apiVersion', result.get('apiVersion'))
+        return result
+
+    def get(self, namespace, resource_type, name):
+        '''
+        Returns a single object
+        '''
+        return self.request('GET', self.resource_path(namespace, resource_type,
+                                                      name))
+
+    def delete(self, namespace, resource_type, name):
+        '''
+        Deletes a single object (background propagation, like kubectl)
+        '''
+        return self.request('DELETE', self.resource_path(namespace,
+                                                         resource_type, name),
+                            body={'kind': 'DeleteOptions', 'apiVersion': 'v1',
+                                  'propagationPolicy': 'Background'})
+
+    def delete_collection(self, namespace, resource_type, label_selector=None):
+        '''
+        Deletes all objects of a type in the namespace
+        '''
+        query = {'labelSelector': label_selector} if label_selector else None
+        return self.request('DELETE', self.resource_path(namespace,
+                                                         resource_type),
+                            query=query,
+                            body={'kind': 'DeleteOptions', 'apiVersion': 'v1',
+                                  'propagationPolicy': 'Background'})
+
+    def apply(self, namespace, doc):
+        '''
+        Create the object, or patch the existing one as `kubectl apply` does
+        (see apply_patch).  Returns "created" or "configured" (mirrors
+        `kubectl apply` output).
+        '''
+        return self._apply(namespace, doc)[0]
+
+    def dry_run_apply(self, namespace, doc, exists=None):
+        '''
+        Server-side dry-run of apply(): nothing is changed.  Returns (action,
+        the object as the server would store it).  When the caller knows
+        whether the object exists, pass exists to save the failed create.
+        '''
+        return self._apply(namespace, doc, {'dryRun': 'All'}, exists)
+
+    def _apply(self, namespace, doc, query=None, exists=None):
+        kind = doc['kind']
+        namespace = doc['metadata'].get('namespace', namespace)
+        api_version = doc.get('apiVersion')
+        doc = with_last_applied(doc)
+        if not exists:
+            try:
+                return 'created', self.request(
+                    'POST', self.resource_path(namespace, kind, api_version=api_version),
+                    body=doc, query=query)
+            except ApiError as err:
+                if err.status != 409:
+                    raise
+        path = self.resource_path(namespace, kind, doc['metadata']['name'],
+                                  api_version=api_version)
+        # strategic merge is only understood by built-in kinds
+        strategic = kind in RESOURCES and kind != 'CustomResourceDefinition'
+        patch = apply_patch(last_applied(self.request('GET', path)), doc, strategic)
+        return 'configured', self.request(
+            'PATCH', path, body=patch, query=query,
+            content_type='application/strategic-merge-patch+json' if strategic
+            else 'application/merge-patch+json')
+
+    def watch(self, namespace, resource_type, resource_version=None,
+              field_selector=None, timeout_seconds=300):
+        '''
+        Generator yielding watch events ({"type": ..., "object": ...})
+        '''
+        query = {'watch': 'true', 'timeoutSeconds': str(int(timeout_seconds))}
+        if resource_version:
+            query['resourceVersion'] = resource_version
+        if field_selector:
+            query['fieldSelector'] = field_selector
+        kind = resolve_kind(resource_type)
+        for event in self.stream(self.resource_path(namespace, kind),
+                                 query=query, timeout=timeout_seconds + 30):
+            if isinstance(event.get('object'), dict):
+                event['object'].setdefault('kind', kind)
+            yield event
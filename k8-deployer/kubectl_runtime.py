@@ -0,0 +1,257 @@
+#! /usr/bin/env python
+'''
+kubectl_runtime.py -- picks (and unpacks, once) the kubectl client matching
+the cluster.
+
+The container stages one gzip compressed client per minor version, as
+STAGED_DIR/kubectl_<major.minor>.gz.  The one matching the server is
+unpacked once into RUNTIME_DIR (kept for the container's lifetime), and
+every kubectl call runs it directly.  Server versions are probed once per
+cluster and cached in RUNTIME_DIR for VERSION_TTL seconds.  Without staged
+clients (ie: a workstation), `kubectl` from the PATH is used.
+
+Run as a script, prints the path of the selected client.
+'''
+
+import glob
+import gzip
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import yaml
+
+STAGED_DIR = os.environ.get('K8_KUBECTL_STAGED_DIR', '/usr/local/bin')
+RUNTIME_DIR = os.environ.get('K8_KUBECTL_RUNTIME_DIR', os.path.join(
+    tempfile.gettempdir(), 'k8-deployer-kubectl'))
+VERSION_TTL = int(os.environ.get('K8_VERSION_TTL', 600))
+
+VERSIONS_FILE = 'versions.json'
+MAJOR_MINOR = re.compile(r'^v?(\d+)\.(\d+)')
+# `kubectl version` text output: 'Client Version: version.Info{... GitVersion:"v1.9.6", ...'
+# (old clients) or 'Client Version: v1.9.6'
+VERSION_LINE = re.compile(
+    r'^(Client|Server) Version: (?:version\.Info\{.*GitVersion:"([^"]+)"|(\S+))')
+
+_LOCK = threading.Lock()
+_BINARIES = {}  # kubeconfig -> kubectl client to run
+
+
+def main():
+    '''
+    Print the kubectl client matching $KUBECONFIG's cluster
+    '''
+    print(kubectl_binary())
+
+
+def _kubeconfig(kubeconfig=None):
+    # the (first) kubeconfig file in use
+    kubeconfig = kubeconfig or os.environ.get('KUBECONFIG', '~/.kube/config')
+    return os.path.abspath(os.path.expanduser(kubeconfig.split(os.pathsep)[0]))
+
+
+def major_minor(version):
+    '''
+    "v1.9.6-gke.1" -> "1.9" (None if it isn't a version)
+    '''
+    match = MAJOR_MINOR.match(version or '')
+    return '%s.%s' % match.groups() if match else None
+
+
+def staged_versions():
+    '''
+    Returns the major.minor versions of the staged clients, oldest first
+    '''
+    staged = [os.path.basename(path)[len('kubectl_'):-len('.gz')]
+              for path in glob.glob(os.path.join(STAGED_DIR, 'kubectl_*.gz'))]
+    return sorted((v for v in staged if major_minor(v) == v),
+                  key=lambda v: tuple(int(x) for x in v.split('.')))
+
+
+def unpack(version):
+    '''
+    Returns the path of the (unpacked) staged client for a major.minor
+    version, unpacking it the first time
+    '''
+    target = os.path.join(RUNTIME_DIR, 'kubectl_%s' % version)
+    if os.path.exists(target):
+        return target
+    if not os.path.isdir(RUNTIME_DIR):
+        os.makedirs(RUNTIME_DIR, exist_ok=True)
+    # unpack to a private name, then rename: concurrent deploys never run a
+    # half written client
+    handle, tmp_path = tempfile.mkstemp(prefix='.kubectl_', dir=RUNTIME_DIR)
+    with gzip.open(os.path.join(STAGED_DIR, 'kubectl_%s.gz' % version), 'rb') as packed, \
+            os.fdopen(handle, 'wb') as unpacked:
+        shutil.copyfileobj(packed, unpacked)
+    os.chmod(tmp_path, 0o755)
+    os.replace(tmp_path, target)
+    return target
+
+
+def _closest(version, staged):
+    # the staged version nearest to the server's (kubectl supports one minor
+    # version of skew either way)
+    wanted = tuple(int(x) for x in version.split('.'))
+    return min(staged, key=lambda v: (
+        abs(int(v.split('.')[0]) - wanted[0]), abs(int(v.split('.')[1]) - wanted[1]),
+        -int(v.split('.')[1])))
+
+
+def kubectl_binary(kubeconfig=None):
+    '''
+    Returns the kubectl client to run against kubeconfig's cluster: the
+    staged client matching the server (or $FORCE_KUBECTL_VERSION), unpacked;
+    "kubectl" when no clients are staged
+    '''
+    kubeconfig = _kubeconfig(kubeconfig)
+    with _LOCK:
+        if kubeconfig in _BINARIES:
+            return _BINARIES[kubeconfig]
+    staged = staged_versions()
+    if not staged:
+        binary = 'kubectl'
+    else:
+        version = os.environ.get('FORCE_KUBECTL_VERSION') or major_minor(
+            server_version(kubeconfig))
+        if version not in staged:
+            if not version:
+                raise AssertionError("Unable to determine the kubectl server version")
+            if os.environ.get('FORCE_KUBECTL_VERSION'):
+                raise AssertionError("No staged kubectl for version %s: %s"
+                                     % (version, ', '.join(staged)))
+            closest = _closest(version, staged)
+            print("\033[33mWarning: no kubectl %s staged, using %s\033[39m"
+                  % (version, closest))
+            version = closest
+        binary = unpack(version)
+    with _LOCK:
+        _BINARIES[kubeconfig] = binary
+    return binary
+
+
+def _cluster_key(kubeconfig):
+    # the API server's URL (so kubeconfigs for the same cluster share a
+    # cached version), or the kubeconfig's path
+    try:
+        with open(kubeconfig, 'r') as k_file:
+            config = yaml.load(k_file, Loader=yaml.SafeLoader)
+        context = [c['context'] for c in config['contexts']
+                   if c['name'] == config['current-context']][0]
+        return [c['cluster'] for c in config['clusters']
+                if c['name'] == context['cluster']][0]['server']
+    except (IOError, KeyError, IndexError, TypeError, yaml.YAMLError):
+        return kubeconfig
+
+
+def _load_versions():
+    try:
+        with open(os.path.join(RUNTIME_DIR, VERSIONS_FILE), 'r') as v_file:
+            return json.load(v_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_versions(cache):
+    path = os.path.join(RUNTIME_DIR, VERSIONS_FILE)
+    try:
+        if not os.path.isdir(RUNTIME_DIR):
+            os.makedirs(RUNTIME_DIR, exist_ok=True)
+        with open('%s.%s' % (path, os.getpid()), 'w') as v_file:
+            json.dump(cache, v_file)
+        os.replace('%s.%s' % (path, os.getpid()), path)
+    except (IOError, OSError) as err:
+        print('\033[33mWarning: could not save %s: %s\033[39m' % (path, err))
+
+
+def _kubectl_versions(binary, client_only=False):
+    '''
+    Returns {"client": gitVersion, "server": gitVersion} from `kubectl version`
+    '''
+    args = [binary, 'version'] + (['--client'] if client_only else [])
+    try:
+        output = json.loads(subprocess.check_output(args + ['-o', 'json'],
+                                                    universal_newlines=True))
+        return {'client': (output.get('clientVersion') or {}).get('gitVersion'),
+                'server': (output.get('serverVersion') or {}).get('gitVersion')}
+    except (subprocess.CalledProcessError, ValueError):
+        pass  # a client too old for -o json
+    result = {}
+    for line in subprocess.check_output(args, universal_newlines=True).splitlines():
+        match = VERSION_LINE.match(line.strip())
+        if match:
+            result[match.group(1).lower()] = match.group(2) or match.group(3)
+    return result
+
+
+def _probe_server(kubeconfig, probe_binary):
+    # ask the API server directly; kubectl only for kubeconfigs the API
+    # client can't use
+    from kube_api import KubeApiClient  # pylint: disable=import-outside-toplevel
+    try:
+        client = KubeApiClient.from_kubeconfig(kubeconfig, timeout=30)
+    except (ValueError, KeyError, IOError):
+        if not probe_binary:  # any client will do
+            staged = staged_versions()
+            probe_binary = unpack(staged[-1]) if staged else 'kubectl'
+        return _kubectl_versions(probe_binary).get('server')
+    try:
+        return client.request('GET', '/version')['gitVersion']
+    finally:
+        client.close()
+
+
+def server_version(kubeconfig=None, ttl=VERSION_TTL, probe_binary=None):
+    '''
+    Returns the API server's gitVersion ("v1.9.6"), probed at most once
+    every ttl seconds per cluster
+    '''
+    kubeconfig = _kubeconfig(kubeconfig)
+    key = 'server %s' % _cluster_key(kubeconfig)
+    cached = _load_versions().get(key)
+    if cached and time.time() - cached['probed'] < ttl:
+        return cached['version']
+    version = _probe_server(kubeconfig, probe_binary)
+    cache = _load_versions()
+    cache[key] = {'version': version, 'probed': time.time()}
+    _save_versions(cache)
+    return version
+
+
+def client_version(binary):
+    '''
+    Returns a kubectl client's gitVersion, probed once per client (and
+    cached until it changes)
+    '''
+    path = shutil.which(binary) or binary
+    try:
+        stat = os.stat(path)
+    except OSError as err:
+        raise AssertionError("Unable to find the kubectl client %s (is it on the PATH?)"
+                             % binary) from err
+    key = 'client %s %s %s' % (path, stat.st_size, stat.st_mtime_ns)
+    cached = _load_versions().get(key)
+    if cached:
+        return cached['version']
+    version = _kubectl_versions(path, client_only=True).get('client')
+    cache = _load_versions()
+    cache[key] = {'version': version, 'probed': time.time()}
+    _save_versions(cache)
+    return version
+
+
+def versions(kubeconfig=None):
+    '''
+    Returns (client, server) gitVersions for kubeconfig's cluster, from the
+    cache where possible
+    '''
+    binary = kubectl_binary(kubeconfig)
+    return client_version(binary), server_version(kubeconfig, probe_binary=binary)
+
+
+if __name__ == "__main__":
+    main()
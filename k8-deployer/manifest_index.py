@@ -0,0 +1,352 @@
+'''
+Parse-once index of a generated template directory.
+
+Every document of every .yml / .yaml / .json file is recorded once: kind,
+name, namespace, file, offsets and content hash.  The parsed .depend.start
+files are kept too.  The index is saved in the template directory (as
+INDEX_FILE) and only files whose mtime or size changed are parsed again.
+
+A template directory can also be packed into a bundle: one file holding the
+index and every file's content (stored once per distinct content, addressed
+by its sha256).  A bundle is read through mmap -- one open, no directory
+walk -- and can be used wherever a template directory is.
+'''
+
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import yaml
+
+from utils import stamp_content_hash, stamp_ownership
+
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Saved in the template directory -- no .json extension, so `kubectl apply`
+# and the directory walks never mistake it for a kubernetes file
+INDEX_FILE = '.manifest-index'
+INDEX_VERSION = 1
+
+TEMPLATE_EXTENSIONS = ('.yml', '.yaml', '.json')
+DEPEND_START = '.depend.start'
+
+# Bundle layout: BUNDLE_MAGIC, the index's length (8 bytes, big endian), the
+# index (JSON), then the file contents
+BUNDLE_MAGIC = b'K8BUNDLE\n'
+BUNDLE_VERSION = 1
+
+
+def read_depend_start(depend_start_path):
+    '''
+    Parses a .depend.start file into [(file, [files it depends on])].
+    Entries are applied (and waited on) in list order:
+      - a.yml                 -- after every entry above it
+      - [b.yml, c.yml]        -- in parallel, after every entry above them
+      - d.yml: [a.yml]        -- only after the listed files
+    '''
+    with open(depend_start_path, "r") as d_file:
+        entries = yaml.load(d_file, Loader=yaml.SafeLoader) or []
+    result = []
+    seen = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            result.extend((f_name, list(deps or [])) for f_name, deps in entry.items())
+            seen.extend(entry)
+        else:
+            group = entry if isinstance(entry, list) else [entry]
+            result.extend((f_name, list(seen)) for f_name in group)
+            seen.extend(group)
+    return result
+
+
+def scan_file(path):
+    '''
+    Returns [{kind, name, namespace, offset, end, hash}] for every document
+    of a file.  offset / end are character positions of the document in the
+    file; hash is its content hash as apply stamps it.
+    '''
+    with open(path, 'r') as k_file:
+        text = k_file.read()
+    loader = YamlLoader(text)
+    documents = []
+    try:
+        while loader.check_node():
+            node = loader.get_node()
+            doc = loader.construct_document(node)
+            if not isinstance(doc, dict):
+                continue  # empty document
+            metadata = doc.get('metadata') or {}
+            documents.append({
+                'kind': doc.get('kind'),
+                'name': metadata.get('name'),
+                'namespace': metadata.get('namespace'),
+                'offset': node.start_mark.index,
+                'end': node.end_mark.index,
+                'hash': stamp_content_hash(stamp_ownership(doc)),
+            })
+    finally:
+        loader.dispose()
+    return documents
+
+
+def is_bundle(path):
+    '''
+    True if path is a bundle (see write_bundle)
+    '''
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as b_file:
+        return b_file.read(len(BUNDLE_MAGIC)) == BUNDLE_MAGIC
+
+
+def write_bundle(template_dir, bundle_path):
+    '''
+    Packs a template directory (its templates and .depend.start files) into
+    one bundle file.  The same files always give the same bundle.  Returns
+    the bundle's sha256.
+    '''
+    index = ManifestIndex.load(template_dir)
+    files = {}
+    blobs = {}  # sha256 -> [offset, length]
+    contents = []
+    offset = 0
+    for rel in sorted(index.files):
+        data = index.read(os.path.join(index.template_dir, rel)).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in blobs:
+            blobs[digest] = [offset, len(data)]
+            contents.append(data)
+            offset += len(data)
+        files[rel] = dict((k, v) for k, v in index.files[rel].items()
+                          if k not in ('mtime', 'size'))
+        files[rel]['blob'] = digest
+    header = json.dumps({'version': BUNDLE_VERSION, 'files': files, 'blobs': blobs},
+                        sort_keys=True).encode('utf-8')
+    bundle_hash = hashlib.sha256()
+    with open(bundle_path + '.tmp', 'wb') as b_file:
+        for chunk in [BUNDLE_MAGIC, struct.pack('>Q', len(header)), header] + contents:
+            b_file.write(chunk)
+            bundle_hash.update(chunk)
+    os.replace(bundle_path + '.tmp', bundle_path)
+    return bundle_hash.hexdigest()
+
+
+class TemplateFiles(object):
+    '''
+    Reads the generated files -- here, straight from the filesystem
+    '''
+    def exists(self, path):
+        '''
+        True if the file or directory exists
+        '''
+        return os.path.exists(path)
+
+    def isdir(self, path):
+        '''
+        True if path is a directory
+        '''
+        return os.path.isdir(path)
+
+    def templates_in(self, path):
+        '''
+        Returns the files `kubectl apply -f <dir>` would pick up (it doesn't
+        recurse)
+        '''
+        return sorted(f for f in glob.glob(os.path.join(path, '*'))
+                      if f.endswith(TEMPLATE_EXTENSIONS))
+
+    def read(self, path):
+        '''
+        Returns a file's content
+        '''
+        with open(path, 'r') as k_file:
+            return k_file.read()
+
+
+class ManifestIndex(TemplateFiles):
+    '''
+    The documents of a template directory: {relative path: file record}
+    '''
+    def __init__(self, template_dir, files):
+        self.template_dir = os.path.abspath(template_dir)
+        self.files = files
+
+    @classmethod
+    def load(cls, template_dir):
+        '''
+        Returns the index of template_dir, re-parsing only the files changed
+        since it was last saved (and saving it again if any were).  For a
+        bundle, returns its BundleIndex.
+        '''
+        if is_bundle(template_dir):
+            return BundleIndex(template_dir)
+        template_dir = os.path.abspath(template_dir)
+        index_path = os.path.join(template_dir, INDEX_FILE)
+        try:
+            with open(index_path, 'r') as i_file:
+                saved = json.load(i_file)
+            if saved.get('version') != INDEX_VERSION:
+                saved = {}
+        except (IOError, ValueError):
+            saved = {}
+        old_files = saved.get('files') or {}
+        files = {}
+        for subdir, _dirs, names in os.walk(template_dir):
+            for name in names:
+                if not name.endswith(TEMPLATE_EXTENSIONS) and name != DEPEND_START:
+                    continue
+                full = os.path.join(subdir, name)
+                rel = os.path.relpath(full, template_dir)
+                stat = os.stat(full)
+                record = old_files.get(rel)
+                if not record or record['mtime'] != stat.st_mtime_ns or \
+                        record['size'] != stat.st_size:
+                    record = {'mtime': stat.st_mtime_ns, 'size': stat.st_size}
+                    if name == DEPEND_START:
+                        record['depend_start'] = [list(e) for e in read_depend_start(full)]
+                    else:
+                        record['documents'] = scan_file(full)
+                files[rel] = record
+        index = cls(template_dir, files)
+        if files != old_files:
+            index.save()
+        return index
+
+    def save(self):
+        '''
+        Write the index to the template directory (if it's writable)
+        '''
+        index_path = os.path.join(self.template_dir, INDEX_FILE)
+        try:
+            with open(index_path + '.tmp', 'w') as i_file:
+                json.dump({'version': INDEX_VERSION, 'files': self.files}, i_file)
+            os.replace(index_path + '.tmp', index_path)
+        except (IOError, OSError) as err:
+            print('\033[33mWarning: could not save %s: %s\033[39m' % (index_path, err))
+
+    def _relative(self, path):
+        # a file's path (absolute, or relative to the cwd) -> its index key
+        return os.path.relpath(os.path.abspath(path), self.template_dir)
+
+    def documents(self, kind=None, path=None):
+        '''
+        Returns every document (a dict, with its "file") -- optionally only
+        of one kind, and / or in one file or directory relative to the
+        template directory ("storage/")
+        '''
+        files = sorted(self.files)
+        if path is not None:
+            rel_path = os.path.normpath(path)
+            if self.isdir(os.path.join(self.template_dir, rel_path)):
+                prefix = '' if rel_path == '.' else rel_path + os.sep
+                files = [f for f in files if f.startswith(prefix)]
+            else:
+                files = [f for f in files if f == rel_path]
+        result = []
+        for rel in files:
+            for doc in self.files[rel].get('documents', []):
+                if kind is None or doc['kind'] == kind:
+                    result.append(dict(doc, file=rel))
+        return result
+
+    def objects_in(self, path):
+        '''
+        Returns the documents of one file (its path, not relative to the
+        template directory), or None if it isn't indexed
+        '''
+        record = self.files.get(self._relative(path))
+        if record is None or 'documents' not in record:
+            return None
+        return [dict(doc, file=self._relative(path)) for doc in record['documents']]
+
+    def depend_start(self, path):
+        '''
+        Returns the parsed .depend.start file (see read_depend_start), or None
+        if it isn't indexed
+        '''
+        record = self.files.get(self._relative(path))
+        if record is None or 'depend_start' not in record:
+            return None
+        return [(f_name, deps) for f_name, deps in record['depend_start']]
+
+    def resources(self):
+        '''
+        Returns {kind: [names]} of every document
+        '''
+        result = {}
+        for doc in self.documents():
+            result.setdefault(doc['kind'], []).append(doc['name'])
+        return result
+
+    def load_document(self, doc):
+        '''
+        Parses just one (indexed) document
+        '''
+        text = self.read(os.path.join(self.template_dir, doc['file']))
+        return yaml.load(text[doc['offset']:doc['end']], Loader=YamlLoader)
+
+
+class BundleIndex(ManifestIndex):
+    '''
+    The documents of a bundle, its files read through mmap.  Paths are those
+    of the packed template directory, with the bundle in its place.
+    '''
+    def __init__(self, bundle_path):
+        with open(bundle_path, 'rb') as b_file:
+            self._map = mmap.mmap(b_file.fileno(), 0, access=mmap.ACCESS_READ)
+        start = len(BUNDLE_MAGIC) + 8
+        if self._map[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+            raise AssertionError("Not a bundle: %s" % bundle_path)
+        length = struct.unpack('>Q', self._map[len(BUNDLE_MAGIC):start])[0]
+        index = json.loads(self._map[start:start + length].decode('utf-8'))
+        if index.get('version') != BUNDLE_VERSION:
+            raise AssertionError("Unsupported bundle version %s: %s"
+                                 % (index.get('version'), bundle_path))
+        self._data = start + length
+        self._blobs = index['blobs']
+        ManifestIndex.__init__(self, bundle_path, index['files'])
+
+    @classmethod
+    def load(cls, template_dir):
+        return cls(template_dir)
+
+    def save(self):
+        '''
+        Bundles are read only
+        '''
+
+    def close(self):
+        '''
+        Unmap the bundle
+        '''
+        self._map.close()
+
+    def _children(self, path):
+        # relative paths of the packed files under a directory
+        rel = self._relative(path)
+        if rel == '.':
+            return list(self.files)
+        return [f for f in self.files if f.startswith(rel + os.sep)]
+
+    def exists(self, path):
+        return self._relative(path) in self.files or self.isdir(path)
+
+    def isdir(self, path):
+        return bool(self._children(path))
+
+    def templates_in(self, path):
+        rel = self._relative(path)
+        prefix = '' if rel == '.' else rel + os.sep
+        names = [f[len(prefix):] for f in self._children(path)]
+        return sorted(os.path.join(path, name) for name in names
+                      if os.sep not in name and not name.startswith('.') and
+                      name.endswith(TEMPLATE_EXTENSIONS))
+
+    def read(self, path):
+        record = self.files.get(self._relative(path))
+        if record is None:
+            raise IOError("No such file in %s: %s" % (self.template_dir, path))
+        offset, length = self._blobs[record['blob']]
+        return self._map[self._data + offset:self._data + offset + length].decode('utf-8')
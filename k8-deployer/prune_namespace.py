@@ -4,42 +4,49 @@ should not exist.
 '''
 
 import os
-import yaml
 
-from utils import all_resource_names, run_kubecmd
+import cluster_cache
+from manifest_index import ManifestIndex, is_bundle
+from utils import run_kubecmd
 
-def _get_current_state(namespace):
-    # dictionary where:
-    #   key: kubernetes resource type (Kubernetes Kind)
-    # value: list of names of resources in the namespace
-    return {
-        'ConfigMap': all_resource_names(namespace, 'ConfigMap'),
-        'Deployment': all_resource_names(namespace, 'Deployment'),
-        'Job': all_resource_names(namespace, 'Job'),
-        'PersistentVolumeClaim': all_resource_names(namespace, 'PersistentVolumeClaim'),
-        'Secret': [l for l in all_resource_names(namespace, 'Secret')
-                   if not l.startswith('default-token')],
-        'Service': [l for l in all_resource_names(namespace, 'Service')
-                    if not l.startswith('glusterfs')]
-    }
+# Kinds always inventoried, even once no template defines them any more.
+# Other kinds (found in the templates) are only pruned when labelled as ours.
+DEFAULT_KINDS = ['ConfigMap', 'Deployment', 'Job', 'PersistentVolumeClaim',
+                 'Secret', 'Service']
+
+# Cluster scoped kinds -- never pruned from a namespace
+CLUSTER_KINDS = ['ClusterRole', 'ClusterRoleBinding', 'CustomResourceDefinition',
+                 'Namespace', 'PersistentVolume', 'StorageClass']
+
+
+def _is_system_object(kind, name):
+    # objects kubernetes creates in every namespace by itself
+    return ((kind == 'Secret' and name.startswith('default-token')) or
+            (kind == 'Service' and name.startswith('glusterfs')) or
+            (kind == 'ServiceAccount' and name == 'default') or
+            (kind == 'ConfigMap' and name == 'kube-root-ca.crt'))
 
 
-def _get_template_resources(template_dir):
+def _get_current_state(namespace, kinds=None, owned_only=False):
     # dictionary where:
-    #   key: kubernetes resource type
+    #   key: kubernetes resource type (Kubernetes Kind)
     # value: list of names of resources in the namespace
-    result = {}
-    for subdir, _dirs, files in os.walk(template_dir):
-        for file in files:
-            if file.endswith('.yaml') or file.endswith('.yml') or file.endswith('.json'):
-                with open(os.path.join(subdir, file), 'r') as k_file:
-                    docs = yaml.safe_load_all(k_file)
-                    for doc in docs:
-                        kind = doc['kind']
-                        name = doc['metadata']['name']
-                        if kind not in result:
-                            result[kind] = []
-                        result[kind].append(name)
+    # Read from the namespace's cache (each kind listed at most once per run)
+    kinds = sorted(set(kinds or DEFAULT_KINDS) - set(CLUSTER_KINDS))
+    cache = cluster_cache.for_namespace(namespace)
+    result = {kind: [] for kind in kinds}
+    for kind in kinds:
+        for name, item in sorted(cache.objects(kind).items()):
+            metadata = item['metadata']
+            if metadata.get('namespace') != namespace:
+                continue  # cluster scoped (ie: a custom resource)
+            if metadata.get('ownerReferences'):
+                continue  # managed by a controller (ie: a CronJob's Jobs)
+            if (owned_only or kind not in DEFAULT_KINDS) and \
+                    not cluster_cache.is_owned(item):
+                continue
+            if not _is_system_object(kind, name):
+                result[kind].append(name)
     return result
 
 
@@ -57,22 +64,36 @@ def _diff(current, expected):
     result = {k:v for (k, v) in result.items() if v} # remove empties
     return result
 
-def prune_namespace(namespace, template_dir, dry_run=False):
+def extraneous(namespace, template_dir, owned_only=False, index=None):
+    '''
+    Returns {kind: [names]} of the objects in the namespace that are not
+    defined in template_dir (what prune_namespace would delete)
+    '''
+    if not os.path.isdir(template_dir) and not is_bundle(template_dir):
+        raise AssertionError("Path either does not exist, or is not a directory"
+                             " (or bundle): %s" % template_dir)
+    expected_state = (index or ManifestIndex.load(template_dir)).resources()
+    current_state = _get_current_state(
+        namespace, DEFAULT_KINDS + list(expected_state), owned_only)
+    return _diff(current_state, expected_state)
+
+
+def prune_namespace(namespace, template_dir, dry_run=False, owned_only=False,
+                    index=None):
     '''
     Compare the k8-namespace to what is defined in template_dir, report
-    on (and optionally auto_prune) objects that should not exist in the namespace
+    on (and optionally auto_prune) objects that should not exist in the namespace.
+    With owned_only, only objects carrying our ownership label are considered.
+    index is template_dir's ManifestIndex (loaded here if not given).
     '''
-    if not os.path.isdir(template_dir):
-        raise AssertionError("Path either does not exist, or is not a directory: %s"
-                             % template_dir)
-    current_state = _get_current_state(namespace)
-    expected_state = _get_template_resources(template_dir)
-    diff = _diff(current_state, expected_state)
+    diff = extraneous(namespace, template_dir, owned_only, index)
     for res_type, resources in diff.items():
         if dry_run:
             print("\033[31mFound extraneous %s records: %s.  These should be "
                   " removed...\033[39m" % (res_type, resources))
         else:
-            for resource in resources:
-                print("\033[33mDeleting extraneous %s: %s ...\033[39m" % (res_type, resource))
-                run_kubecmd(namespace, ['delete', res_type, resource])
+            # one delete call per kind (objects already gone, ie: on a retry, are fine)
+            print("\033[33mDeleting extraneous %s: %s ...\033[39m" % (res_type, resources))
+            run_kubecmd(namespace, ['delete', res_type, '--ignore-not-found'] +
+                        sorted(resources))
+            cluster_cache.invalidate(namespace, res_type, resources)
@@ -0,0 +1,272 @@
+'''
+Watch driven readiness checks.
+
+Rather than sleeping and scraping `kubectl describe` output, read each
+object's structured `status` from the namespace's watch driven cache,
+re-evaluating the moment anything changes.  All waits are bounded by a
+deadline.
+'''
+
+import sys
+import time
+
+import cluster_cache
+from tracing import span
+
+# Longest wait for a change before re-checking anyway (bounds how late a
+# time-based check, like a Job that never starts, can be noticed)
+RECHECK = 10
+
+# Most objects listed on the progress line
+PROGRESS_NAMES = 4
+
+
+def _observed(obj):
+    # True once the controller has seen the latest spec
+    status = obj.get('status') or {}
+    return status.get('observedGeneration', 0) >= obj['metadata'].get('generation', 0)
+
+
+def _rolling_update(obj):
+    # OnDelete updates only happen when pods are deleted: nothing to wait on
+    strategy = (obj.get('spec') or {}).get('updateStrategy') or {}
+    return strategy.get('type', 'RollingUpdate') == 'RollingUpdate'
+
+
+def deployment_ready(obj):
+    '''
+    True once the latest Deployment spec is rolled out and fully available
+    '''
+    spec = obj.get('spec') or {}
+    status = obj.get('status') or {}
+    desired = spec.get('replicas', 1)
+    if not _observed(obj):
+        return False  # controller hasn't seen the latest spec yet
+    return (status.get('updatedReplicas', 0) >= desired and
+            status.get('availableReplicas', 0) >= desired and
+            status.get('replicas', 0) == status.get('updatedReplicas', 0))
+
+
+def statefulset_ready(obj):
+    '''
+    True once the latest StatefulSet spec is rolled out (up to its
+    partition) and every replica is ready
+    '''
+    spec = obj.get('spec') or {}
+    status = obj.get('status') or {}
+    if not _rolling_update(obj):
+        return _observed(obj)
+    desired = spec.get('replicas', 1)
+    if not _observed(obj) or status.get('readyReplicas', 0) < desired:
+        return False
+    partition = ((spec.get('updateStrategy') or {}).get('rollingUpdate') or {}).get(
+        'partition', 0)
+    if partition:
+        return status.get('updatedReplicas', 0) >= desired - partition
+    return status.get('updateRevision') == status.get('currentRevision')
+
+
+def daemonset_ready(obj):
+    '''
+    True once the latest DaemonSet spec is running, and available, on
+    every node it's scheduled to
+    '''
+    status = obj.get('status') or {}
+    if not _observed(obj):
+        return False
+    if not _rolling_update(obj):
+        return True
+    desired = status.get('desiredNumberScheduled', 0)
+    return (status.get('updatedNumberScheduled', 0) >= desired and
+            status.get('numberAvailable', 0) >= desired)
+
+
+def replicaset_ready(obj):
+    '''
+    True once a ReplicaSet's latest spec is observed and all its replicas
+    are available
+    '''
+    status = obj.get('status') or {}
+    desired = (obj.get('spec') or {}).get('replicas', 1)
+    return (_observed(obj) and status.get('readyReplicas', 0) >= desired and
+            status.get('availableReplicas', 0) >= desired)
+
+
+def job_started(obj):
+    '''
+    True once a Job has (or had) any pods
+    '''
+    status = obj.get('status') or {}
+    return any(status.get(x) for x in ('active', 'succeeded', 'failed'))
+
+
+def job_done(obj):
+    '''
+    True once a Job has completed.  If the Job fails, an AssertionError is
+    raised.
+    '''
+    status = obj.get('status') or {}
+    active = status.get('active', 0)
+    succeeded = status.get('succeeded', 0)
+    failed = status.get('failed', 0)
+    conditions = {c['type']: c['status'] for c in status.get('conditions') or []}
+    if conditions.get('Failed') == 'True' or (
+            active == 0 and succeeded == 0 and failed != 0):
+        raise AssertionError("Job %s failed.  Running: %s, Succeeded: %s, Failed: %s" %
+                             (obj['metadata']['name'], active, succeeded, failed))
+    if conditions.get('Complete') == 'True':
+        return True
+    return active == 0 and succeeded >= (obj.get('spec') or {}).get('completions', 1)
+
+
+def pvc_bound(obj):
+    '''
+    True once a PersistentVolumeClaim is Bound
+    '''
+    return (obj.get('status') or {}).get('phase') == 'Bound'
+
+
+def wait_for(namespace, kind, predicate, timeout, names=None, description=None):
+    '''
+    Waits (up to "timeout" seconds) until predicate(obj) is True for every
+    named object of "kind" -- or for every object of "kind" when names is
+    None.  Missing objects count as not ready.
+    '''
+    description = description or '%s %s' % (kind, ', '.join(names or ['(all)']))
+    with span('wait %s' % description, 'wait'):
+        _wait_for(namespace, kind, predicate, timeout, names, description)
+
+
+def _wait_for(namespace, kind, predicate, timeout, names, description):
+    cache = cluster_cache.for_namespace(namespace)
+    deadline = time.time() + timeout
+    waiting = False
+    while True:
+        state, seen = cache.snapshot(kind, names)
+        pending = _pending(state, names, predicate)
+        if not pending or time.time() >= deadline:
+            break
+        if not waiting:
+            waiting = True
+            print("\033[33mWaiting on %s in %s..." % (description, namespace))
+        if cache.wait_change(kind, seen, min(deadline - time.time(), RECHECK)):
+            sys.stdout.write('.')
+            sys.stdout.flush()
+    if waiting:
+        print('\033[39m')  # Write the newline / clear colors
+    if pending:
+        raise AssertionError("Condition not met for %s in %s: %s" %
+                             (description, namespace, sorted(pending)))
+
+
+def _pending(state, names, predicate):
+    # names of objects that are missing or not (yet) ready
+    missing = [n for n in names if n not in state] if names else []
+    return missing + [n for n, obj in state.items() if not predicate(obj)]
+
+
+def _job_waiter(start_timeout):
+    # job_done, failing once the Job hasn't started any pods after
+    # start_timeout seconds
+    started = time.time()
+
+    def _done(obj):
+        if job_done(obj):
+            return True
+        if not job_started(obj) and time.time() - started > start_timeout:
+            raise AssertionError("Job %s refuses to start after %smin."
+                                 % (obj['metadata']['name'], start_timeout // 60))
+        return False
+    return _done
+
+
+# kind -> (readiness predicate, or a factory of one given the Job start
+#          timeout; default timeout in seconds)
+ROLLOUTS = {
+    'Deployment': (deployment_ready, 600),
+    'StatefulSet': (statefulset_ready, 600),
+    'DaemonSet': (daemonset_ready, 600),
+    'ReplicaSet': (replicaset_ready, 600),
+    'CronJob': (lambda obj: True, 600),  # nothing to roll out: ready once it exists
+    'Job': (_job_waiter, 5 * 3600),
+}
+
+
+def wait_rollout(namespace, objects, timeout=None, start_timeout=600):
+    '''
+    Waits on every (kind, name) in objects at once -- kinds from ROLLOUTS --
+    until all are ready, showing one progress line.  Each object may take
+    its kind's default timeout (or "timeout" seconds); the wait fails as
+    soon as any object runs out of time, or a Job fails.
+    '''
+    objects = sorted(set(objects))
+    if not objects:
+        return
+    with span('wait rollout %s' % ', '.join('%s/%s' % o for o in objects[:PROGRESS_NAMES]),
+              'wait', objects=len(objects)):
+        _wait_rollout(namespace, objects, timeout, start_timeout)
+
+
+def _wait_rollout(namespace, objects, timeout, start_timeout):
+    cache = cluster_cache.for_namespace(namespace)
+    started = time.time()
+    predicates = {kind: ROLLOUTS[kind][0](start_timeout) if kind == 'Job'
+                  else ROLLOUTS[kind][0] for kind in set(k for k, _ in objects)}
+    deadlines = {obj: started + (timeout or ROLLOUTS[obj[0]][1]) for obj in objects}
+    names = {}
+    for kind, name in objects:
+        names.setdefault(kind, []).append(name)
+    progress = None
+    try:
+        while True:
+            pending = []
+            seen = {}
+            for kind in sorted(names):
+                state, seen[kind] = cache.snapshot(kind, names[kind])
+                pending.extend((kind, n) for n in _pending(state, names[kind],
+                                                           predicates[kind]))
+            if not pending:
+                return
+            now = time.time()
+            expired = [obj for obj in pending if now >= deadlines[obj]]
+            if expired:
+                raise AssertionError("Rollout not complete in %s: %s" % (namespace, ', '.join(
+                    '%s/%s' % obj for obj in sorted(expired))))
+            progress = _show_progress(progress, namespace, sorted(pending), len(objects),
+                                      now - started)
+            cache.wait_any_change(seen, min(min(deadlines[obj] for obj in pending) - now,
+                                            RECHECK))
+    finally:
+        if progress is not None:
+            print('\033[39m')  # end the progress line / clear colors
+
+
+def _show_progress(last, namespace, pending, total, elapsed):
+    # (re)writes the progress line -- in place on a terminal, otherwise
+    # only when what's pending changed.  Returns what's pending.
+    line = 'Waiting on %s/%s in %s (%ds): %s%s' % (
+        len(pending), total, namespace, elapsed,
+        ', '.join('%s/%s' % (kind.lower(), name) for kind, name in pending[:PROGRESS_NAMES]),
+        ' ...' if len(pending) > PROGRESS_NAMES else '')
+    if sys.stdout.isatty():
+        sys.stdout.write('\r\033[33m%s\033[K' % line)
+    elif pending != last:
+        sys.stdout.write('%s\033[33m%s' % ('' if last is None else '\n', line))
+    sys.stdout.flush()
+    return pending
+
+
+def wait_job(namespace, name, timeout=5*3600, start_timeout=600):
+    '''
+    Wait for a Job to complete (default: 5 hours).  Fails if the Job fails,
+    or if it hasn't started any pods after start_timeout seconds.
+    '''
+    wait_for(namespace, 'Job', _job_waiter(start_timeout), timeout, names=[name])
+
+
+def wait_pvcs_bound(namespace, timeout=600):
+    '''
+    Wait for all PersistentVolumeClaims in the namespace to be Bound
+    '''
+    wait_for(namespace, 'PersistentVolumeClaim', pvc_bound, timeout,
+             description='all PersistentVolumeClaims (PVCs) to be bound')
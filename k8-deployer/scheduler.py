@@ -0,0 +1,103 @@
+'''
+Tiny dependency-graph scheduler -- runs named actions on a bounded thread
+pool, starting each one as soon as everything it depends on has finished.
+'''
+
+import concurrent.futures
+
+from tracing import span
+
+
+class Scheduler(object):
+    '''
+    DAG of named actions.  Nodes without a path between them run
+    concurrently (up to max_workers at a time); ready nodes start in the
+    order they were added, so max_workers=1 is a plain topological walk.
+    '''
+    def __init__(self, max_workers=1):
+        self.max_workers = max(1, max_workers)
+        self._nodes = {}  # name -> (action, deps)
+        self._order = []
+
+    def add(self, name, action=None, deps=()):
+        '''
+        Add a node.  "action" is a no-arg callable (None for a pure barrier),
+        "deps" are names of nodes that must complete first.
+        '''
+        if name in self._nodes:
+            raise AssertionError("Duplicate scheduler node: %s" % name)
+        self._nodes[name] = (action, list(deps))
+        self._order.append(name)
+        return name
+
+    def __contains__(self, name):
+        return name in self._nodes
+
+    def _check(self):
+        for name in self._order:
+            for dep in self._nodes[name][1]:
+                if dep not in self._nodes:
+                    raise AssertionError("%s depends on unknown node: %s" % (name, dep))
+        # Kahn's algorithm, just to detect cycles up front
+        remaining = {n: len(set(self._nodes[n][1])) for n in self._order}
+        dependents = self._dependents()
+        ready = [n for n in self._order if not remaining[n]]
+        seen = 0
+        while ready:
+            seen += 1
+            for child in dependents[ready.pop()]:
+                remaining[child] -= 1
+                if not remaining[child]:
+                    ready.append(child)
+        if seen != len(self._order):
+            raise AssertionError("Dependency cycle between: %s"
+                                 % sorted(n for n, c in remaining.items() if c))
+
+    def _dependents(self):
+        dependents = {n: [] for n in self._order}
+        for name in self._order:
+            for dep in set(self._nodes[name][1]):
+                dependents[dep].append(name)
+        return dependents
+
+    def run(self):
+        '''
+        Run every node.  On the first failure no new nodes are started; the
+        ones already running are allowed to finish, then the error is raised.
+        '''
+        self._check()
+        remaining = {n: len(set(self._nodes[n][1])) for n in self._order}
+        dependents = self._dependents()
+        ready = [n for n in self._order if not remaining[n]]
+        position = {n: i for i, n in enumerate(self._order)}
+        errors = []
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            running = {}
+            while ready or running:
+                while ready and not errors:
+                    name = ready.pop(0)
+                    action = self._nodes[name][0]
+                    running[pool.submit(_traced, name, action)] = name
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        errors.append(future.exception())
+                        continue
+                    for child in dependents[name]:
+                        remaining[child] -= 1
+                        if not remaining[child]:
+                            ready.append(child)
+                ready.sort(key=position.get)
+        if errors:
+            raise errors[0]
+
+
+def _traced(name, action):
+    # barriers (no action) aren't worth a span
+    if action is not None:
+        with span(name, 'phase'):
+            action()
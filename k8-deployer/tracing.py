@@ -0,0 +1,177 @@
+'''
+Lightweight tracing -- timed spans around deploy phases, kubectl / API
+calls, retries, waits and template renders.
+
+Disabled (and close to free) until enable() is called.  Spans can be written
+as a Chrome trace-event file (chrome://tracing, Perfetto) and summarized as
+a table.
+'''
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+_LOCK = threading.Lock()
+_EVENTS = []
+_ENABLED = False
+
+
+def enable(enabled=True):
+    '''
+    Turn span recording on (or off)
+    '''
+    global _ENABLED  # pylint: disable=global-statement
+    _ENABLED = enabled
+
+
+def is_enabled():
+    '''
+    True when spans are being recorded
+    '''
+    return _ENABLED
+
+
+class _Span(object):
+    '''
+    A running span.  set() adds arguments (ie: an outcome) to it.
+    '''
+    __slots__ = ('args',)
+
+    def __init__(self, args):
+        self.args = args
+
+    def set(self, **args):
+        '''
+        Add arguments to the span
+        '''
+        self.args.update(args)
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def set(self, **args):
+        '''
+        Ignored -- tracing is off
+        '''
+
+
+_NULL_SPAN = _NullSpan()
+
+
+@contextlib.contextmanager
+def _recording(name, category, args):
+    current = _Span(args)
+    start = time.time()
+    try:
+        yield current
+    except BaseException as err:
+        current.args.setdefault('outcome', 'error')
+        current.args.setdefault('error', '%s: %s' % (type(err).__name__,
+                                                     str(err)[:200]))
+        raise
+    finally:
+        current.args.setdefault('outcome', 'ok')
+        record(name, category, start, time.time() - start, current.args)
+
+
+@contextlib.contextmanager
+def _not_recording():
+    yield _NULL_SPAN
+
+
+def span(name, category='deploy', **args):
+    '''
+    Context manager timing a block.  Exceptions are recorded (outcome
+    "error") and re-raised.
+    '''
+    if not _ENABLED:
+        return _not_recording()
+    return _recording(name, category, args)
+
+
+def record(name, category, start, duration, args=None, pid=None, tid=None):
+    '''
+    Record a finished span (start is a time.time() value)
+    '''
+    if not _ENABLED:
+        return
+    event = {'name': name, 'cat': category, 'ph': 'X',
+             'ts': int(start * 1e6), 'dur': int(duration * 1e6),
+             'pid': pid or os.getpid(), 'tid': tid or threading.current_thread().ident,
+             'args': args or {}}
+    with _LOCK:
+        _EVENTS.append(event)
+
+
+def drain():
+    '''
+    Returns (and forgets) every recorded span -- ie: to ship a worker
+    process's spans back to its parent
+    '''
+    with _LOCK:
+        events = list(_EVENTS)
+        del _EVENTS[:]
+    return events
+
+
+def merge(events):
+    '''
+    Add spans recorded elsewhere (ie: by a worker process)
+    '''
+    with _LOCK:
+        _EVENTS.extend(events)
+
+
+def write_chrome_trace(path):
+    '''
+    Write every span as a Chrome trace-event JSON file
+    '''
+    with _LOCK:
+        events = sorted(_EVENTS, key=lambda e: e['ts'])
+    with open(path, 'w') as t_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, t_file)
+
+
+def summary():
+    '''
+    Returns [(category, name, count, total, max, errors)] sorted by total
+    time, spans of the same name aggregated
+    '''
+    totals = {}
+    with _LOCK:
+        for event in _EVENTS:
+            key = (event['cat'], event['name'])
+            count, total, longest, errors = totals.get(key, (0, 0, 0, 0))
+            totals[key] = (count + 1, total + event['dur'], max(longest, event['dur']),
+                           errors + (event['args'].get('outcome') == 'error'))
+    return sorted(((cat, name, count, total / 1e6, longest / 1e6, errors)
+                   for (cat, name), (count, total, longest, errors) in totals.items()),
+                  key=lambda row: -row[3])
+
+
+def print_summary(limit=40):
+    '''
+    Print the (top "limit" rows of the) summary table
+    '''
+    rows = summary()
+    print('\033[36m%-10s %-50s %6s %10s %10s %6s' % (
+        'category', 'span', 'count', 'total(s)', 'max(s)', 'errors'))
+    for cat, name, count, total, longest, errors in rows[:limit]:
+        print('%-10s %-50s %6s %10.3f %10.3f %6s' % (
+            cat, name[:50], count, total, longest, errors or ''))
+    if len(rows) > limit:
+        print('... %s more' % (len(rows) - limit))
+    print('\033[39m', end='')
+
+
+def finish(path):
+    '''
+    Write the trace file (if tracing) and print the summary
+    '''
+    if _ENABLED and path:
+        write_chrome_trace(path)
+        print_summary()
+        print('Trace written to: %s' % path)
@@ -2,8 +2,17 @@
 Utility functions
 '''
 
+import glob
+import hashlib
+import json
+import os
 import subprocess
+import threading
 import time
+import yaml
+
+from kubectl_runtime import kubectl_binary
+from tracing import span
 
 def run_localcmd(command_args):
     '''
@@ -22,21 +31,305 @@ def run_minikubecmd(command_args):
     subprocess.check_call(['minikube', 'ssh'] + command_args)
 
 
-def run_kubecmd(namespace, command_args, retry_count=0):
+class KubectlTransport(object):
     '''
-    Runs kubectl CLI against a namespace
+    Runs every request through a freshly spawned `kubectl` process (the
+    client matching the cluster, see kubectl_runtime)
     '''
-    try:
+    name = 'kubectl'
+
+    def __init__(self):
+        self._watches = {}  # process -> owner
+        self._watches_lock = threading.Lock()
+
+    def run(self, namespace, command_args, input_data=None):
+        '''
+        Runs kubectl CLI against a namespace, returns its stripped stdout
+        '''
         return subprocess.check_output(
-            ['kubectl', "--namespace=%s" % namespace] + command_args,
-            universal_newlines=True).strip()
+            [kubectl_binary(), "--namespace=%s" % namespace] + command_args,
+            input=input_data, universal_newlines=True).strip()
+
+    def resource_names(self, namespace, resource_type):
+        '''
+        Returns list of names of all resources of type "resource_type"
+        '''
+        resources = self.run(namespace, ['get', resource_type, '-o', 'name']).splitlines()
+        return [resource.split('/', 1)[1] for resource in resources]
+
+    def list_objects(self, namespace, resource_type, name=None,
+                     label_selector=None):
+        '''
+        Returns a List (dict with "items" and "metadata") of full objects
+        '''
+        args = ['get', resource_type] + ([name, '--ignore-not-found']
+                                         if name else []) + ['-o', 'json']
+        if label_selector:
+            args += ['-l', label_selector]
+        result = json.loads(self.run(namespace, args) or '{}')
+        if name:  # a single object (or nothing), not a List
+            return {'items': [result] if result else [], 'metadata': {}}
+        return result
+
+    def watch(self, namespace, resource_type, resource_version=None,
+              name=None, timeout=60, owner=None):
+        '''
+        Generator of watch events ({"type", "object"}) for up to "timeout"
+        seconds.  `kubectl get --watch` prints the current state first and
+        doesn't report event types, so every event is reported as MODIFIED.
+        stop_watches(owner) ends it early.
+        '''
+        del resource_version  # kubectl can't resume from a resourceVersion
+        process = subprocess.Popen(
+            [kubectl_binary(), "--namespace=%s" % namespace, 'get', resource_type] +
+            ([name] if name else []) + ['--watch', '-o', 'json'],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        timer = threading.Timer(timeout, process.kill)
+        timer.start()
+        with self._watches_lock:
+            self._watches[process] = owner
+        try:
+            buf = []
+            for line in process.stdout:
+                buf.append(line)
+                if line.rstrip() == '}':  # end of a pretty-printed object
+                    yield {'type': 'MODIFIED', 'object': json.loads(''.join(buf))}
+                    buf = []
+        finally:
+            timer.cancel()
+            with self._watches_lock:
+                self._watches.pop(process, None)
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+    def stop_watches(self, owner=None):
+        '''
+        Ends the running watches of an owner (or, without one, every watch)
+        '''
+        with self._watches_lock:
+            for process, process_owner in self._watches.items():
+                if (owner is None or process_owner is owner) and process.poll() is None:
+                    process.kill()
+
+
+class ApiTransport(object):
+    '''
+    Serves the common kubectl verbs (get -o name, delete, apply -f) through an
+    in-process API client that keeps its connections open.  Anything it does
+    not understand is handed to the fallback (kubectl) transport.
+    '''
+    name = 'api'
+
+    def __init__(self, client, fallback=None):
+        self.client = client
+        self.fallback = fallback or KubectlTransport()
+
+    def run(self, namespace, command_args, input_data=None):
+        '''
+        Runs a kubectl style command, natively when possible
+        '''
+        verb, args = command_args[0], command_args[1:]
+        if verb == 'get' and len(args) == 3 and args[1:] == ['-o', 'name']:
+            kind = self.client.resource_info(args[0])[0].lower()
+            return '\n'.join('%s/%s' % (kind, name) for name in
+                             self.resource_names(namespace, args[0]))
+        if verb == 'delete' and len(args) >= 2 and not any(
+                a.startswith('-') for a in args[1:]
+                if a not in ('--all', '--ignore-not-found')):
+            names = [a for a in args[1:] if a != '--ignore-not-found']
+            return self._delete(namespace, args[0], names,
+                                ignore_not_found='--ignore-not-found' in args)
+        if verb == 'delete' and len(args) == 3 and args[1] == '-l':
+            return self._delete(namespace, args[0], ['--all'], label_selector=args[2])
+        if (verb == 'apply' and args and len(args) % 2 == 0 and
+                set(args[0::2]) == {'-f'} and '-' not in args[1::2]):
+            return '\n'.join(self._apply(namespace, path) for path in args[1::2])
+        if verb == 'apply' and args == ['-f', '-']:
+            return self._apply_docs(namespace, yaml.safe_load_all(input_data))
+        return self.fallback.run(namespace, command_args, input_data)
+
+    def resource_names(self, namespace, resource_type):
+        '''
+        Returns list of names of all resources of type "resource_type"
+        '''
+        return [item['metadata']['name'] for item in
+                self.client.list(namespace, resource_type).get('items', [])]
+
+    def list_objects(self, namespace, resource_type, name=None,
+                     label_selector=None):
+        '''
+        Returns a List (dict with "items" and "metadata") of full objects
+        '''
+        return self.client.list(namespace, resource_type,
+                                label_selector=label_selector,
+                                field_selector=('metadata.name=%s' % name
+                                                if name else None))
+
+    def watch(self, namespace, resource_type, resource_version=None,
+              name=None, timeout=60, owner=None):
+        '''
+        Generator of watch events ({"type", "object"}) for up to "timeout"
+        seconds, starting after resource_version
+        '''
+        del owner  # API watches end with their session
+        return self.client.watch(namespace, resource_type, resource_version,
+                                 field_selector=('metadata.name=%s' % name
+                                                 if name else None),
+                                 timeout_seconds=timeout)
+
+    def stop_watches(self, owner=None):
+        '''
+        Ends running kubectl watches (API watches end with their session)
+        '''
+        self.fallback.stop_watches(owner)
+
+    def _delete(self, namespace, resource_type, names, label_selector=None,
+                ignore_not_found=False):
+        kind = self.client.resource_info(resource_type)[0].lower()
+        if names == ['--all']:
+            names = [item['metadata']['name'] for item in self.client.list(
+                namespace, resource_type, label_selector=label_selector)['items']]
+            self.client.delete_collection(namespace, resource_type,
+                                          label_selector=label_selector)
+            return '\n'.join('%s "%s" deleted' % (kind, name) for name in names)
+        output = []
+        for name in names:
+            try:
+                self.client.delete(namespace, resource_type, name)
+            except subprocess.CalledProcessError as err:  # kube_api.ApiError
+                if err.returncode != 404 or not ignore_not_found:
+                    raise
+                continue  # already gone, like kubectl --ignore-not-found
+            output.append('%s "%s" deleted' % (kind, name))
+        return '\n'.join(output)
+
+    def _apply(self, namespace, path):
+        if os.path.isdir(path):  # like kubectl, directories are not recursed
+            files = sorted(f for f in glob.glob(os.path.join(path, '*'))
+                           if f.endswith(('.json', '.yaml', '.yml')))
+        else:
+            files = [path]
+        output = []
+        for k8_file in files:
+            with open(k8_file, 'r') as k_file:
+                output.append(self._apply_docs(namespace, yaml.safe_load_all(k_file)))
+        return '\n'.join(output)
+
+    def _apply_docs(self, namespace, docs):
+        # like kubectl, keep going past failed objects and fail at the end
+        output = []
+        failures = []
+        for doc in docs:
+            if not doc:
+                continue
+            obj = '%s/%s' % (doc['kind'].lower(), doc['metadata']['name'])
+            try:
+                output.append('%s %s' % (obj, self.client.apply(namespace, doc)))
+            except subprocess.CalledProcessError as err:
+                failures.append(err)
+                output.append('error: %s: %s' % (obj, err.output))
+        if failures:
+            failures[0].output = '\n'.join(output)
+            raise failures[0]
+        return '\n'.join(output)
+
+
+# Label stamped on every object we apply, so we can find "our" objects later
+OWNER_LABEL = ('app.kubernetes.io/managed-by', 'k8-deployer')
+OWNER_SELECTOR = '%s=%s' % OWNER_LABEL
+
+
+def stamp_ownership(doc):
+    '''
+    Adds the ownership label to a (parsed) kubernetes object
+    '''
+    metadata = doc.setdefault('metadata', {})
+    labels = metadata.get('labels') or {}
+    labels[OWNER_LABEL[0]] = OWNER_LABEL[1]
+    metadata['labels'] = labels
+    return doc
+
+
+# Annotation holding a hash of the rendered object, as last applied
+HASH_ANNOTATION = 'k8-deployer/content-hash'
+
+
+def stamp_content_hash(doc):
+    '''
+    Annotates a (parsed) kubernetes object with a hash of its own content,
+    and returns the hash
+    '''
+    metadata = doc.setdefault('metadata', {})
+    annotations = metadata.get('annotations') or {}
+    annotations.pop(HASH_ANNOTATION, None)
+    metadata['annotations'] = annotations
+    digest = hashlib.sha256(json.dumps(doc, sort_keys=True, default=str)
+                            .encode('utf-8')).hexdigest()
+    annotations[HASH_ANNOTATION] = digest
+    return digest
+
+
+_TRANSPORT = None
+
+
+def set_transport(transport):
+    '''
+    Select the transport used by run_kubecmd / all_resource_names.  Accepts
+    a transport object, or the name "kubectl" / "api".  The "api" transport
+    reads $KUBECONFIG and falls back to kubectl when it can't be used.
+    '''
+    global _TRANSPORT  # pylint: disable=global-statement
+    if transport == 'api':
+        from kube_api import KubeApiClient  # pylint: disable=import-outside-toplevel
+        kubeconfig = os.path.expanduser(
+            os.environ.get('KUBECONFIG', '~/.kube/config').split(os.pathsep)[0])
+        try:
+            transport = ApiTransport(KubeApiClient.from_kubeconfig(kubeconfig))
+        except (ValueError, KeyError, IOError) as err:
+            print('\033[33mWarning: API transport unavailable (%s), '
+                  'using kubectl\033[39m' % err)
+            transport = KubectlTransport()
+    elif transport == 'kubectl' or transport is None:
+        transport = KubectlTransport()
+    _TRANSPORT = transport
+    return _TRANSPORT
+
+
+def get_transport():
+    '''
+    Returns the active transport (from $K8_DEPLOYER_TRANSPORT, default kubectl)
+    '''
+    if _TRANSPORT is None:
+        set_transport(os.environ.get('K8_DEPLOYER_TRANSPORT', 'kubectl'))
+    return _TRANSPORT
+
+
+def _retrying(fun, retry_count=0, name='kubectl'):
+    '''
+    Calls fun(), retrying (up to 3 times, 5 seconds apart) on failure
+    '''
+    try:
+        with span(name, get_transport().name, attempt=retry_count):
+            return fun()
     except subprocess.CalledProcessError as cpe:
         # could use @retrying package, but don't want to pull in an outside pip dependency
         if retry_count > 2: # max retries
             raise cpe # done with retries
         print('Warning: kubectl CalledProcessError: %s, retrying in 5 seconds...' % cpe)
-        time.sleep(5) # sleep 5-seconds
-        return run_kubecmd(namespace, command_args, retry_count+1)
+        with span('retry sleep', 'retry', call=name):
+            time.sleep(5) # sleep 5-seconds
+        return _retrying(fun, retry_count+1, name)
+
+
+def run_kubecmd(namespace, command_args, retry_count=0, input_data=None):
+    '''
+    Runs kubectl CLI against a namespace (optionally feeding it input_data
+    on stdin)
+    '''
+    return _retrying(lambda: get_transport().run(namespace, command_args,
+                                                 input_data),
+                     retry_count, ' '.join(command_args[:2]))
 
 
 
@@ -44,5 +337,26 @@ def all_resource_names(namespace, resource_type):
     '''
     Returns list of names of all resources of type "resource_type" in namespace
     '''
-    resources = run_kubecmd(namespace, ['get', resource_type, '-o', 'name']).splitlines()
-    return [resource.split('/', 1)[1] for resource in resources]
+    return _retrying(lambda: get_transport().resource_names(namespace,
+                                                            resource_type),
+                     name='names %s' % resource_type)
+
+
+def list_objects(namespace, resource_type, name=None, label_selector=None):
+    '''
+    Returns a List (dict with "items" and "metadata.resourceVersion") of all
+    resources of type "resource_type" (or just "name") in namespace
+    '''
+    return _retrying(lambda: get_transport().list_objects(
+        namespace, resource_type, name=name, label_selector=label_selector),
+                     name='list %s' % resource_type)
+
+
+def watch_objects(namespace, resource_type, resource_version=None, name=None,
+                  timeout=60, owner=None):
+    '''
+    Generator of watch events for resources of type "resource_type"
+    (transport.stop_watches(owner) ends it early)
+    '''
+    return get_transport().watch(namespace, resource_type, resource_version,
+                                 name=name, timeout=timeout, owner=owner)
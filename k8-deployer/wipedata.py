@@ -12,13 +12,17 @@ Mounts all PVCs and `rm -rf` their contents
 '''
 
 import argparse
+import concurrent.futures
 import os
 import sys
 import time
+import yaml
 
 # External dependencies
+import cluster_cache
 from deploy import wait_online
-from gen_k8 import gen_jinja
+from gen_k8 import gen_jinja, render_each
+from readiness import wait_job
 from utils import run_kubecmd, all_resource_names
 
 
@@ -46,6 +50,16 @@ def main():
         '-s', '--subpath', required=False,
         help='Optional subpath directory on the specified PVC')
 
+    group = parser.add_argument_group(
+        'All PVCs', 'Options for wiping all PVCs in the namespace.')
+    group.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of wipe Jobs to run at once.  Default is 1')
+    group.add_argument(
+        '--pvcs-per-pod', type=int, default=1,
+        help=('Mount (and wipe) this many PVCs from each wipe pod.  Only use'
+              ' with PVCs that can be mounted on the same node.  Default is 1'))
+
     args = parser.parse_args()
     if args.subpath and not args.pvc:
         sys.exit('Error: -s (--subpath) is only valid with -p (--pvc)')
@@ -66,7 +80,7 @@ def main():
     else:
         print('WIPING ALL PVCS IN %s, in 10 seconds...' % args.namespace)
         time.sleep(10)
-        _wipe_all_pvs(args.namespace) # wipe the PVCs
+        _wipe_all_pvs(args.namespace, args.jobs, args.pvcs_per_pod) # wipe the PVCs
 
 
 def _wipe_pvc(pvc, subpath, namespace,
@@ -92,6 +106,7 @@ def _wipe_pvc(pvc, subpath, namespace,
     try:
         print('Starting job: %s' % job_name)
         print(run_kubecmd(namespace, ['apply', '-f', template]))
+        cluster_cache.invalidate(namespace, 'Job', [job_name])
         print('Waiting for job: %s to complete.' % job_name)
         wait_online(namespace, template)
     finally:
@@ -99,14 +114,55 @@ def _wipe_pvc(pvc, subpath, namespace,
         print(run_kubecmd(namespace, ['delete', 'job', job_name]))
 
 
-def _wipe_all_pvs(namespace):
+def _run_wipe_job(namespace, job_name, rendered_job):
+    '''
+    Apply a rendered wipe job, wait for it to complete, then delete it
+    '''
+    try:
+        print('Starting job: %s' % job_name)
+        print(run_kubecmd(namespace, ['apply', '-f', '-'], input_data=rendered_job))
+        cluster_cache.invalidate(namespace, 'Job', [job_name])
+        wait_job(namespace, job_name)
+    finally:
+        print('Deleting job: %s' % job_name)
+        print(run_kubecmd(namespace, ['delete', 'job', job_name]))
+
+
+def _wipe_all_pvs(namespace, jobs=1, pvcs_per_pod=1,
+                  working_dir=os.path.dirname(os.path.abspath(__file__))):
     '''
-    Find all PVCs, and wipe their contents
+    Find all PVCs, and wipe their contents -- "jobs" wipe Jobs at a time,
+    each mounting up to "pvcs_per_pod" PVCs.  Every Job is rendered up front
+    in one pass.  Reports per-PVC results and fails if any wipe failed.
     '''
-    pvcs = all_resource_names(namespace, 'pvc')
+    pvcs = sorted(all_resource_names(namespace, 'pvc'))
     print('PVCs to wipe: %s' % pvcs)
+    pvcs_per_pod = max(1, pvcs_per_pod)
+    groups = [pvcs[i:i + pvcs_per_pod] for i in range(0, len(pvcs), pvcs_per_pod)]
+    job_names = [('wipe-%s' % group[0] if len(group) == 1 else 'wipe-batch-%s' % index)
+                 for index, group in enumerate(groups)]
+    rendered = render_each(
+        os.path.join(working_dir, 'utilities', 'pvc_recycler'), 'pvc_recycler.yml',
+        [{'JOB_NAME': job_name, 'CLAIMS': [{'claim': pvc} for pvc in group]}
+         for job_name, group in zip(job_names, groups)])
+    for rendered_job in rendered:
+        yaml.safe_load(rendered_job)  # fail early on a broken template
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as pool:
+        futures = {pool.submit(_run_wipe_job, namespace, job_name, rendered_job): group
+                   for job_name, group, rendered_job in zip(job_names, groups, rendered)}
+        for future in concurrent.futures.as_completed(futures):
+            error = future.exception()
+            for pvc in futures[future]:
+                results[pvc] = 'FAILED: %s' % error if error else 'wiped'
+
+    print('Wipe results:')
     for pvc in pvcs:
-        _wipe_pvc(pvc, None, namespace)
+        print('  %s: %s' % (pvc, results[pvc]))
+    failed = [pvc for pvc in pvcs if results[pvc] != 'wiped']
+    if failed:
+        raise AssertionError("Failed to wipe PVCs: %s" % failed)
 
 
 if __name__ == "__main__":